@@ -1,5 +1,5 @@
 import os
-import sys
+import argparse
 
 from src.logger import create_logger
 from src.data.dictionary import Dictionary
@@ -7,18 +7,30 @@ from src.data.dictionary import Dictionary
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Binarize a text file')
+    parser.add_argument("voc_path", type=str,
+                        help="Vocabulary file")
+    parser.add_argument("txt_path", type=str,
+                        help="Text file to binarize (saved to txt_path.pth)")
+    parser.add_argument("--mmap", action='store_true',
+                        help="Save the data in the memory-mapped format")
+    parser.add_argument("--n_workers", type=int, default=1,
+                        help="Number of binarization processes")
+    args = parser.parse_args()
+
     logger = create_logger(None)
 
-    voc_path = sys.argv[1]
-    txt_path = sys.argv[2]
-    bin_path = sys.argv[2] + '.pth'
+    voc_path = args.voc_path
+    txt_path = args.txt_path
+    bin_path = args.txt_path + '.pth'
     assert os.path.isfile(voc_path)
     assert os.path.isfile(txt_path)
+    assert args.n_workers >= 1
 
     dico = Dictionary.read_vocab(voc_path)
     logger.info("")
 
-    data = Dictionary.index_data(txt_path, bin_path, dico)
+    data = Dictionary.index_data(txt_path, bin_path, dico, mmap=args.mmap, n_workers=args.n_workers)
     logger.info("%i words (%i unique) in %i sentences." % (
         len(data['sentences']) - len(data['positions']),
         len(data['dico']),
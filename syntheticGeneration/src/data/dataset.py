@@ -15,27 +15,59 @@ class Dataset(object):
         self.unk_index = params.unk_index
         self.bos_index = params.bos_index
         self.batch_size = params.batch_size
+        self.max_tokens = params.max_tokens
+        self.max_vocab = params.max_vocab
 
-    def batch_sentences(self, sentences, lang_id):
+    def batch_sentences(self, sent, pos, lang_id):
         """
-        Take as input a list of n sentences (torch.LongTensor vectors) and return
-        a tensor of size (s_len, n) where s_len is the length of the longest
-        sentence, and a vector lengths containing the length of each sentence.
+        Take as input a flat array of sentences and the (start, end) positions
+        of n sentences in this array, and return a tensor of size (s_len, n)
+        where s_len is the length of the longest sentence, and a vector lengths
+        containing the length of each sentence.
+        Sentences are stored with a compact dtype, and only converted to int64 here.
         """
         assert type(lang_id) is int
-        lengths = torch.LongTensor([len(s) + 2 for s in sentences])
-        sent = torch.LongTensor(lengths.max(), lengths.size(0)).fill_(self.pad_index)
-
-        sent[0] = self.bos_index[lang_id]
-        for i, s in enumerate(sentences):
-            sent[1:lengths[i] - 1, i].copy_(s)
-            sent[lengths[i] - 1, i] = self.eos_index
-
-        return sent, lengths
+        lengths = (pos[:, 1] - pos[:, 0]).astype(np.int64) + 2
+        slen, bs = lengths.max(), len(lengths)
+
+        # gather all words at once (BOS / EOS are not stored in the sentences array)
+        word_ids = np.arange(slen - 2)[:, None]
+        mask = word_ids < (lengths - 2)[None, :]
+        batch = np.full((slen, bs), self.pad_index, dtype=np.int64)
+        batch[0] = self.bos_index[lang_id]
+        batch[1:-1][mask] = sent[(pos[:, 0][None, :] + word_ids)[mask]]
+        batch[lengths - 1, np.arange(bs)] = self.eos_index
+        sent = torch.from_numpy(batch)
+
+        # memory-mapped data is not pruned when it is loaded
+        if self.max_vocab != -1:
+            sent.masked_fill_(sent >= self.max_vocab, self.unk_index)
+
+        return sent, torch.from_numpy(lengths)
     
     # batch_sentences method processes the input sentences
     # and prepares them as a tensor for further processing in batches.
 
+    def split_batches(self, indices, lengths):
+        """
+        Split sentence indices into batches. If `max_tokens` is set, consecutive
+        sentences are packed into batches of at most `max_tokens` padded tokens
+        (BOS / EOS included), otherwise batches contain `batch_size` sentences.
+        """
+        if self.max_tokens == -1:
+            return np.array_split(indices, math.ceil(len(indices) * 1. / self.batch_size))
+        batches = []
+        start = 0
+        max_len = 0
+        for i, length in enumerate((lengths[indices] + 2).tolist()):
+            max_len = max(max_len, length)
+            if max_len * (i - start + 1) > self.max_tokens and i > start:
+                batches.append(indices[start:i])
+                start = i
+                max_len = length
+        batches.append(indices[start:])
+        return batches
+
 
 class MonolingualDataset(Dataset):
 
@@ -49,13 +81,14 @@ class MonolingualDataset(Dataset):
         self.lengths = self.pos[:, 1] - self.pos[:, 0]
         self.is_parallel = False
 
-        # check number of sentences
-        assert len(self.pos) == (self.sent == -1).sum()
+        # check number of sentences (full scans are skipped for memory-mapped data)
+        is_mmap = isinstance(sent, np.memmap)
+        assert is_mmap or len(self.pos) == (self.sent == -1).sum()
 
         self.remove_empty_sentences()
 
-        assert len(pos) == (sent[torch.from_numpy(pos[:, 1])] == -1).sum()  # check sentences indices
-        assert -1 <= sent.min() < sent.max() < len(dico)                    # check dictionary indices
+        assert len(pos) == (sent[pos[:, 1]] == -1).sum()                     # check sentences indices
+        assert is_mmap or -1 <= sent.min() < sent.max() < len(dico)         # check dictionary indices
         assert self.lengths.min() > 0                                       # check empty sentences
 
     def __len__(self):
@@ -105,22 +138,23 @@ class MonolingualDataset(Dataset):
         """
         def iterator():
             for sentence_ids in batches:
-                pos = self.pos[sentence_ids]
-                sent = [self.sent[a:b] for a, b in pos]
-                yield self.batch_sentences(sent, self.lang_id)
+                yield self.batch_sentences(self.sent, self.pos[sentence_ids], self.lang_id)
         return iterator
 
-    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1):
+    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1, seed=None, start_batch=0):
         """
         Return a sentences iterator.
+        If `seed` is set, batches are shuffled with a dedicated random generator,
+        so the iterator can be re-created and resumed from `start_batch`.
         """
         n_sentences = len(self.pos) if n_sentences == -1 else n_sentences
         assert 0 < n_sentences <= len(self.pos)
         assert type(shuffle) is bool and type(group_by_size) is bool
 
         # select sentences to iterate over
+        rng = np.random if seed is None else np.random.RandomState(seed)
         if shuffle:
-            indices = np.random.permutation(len(self.pos))[:n_sentences]
+            indices = rng.permutation(len(self.pos))[:n_sentences]
         else:
             indices = np.arange(n_sentences)
 
@@ -129,12 +163,12 @@ class MonolingualDataset(Dataset):
             indices = indices[np.argsort(self.lengths[indices], kind='mergesort')]
 
         # create batches / optionally shuffle them
-        batches = np.array_split(indices, math.ceil(len(indices) * 1. / self.batch_size))
+        batches = self.split_batches(indices, self.lengths)
         if shuffle:
-            np.random.shuffle(batches)
+            rng.shuffle(batches)
 
         # return the iterator
-        return self.get_batches_iterator(batches)
+        return self.get_batches_iterator(batches[start_batch:])
 
 
 class ParallelDataset(Dataset):
@@ -155,17 +189,18 @@ class ParallelDataset(Dataset):
         self.lengths2 = self.pos2[:, 1] - self.pos2[:, 0]
         self.is_parallel = True
 
-        # check number of sentences
-        assert len(self.pos1) == (self.sent1 == -1).sum()
-        assert len(self.pos2) == (self.sent2 == -1).sum()
+        # check number of sentences (full scans are skipped for memory-mapped data)
+        is_mmap = isinstance(sent1, np.memmap) or isinstance(sent2, np.memmap)
+        assert is_mmap or len(self.pos1) == (self.sent1 == -1).sum()
+        assert is_mmap or len(self.pos2) == (self.sent2 == -1).sum()
 
         self.remove_empty_sentences()
 
         assert len(pos1) == len(pos2) > 0                                      # check number of sentences
-        assert len(pos1) == (sent1[torch.from_numpy(pos1[:, 1])] == -1).sum()  # check sentences indices
-        assert len(pos2) == (sent2[torch.from_numpy(pos2[:, 1])] == -1).sum()  # check sentences indices
-        assert -1 <= sent1.min() < sent1.max() < len(dico1)                    # check dictionary indices
-        assert -1 <= sent2.min() < sent2.max() < len(dico2)                    # check dictionary indices
+        assert len(pos1) == (sent1[pos1[:, 1]] == -1).sum()                     # check sentences indices
+        assert len(pos2) == (sent2[pos2[:, 1]] == -1).sum()                     # check sentences indices
+        assert is_mmap or -1 <= sent1.min() < sent1.max() < len(dico1)         # check dictionary indices
+        assert is_mmap or -1 <= sent2.min() < sent2.max() < len(dico2)         # check dictionary indices
         assert self.lengths1.min() > 0                                         # check empty sentences
         assert self.lengths2.min() > 0                                         # check empty sentences
 
@@ -228,22 +263,24 @@ class ParallelDataset(Dataset):
             for sentence_ids in batches:
                 pos1 = self.pos1[sentence_ids]
                 pos2 = self.pos2[sentence_ids]
-                sent1 = [self.sent1[a:b] for a, b in pos1]
-                sent2 = [self.sent2[a:b] for a, b in pos2]
-                yield self.batch_sentences(sent1, self.lang1_id), self.batch_sentences(sent2, self.lang2_id)
+                yield (self.batch_sentences(self.sent1, pos1, self.lang1_id),
+                       self.batch_sentences(self.sent2, pos2, self.lang2_id))
         return iterator
 
-    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1):
+    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1, seed=None, start_batch=0):
         """
         Return a sentences iterator.
+        If `seed` is set, batches are shuffled with a dedicated random generator,
+        so the iterator can be re-created and resumed from `start_batch`.
         """
         n_sentences = len(self.pos1) if n_sentences == -1 else n_sentences
         assert 0 < n_sentences <= len(self.pos1)
         assert type(shuffle) is bool and type(group_by_size) is bool
 
         # select sentences to iterate over
+        rng = np.random if seed is None else np.random.RandomState(seed)
         if shuffle:
-            indices = np.random.permutation(len(self.pos1))[:n_sentences]
+            indices = rng.permutation(len(self.pos1))[:n_sentences]
         else:
             indices = np.arange(n_sentences)
 
@@ -253,9 +290,10 @@ class ParallelDataset(Dataset):
             indices = indices[np.argsort(self.lengths1[indices], kind='mergesort')]
 
         # create batches / optionally shuffle them
-        batches = np.array_split(indices, math.ceil(len(indices) * 1. / self.batch_size))
+        # the padded size of a batch is given by its longest sentence on either side
+        batches = self.split_batches(indices, np.maximum(self.lengths1, self.lengths2))
         if shuffle:
-            np.random.shuffle(batches)
+            rng.shuffle(batches)
 
         # return the iterator
-        return self.get_batches_iterator(batches)
+        return self.get_batches_iterator(batches[start_batch:])
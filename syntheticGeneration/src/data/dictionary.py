@@ -6,6 +6,8 @@
 #
 
 import os
+import multiprocessing
+import numpy as np
 import torch
 from logging import getLogger
 
@@ -24,6 +26,27 @@ UNK_WORD = '<unk>'
 SPECIAL_WORD = '<special%i>'
 SPECIAL_WORDS = 10
 
+# memory-mapped binarized data: flat token ids / (n_sentences, 2) offsets index
+MMAP_TOKENS_SUFFIX = '.tok'
+MMAP_INDEX_SUFFIX = '.idx'
+
+BINARIZE_CHUNK_SIZE = 1 << 20  # number of tokens buffered by a binarizer worker before writing to disk
+
+
+def get_index_dtype(n_words):
+    """
+    Smallest signed integer type able to store the indices of a dictionary
+    with `n_words` words, as well as the -1 sentence separator.
+    """
+    return np.int16 if n_words <= np.iinfo(np.int16).max + 1 else np.int32
+
+
+def get_positions_dtype(n_tokens):
+    """
+    Smallest integer type able to store positions in a flat array of `n_tokens` tokens.
+    """
+    return np.int32 if n_tokens <= np.iinfo(np.int32).max else np.int64
+
 
 class Dictionary(object):
 
@@ -92,8 +115,17 @@ class Dictionary(object):
         assert max_vocab >= 1
         self.id2word = {k: v for k, v in self.id2word.items() if k < max_vocab}
         self.word2id = {v: k for k, v in self.id2word.items()}
+        self._words = None
         self.check_valid()
 
+    def get_words(self):
+        """
+        Return the words as a numpy object array, to convert indices with a single lookup.
+        """
+        if getattr(self, '_words', None) is None:
+            self._words = np.array([self.id2word[i] for i in range(len(self))], dtype=object)
+        return self._words
+
     @staticmethod
     def read_vocab(vocab_path):
         """
@@ -125,58 +157,223 @@ class Dictionary(object):
         return dico
 
     @staticmethod
-    def index_data(path, bin_path, dico):
+    def save_mmap_header(bin_path, dico, unk_words, dtype, positions_dtype, n_tokens, n_sentences):
+        """
+        Save the header of data stored in the memory-mapped format.
+        """
+        torch.save({
+            'dico': dico,
+            'unk_words': unk_words,
+            'mmap': True,
+            'dtype': np.dtype(dtype).str,
+            'positions_dtype': np.dtype(positions_dtype).str,
+            'n_tokens': n_tokens,
+            'n_sentences': n_sentences,
+        }, bin_path)
+
+    @staticmethod
+    def load_mmap(bin_path, header=None):
+        """
+        Open data saved in the memory-mapped format. Sentences and positions
+        are read-only `np.memmap` arrays, nothing is loaded in memory.
+        """
+        if header is None:
+            header = torch.load(bin_path)
+        assert header.get('mmap', False), bin_path
+        tok_path = bin_path + MMAP_TOKENS_SUFFIX
+        idx_path = bin_path + MMAP_INDEX_SUFFIX
+        assert os.path.isfile(tok_path), tok_path
+        assert os.path.isfile(idx_path), idx_path
+        sentences = np.memmap(tok_path, dtype=np.dtype(header['dtype']), mode='r',
+                              shape=(header['n_tokens'],))
+        positions = np.memmap(idx_path, dtype=np.dtype(header.get('positions_dtype', '<i8')), mode='r',
+                              shape=(header['n_sentences'], 2))
+        return {
+            'dico': header['dico'],
+            'positions': positions,
+            'sentences': sentences,
+            'unk_words': header['unk_words'],
+        }
+
+    @staticmethod
+    def index_data(path, bin_path, dico, mmap=False, n_workers=1, chunk_size=BINARIZE_CHUNK_SIZE):
         """
         Index sentences with a dictionary.
+        The input file is split into byte ranges, indexed by `n_workers`
+        processes, and each shard is streamed to disk in chunks of
+        `chunk_size` tokens. If `mmap` is set, save the data in the
+        memory-mapped format, without loading it in memory.
         """
         if os.path.isfile(bin_path):
             print("Loading data from %s ..." % bin_path)
             data = torch.load(bin_path)
+            if data.get('mmap', False):
+                data = Dictionary.load_mmap(bin_path, data)
             assert dico == data['dico']
             return data
 
-        positions = []
-        sentences = []
+        # index shards
+        assert n_workers >= 1 and chunk_size >= 1
+        n_shards = 1 if n_workers == 1 else 4 * n_workers
+        shards = [
+            (path, start, end, dico, '%s.shard%i' % (bin_path, i), chunk_size)
+            for i, (start, end) in enumerate(get_shard_ranges(path, n_shards))
+        ]
+        if n_workers == 1:
+            results = [index_shard(shard) for shard in shards]
+        else:
+            with multiprocessing.Pool(n_workers) as pool:
+                results = pool.map(index_shard, shards)
+
+        # merge unknown words / report empty sentences with their global line number
         unk_words = {}
+        n_lines = 0
+        for result in results:
+            for w, c in result['unk_words'].items():
+                unk_words[w] = unk_words.get(w, 0) + c
+            for i in result['empty_lines']:
+                print("Empty sentence in line %i." % (n_lines + i))
+            n_lines += result['n_sentences']
+        n_tokens = sum(result['n_tokens'] for result in results)
 
-        # index sentences
-        f = open(path, 'r', encoding='utf-8')
-        for i, line in enumerate(f):
-            if i % 1000000 == 0 and i > 0:
-                print(i)
+        # merge shards
+        print("Saving the data to %s ..." % bin_path)
+        if mmap:
+            dtype = get_index_dtype(len(dico))
+            positions_dtype = get_positions_dtype(n_tokens)
+            with open(bin_path + MMAP_TOKENS_SUFFIX, 'wb') as f_tok, open(bin_path + MMAP_INDEX_SUFFIX, 'wb') as f_idx:
+                offset = 0
+                for result in results:
+                    for tokens in iter_chunks(result['tok_path'], np.int32, chunk_size):
+                        tokens.astype(dtype).tofile(f_tok)
+                    for lengths in iter_chunks(result['len_path'], np.int64, chunk_size):
+                        get_positions(lengths, offset).astype(positions_dtype).tofile(f_idx)
+                        offset += int((lengths + 1).sum())
+                assert offset == n_tokens
+            Dictionary.save_mmap_header(bin_path, dico, unk_words, dtype, positions_dtype, n_tokens, n_lines)
+        else:
+            sentences = np.concatenate([np.fromfile(result['tok_path'], dtype=np.int32) for result in results])
+            lengths = np.concatenate([np.fromfile(result['len_path'], dtype=np.int64) for result in results])
+            assert len(sentences) == n_tokens and len(lengths) == n_lines
+            data = {
+                'dico': dico,
+                'positions': torch.from_numpy(get_positions(lengths, 0)),
+                'sentences': torch.from_numpy(sentences.astype(np.int64)),
+                'unk_words': unk_words,
+            }
+            torch.save(data, bin_path)
+        for result in results:
+            os.remove(result['tok_path'])
+            os.remove(result['len_path'])
+
+        return Dictionary.load_mmap(bin_path) if mmap else data
+
+
+def get_shard_ranges(path, n_shards):
+    """
+    Split a text file into `n_shards` byte ranges aligned on line boundaries.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_shards):
+            f.seek(max(size * i // n_shards, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()  # move to the beginning of the next line
+            bounds.append(f.tell())
+    bounds.append(size)
+    ranges = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+    return ranges if len(ranges) > 0 else [(0, size)]
+
+
+def read_lines(path, start, end):
+    """
+    Iterate over the lines of a byte range of a text file. Lines are split
+    the same way as when iterating over a file opened in text mode.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            text = f.readline().decode('utf-8')
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+            lines = text.split('\n')
+            if text.endswith('\n'):
+                lines = lines[:-1]
+            for line in lines:
+                yield line
+
+
+def index_shard(args):
+    """
+    Index a byte range of a text file, and stream the flat token ids (with
+    a -1 at the end of each sentence) and the sentence lengths to disk.
+    """
+    path, start, end, dico, shard_path, chunk_size = args
+    tok_path, len_path = shard_path + '.tok', shard_path + '.len'
+    unk_words = {}
+    empty_lines = []
+    n_sentences = 0
+    n_tokens = 0
+    tokens = []
+    lengths = []
+
+    with open(tok_path, 'wb') as f_tok, open(len_path, 'wb') as f_len:
+        for i, line in enumerate(read_lines(path, start, end)):
             s = line.rstrip().split()
             # skip empty sentences
             if len(s) == 0:
-                print("Empty sentence in line %i." % i)
-                # continue
+                empty_lines.append(i)
             # index sentence words
-            count_unk = 0
-            indexed = []
+            n_words = 0
             for w in s:
                 word_id = dico.index(w, no_unk=False)
                 if word_id < 4 + SPECIAL_WORDS and word_id != dico.unk_index:
                     logger.warning('Found unexpected special word "%s" (%i)!!' % (w, word_id))
                     continue
-                indexed.append(word_id)
+                tokens.append(word_id)
+                n_words += 1
                 if word_id == dico.unk_index:
                     unk_words[w] = unk_words.get(w, 0) + 1
-                    count_unk += 1
             # add sentence
-            positions.append([len(sentences), len(sentences) + len(indexed)])
-            sentences.extend(indexed)
-            sentences.append(-1)
-        f.close()
+            tokens.append(-1)
+            lengths.append(n_words)
+            n_sentences += 1
+            n_tokens += n_words + 1
+            # flush chunk
+            if len(tokens) >= chunk_size:
+                np.array(tokens, dtype=np.int32).tofile(f_tok)
+                np.array(lengths, dtype=np.int64).tofile(f_len)
+                tokens, lengths = [], []
+        np.array(tokens, dtype=np.int32).tofile(f_tok)
+        np.array(lengths, dtype=np.int64).tofile(f_len)
+
+    return {
+        'tok_path': tok_path,
+        'len_path': len_path,
+        'n_sentences': n_sentences,
+        'n_tokens': n_tokens,
+        'unk_words': unk_words,
+        'empty_lines': empty_lines,
+    }
+
+
+def iter_chunks(path, dtype, chunk_size):
+    """
+    Iterate over a flat binary array file, `chunk_size` elements at a time.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            chunk = np.fromfile(f, dtype=dtype, count=chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
 
-        # tensorize data
-        positions = torch.LongTensor(positions)
-        sentences = torch.LongTensor(sentences)
-        data = {
-            'dico': dico,
-            'positions': positions,
-            'sentences': sentences,
-            'unk_words': unk_words,
-        }
-        print("Saving the data to %s ..." % bin_path)
-        torch.save(data, bin_path)
 
-        return data
+def get_positions(lengths, offset):
+    """
+    Compute the (start, end) positions of sentences in the flat token array,
+    given their lengths and the position of the first sentence.
+    """
+    ends = offset + np.cumsum(lengths + 1) - 1
+    return np.stack([ends - lengths, ends], 1).astype(np.int64)
@@ -1,29 +1,40 @@
 import os
+from collections import OrderedDict
+from functools import partial
 from logging import getLogger
+import numpy as np
 import torch
 
 from ..utils import create_word_masks
 from .dataset import MonolingualDataset, ParallelDataset
+from .dictionary import Dictionary, get_index_dtype, get_positions_dtype
 from .dictionary import EOS_WORD, PAD_WORD, UNK_WORD, SPECIAL_WORD, SPECIAL_WORDS
 
 
 logger = getLogger()
 
 
-loaded_data = {}  # store binarized datasets in memory in case of multiple reloadings
+loaded_data = OrderedDict()  # most recently used binarized datasets, in case of multiple reloadings
 
 
 def load_binarized(path, params):
     """
     Load a binarized dataset and log main statistics.
+    Sentences / positions are returned as numpy arrays, which are memory-mapped
+    if the dataset was binarized in the memory-mapped format.
     """
     if path in loaded_data:
         logger.info("Reloading data loaded from %s ..." % path)
+        loaded_data.move_to_end(path)
         return loaded_data[path]
     assert os.path.isfile(path), path
     logger.info("Loading data from %s ..." % path)
     data = torch.load(path)
-    data['positions'] = data['positions'].numpy()
+    if data.get('mmap', False):
+        data = Dictionary.load_mmap(path, data)
+    else:
+        data['sentences'] = data['sentences'].numpy()
+        data['positions'] = data['positions'].numpy()
     logger.info("%i words (%i unique) in %i sentences. %i unknown words (%i unique)." % (
         len(data['sentences']) - len(data['positions']),
         len(data['dico']), len(data['positions']),
@@ -33,12 +44,23 @@ def load_binarized(path, params):
         assert params.max_vocab > 0
         logger.info("Selecting %i most frequent words ..." % params.max_vocab)
         data['dico'].prune(params.max_vocab)
-        data['sentences'].masked_fill_((data['sentences'] >= params.max_vocab), data['dico'].index(UNK_WORD))
-        unk_count = (data['sentences'] == data['dico'].index(UNK_WORD)).sum()
-        logger.info("Now %i unknown words covering %.2f%% of the data." % (
-            unk_count, 100. * unk_count / (len(data['sentences']) - len(data['positions']))
-        ))
+        if isinstance(data['sentences'], np.memmap):
+            # memory-mapped data is read-only, words are replaced when batching
+            logger.info("Words outside the vocabulary will be replaced by %s on the fly." % UNK_WORD)
+        else:
+            data['sentences'][data['sentences'] >= params.max_vocab] = data['dico'].index(UNK_WORD)
+            unk_count = (data['sentences'] == data['dico'].index(UNK_WORD)).sum()
+            logger.info("Now %i unknown words covering %.2f%% of the data." % (
+                unk_count, 100. * unk_count / (len(data['sentences']) - len(data['positions']))
+            ))
+
+    # store word indices / positions with a compact dtype (memory-mapped data already is)
+    if not isinstance(data['sentences'], np.memmap):
+        data['sentences'] = data['sentences'].astype(get_index_dtype(len(data['dico'])))
+        data['positions'] = data['positions'].astype(get_positions_dtype(len(data['sentences'])))
     loaded_data[path] = data
+    while len(loaded_data) > params.data_cache_size:
+        loaded_data.popitem(last=False)
     return data
 
 
@@ -133,72 +155,150 @@ def check_dictionaries(params, data):
                 for i in range(1, params.n_langs)))
 
 
+class LazySplits(object):
+    """
+    Datasets of a language / language pair, indexed by split name.
+    Each split is only loaded on first access, and can be released afterwards.
+    """
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.datasets = {}
+
+    def __getitem__(self, name):
+        if self.loaders[name] is None:
+            return None
+        if name not in self.datasets:
+            self.datasets[name] = self.loaders[name]()
+        return self.datasets[name]
+
+    def is_loaded(self, name):
+        return name in self.datasets
+
+    def release(self, name):
+        """
+        Release a split. It will be reloaded on the next access.
+        """
+        self.datasets.pop(name, None)
+
+
+def release_data(data, names):
+    """
+    Release the given splits of all datasets. Together with the bounded
+    cache of binarized files, this frees their memory. Released splits are
+    reloaded on the next access.
+    """
+    for splits in list(data['mono'].values()) + list(data['para'].values()) + list(data['back'].values()):
+        for name in names:
+            splits.release(name)
+
+
+def set_dictionary(params, data, lang, dico):
+    """
+    Set / check the dictionary of a language.
+    """
+    set_parameters(params, dico)
+    if lang not in data['dico']:
+        data['dico'][lang] = dico
+    else:
+        assert data['dico'][lang] == dico
+
+
+def load_para_split(params, data, lang1, lang2, name, path):
+    """
+    Load a split of a parallel dataset.
+    """
+    logger.info('============ Parallel data (%s - %s) - %s' % (lang1, lang2, name))
+
+    # load data / check dictionaries
+    data1 = load_binarized(path.replace('XX', lang1), params)
+    data2 = load_binarized(path.replace('XX', lang2), params)
+    set_dictionary(params, data, lang1, data1['dico'])
+    set_dictionary(params, data, lang2, data2['dico'])
+
+    # parallel data
+    para_data = ParallelDataset(
+        data1['sentences'], data1['positions'], data['dico'][lang1], params.lang2id[lang1],
+        data2['sentences'], data2['positions'], data['dico'][lang2], params.lang2id[lang2],
+        params
+    )
+
+    # remove too long sentences (train / valid only, test must remain unchanged)
+    if name != 'test':
+        para_data.remove_long_sentences(params.max_len)
+
+    # select a subset of sentences
+    if name == 'train' and params.n_para != -1:
+        para_data.select_data(0, params.n_para)
+    # if name == 'valid':
+    #     para_data.select_data(0, 100)
+    # if name == 'test':
+    #     para_data.select_data(0, 167)
+
+    logger.info('')
+    return para_data
+
+
 def load_para_data(params, data):
     """
-    Load parallel data.
+    Load parallel data (only the dictionaries, splits are loaded on first access).
     """
     assert len(params.para_dataset) > 0
 
     for (lang1, lang2), paths in params.para_dataset.items():
 
         assert lang1 in params.langs and lang2 in params.langs
-        logger.info('============ Parallel data (%s - %s)' % (lang1, lang2))
-
-        datasets = []
 
+        loaders = {}
         for name, path in zip(['train', 'valid', 'test'], paths):
             if path == '':
                 assert name == 'train'
-                datasets.append((name, None))
+                loaders[name] = None
                 continue
             assert name != 'train' or params.n_para != 0
+            loaders[name] = partial(load_para_split, params, data, lang1, lang2, name, path)
 
-            # load data
-            data1 = load_binarized(path.replace('XX', lang1), params)
-            data2 = load_binarized(path.replace('XX', lang2), params)
-            set_parameters(params, data1['dico'])
-            set_parameters(params, data2['dico'])
+        # set dictionaries from the test set, to never load training data at this point
+        set_dictionary(params, data, lang1, load_binarized(paths[2].replace('XX', lang1), params)['dico'])
+        set_dictionary(params, data, lang2, load_binarized(paths[2].replace('XX', lang2), params)['dico'])
 
-            # set / check dictionaries
-            if lang1 not in data['dico']:
-                data['dico'][lang1] = data1['dico']
-            else:
-                assert data['dico'][lang1] == data1['dico']
-            if lang2 not in data['dico']:
-                data['dico'][lang2] = data2['dico']
-            else:
-                assert data['dico'][lang2] == data2['dico']
+        assert (lang1, lang2) not in data['para']
+        data['para'][(lang1, lang2)] = LazySplits(loaders)
 
-            # parallel data
-            para_data = ParallelDataset(
-                data1['sentences'], data1['positions'], data['dico'][lang1], params.lang2id[lang1],
-                data2['sentences'], data2['positions'], data['dico'][lang2], params.lang2id[lang2],
-                params
-            )
 
-            # remove too long sentences (train / valid only, test must remain unchanged)
-            if name != 'test':
-                para_data.remove_long_sentences(params.max_len)
+def load_back_split(params, data, lang1, lang2, src_path, tgt_path):
+    """
+    Load a back-parallel dataset.
+    """
+    logger.info('============ Back-parallel data (%s - %s)' % (lang1, lang2))
 
-            # select a subset of sentences
-            if name == 'train' and params.n_para != -1:
-                para_data.select_data(0, params.n_para)
-            # if name == 'valid':
-            #     para_data.select_data(0, 100)
-            # if name == 'test':
-            #     para_data.select_data(0, 167)
+    # load data / check dictionaries
+    data1 = load_binarized(src_path, params)
+    data2 = load_binarized(tgt_path, params)
+    set_dictionary(params, data, lang1, data1['dico'])
+    set_dictionary(params, data, lang2, data2['dico'])
 
-            datasets.append((name, para_data))
+    # parallel data
+    para_data = ParallelDataset(
+        data1['sentences'], data1['positions'], data['dico'][lang1], params.lang2id[lang1],
+        data2['sentences'], data2['positions'], data['dico'][lang2], params.lang2id[lang2],
+        params
+    )
 
-        assert (lang1, lang2) not in data['para']
-        data['para'][(lang1, lang2)] = {k: v for k, v in datasets}
+    # remove too long sentences
+    para_data.remove_long_sentences(params.max_len)
+
+    # select a subset of sentences
+    if params.n_back != -1:
+        para_data.select_data(0, params.n_back)
 
     logger.info('')
+    return para_data
 
 
 def load_back_data(params, data):
     """
-    Load back-parallel data.
+    Load back-parallel data (train split only, loaded on first access).
     """
     assert not (len(params.back_dataset) == 0) ^ (params.n_back == 0)
 
@@ -208,47 +308,47 @@ def load_back_data(params, data):
         assert os.path.isfile(src_path)
         assert os.path.isfile(tgt_path)
 
-        logger.info('============ Back-parallel data (%s - %s)' % (lang1, lang2))
-
-        # load data
-        data1 = load_binarized(src_path, params)
-        data2 = load_binarized(tgt_path, params)
-        set_parameters(params, data1['dico'])
-        set_parameters(params, data2['dico'])
-
-        # set / check dictionaries
+        # languages without parallel / monolingual data take their dictionary from here
         if lang1 not in data['dico']:
-            data['dico'][lang1] = data1['dico']
-        else:
-            assert data['dico'][lang1] == data1['dico']
+            set_dictionary(params, data, lang1, load_binarized(src_path, params)['dico'])
         if lang2 not in data['dico']:
-            data['dico'][lang2] = data2['dico']
-        else:
-            assert data['dico'][lang2] == data2['dico']
+            set_dictionary(params, data, lang2, load_binarized(tgt_path, params)['dico'])
 
-        # parallel data
-        para_data = ParallelDataset(
-            data1['sentences'], data1['positions'], data['dico'][lang1], params.lang2id[lang1],
-            data2['sentences'], data2['positions'], data['dico'][lang2], params.lang2id[lang2],
-            params
-        )
+        assert (lang1, lang2) not in data['back']
+        data['back'][(lang1, lang2)] = LazySplits({
+            'train': partial(load_back_split, params, data, lang1, lang2, src_path, tgt_path)
+        })
 
-        # remove too long sentences
-        para_data.remove_long_sentences(params.max_len)
 
-        # select a subset of sentences
-        if params.n_back != -1:
-            para_data.select_data(0, params.n_back)
+def load_mono_split(params, data, lang, name, path):
+    """
+    Load a split of a monolingual dataset.
+    """
+    logger.info('============ Monolingual data (%s) - %s' % (lang, name))
 
-        assert (lang1, lang2) not in data['back']
-        data['back'][(lang1, lang2)] = para_data
+    # load data / check dictionary
+    mono_data = load_binarized(path, params)
+    set_dictionary(params, data, lang, mono_data['dico'])
+
+    # monolingual data
+    mono_data = MonolingualDataset(mono_data['sentences'], mono_data['positions'],
+                                   data['dico'][lang], params.lang2id[lang], params)
+
+    # remove too long sentences (train / valid only, test must remain unchanged)
+    if name != 'test':
+        mono_data.remove_long_sentences(params.max_len)
+
+    # select a subset of sentences
+    if name == 'train' and params.n_mono != -1:
+        mono_data.select_data(0, params.n_mono)
 
     logger.info('')
+    return mono_data
 
 
 def load_mono_data(params, data):
     """
-    Load monolingual data.
+    Load monolingual data (only the dictionaries, splits are loaded on first access).
     """
     assert not (len(params.mono_dataset) == 0) ^ (params.n_mono == 0)
     if len(params.mono_dataset) == 0:
@@ -257,51 +357,27 @@ def load_mono_data(params, data):
     for lang, paths in params.mono_dataset.items():
 
         assert lang in params.langs
-        logger.info('============ Monolingual data (%s)' % lang)
-
-        datasets = []
 
+        loaders = {}
         for name, path in zip(['train', 'valid', 'test'], paths):
             if path == '':
                 assert name != 'train'
-                datasets.append((name, None))
+                loaders[name] = None
                 continue
+            loaders[name] = partial(load_mono_split, params, data, lang, name, path)
 
-            # load data
-            mono_data = load_binarized(path, params)
-            set_parameters(params, mono_data['dico'])
-
-            # set / check dictionary
-            if lang not in data['dico']:
-                data['dico'][lang] = mono_data['dico']
-            else:
-                assert data['dico'][lang] == mono_data['dico']
-
-            # monolingual data
-            mono_data = MonolingualDataset(mono_data['sentences'], mono_data['positions'],
-                                           data['dico'][lang], params.lang2id[lang], params)
-
-            # remove too long sentences (train / valid only, test must remain unchanged)
-            if name != 'test':
-                mono_data.remove_long_sentences(params.max_len)
-
-            # select a subset of sentences
-            if name == 'train' and params.n_mono != -1:
-                mono_data.select_data(0, params.n_mono)
-
-            datasets.append((name, mono_data))
+        # set the dictionary from the smallest split available (train is only used as a last resort)
+        path = [path for path in paths if path != ''][-1]
+        set_dictionary(params, data, lang, load_binarized(path, params)['dico'])
 
         assert lang not in data['mono']
-        data['mono'][lang] = {k: v for k, v in datasets}
+        data['mono'][lang] = LazySplits(loaders)
 
-    logger.info('')
 
-
-def check_all_data_params(params):
+def check_lang_params(params):
     """
-    Check datasets parameters.
+    Check languages parameters.
     """
-    # check languages
     params.langs = params.langs.split(',')
     assert len(params.langs) == len(set(params.langs)) >= 2
     assert sorted(params.langs) == params.langs
@@ -309,6 +385,26 @@ def check_all_data_params(params):
     params.lang2id = {k: v for v, k in params.id2lang.items()}
     params.n_langs = len(params.langs)
 
+
+def check_vocab_params(params):
+    """
+    Check vocabulary parameters.
+    """
+    params.vocab = {k: v for k, v in [x.split(':') for x in params.vocab.split(';') if len(x) > 0]}
+    if len(params.vocab) > 0:
+        assert type(params.vocab) is dict
+        assert set(params.vocab.keys()) == set(params.langs)
+        assert all(os.path.isfile(path) for path in params.vocab.values())
+    assert params.vocab_min_count == 0 or params.vocab_min_count >= 0 and len(params.vocab) > 0
+
+
+def check_all_data_params(params):
+    """
+    Check datasets parameters.
+    """
+    # check languages
+    check_lang_params(params)
+
     # check monolingual datasets
     params.mono_dataset = {k: v for k, v in [x.split(':') for x in params.mono_dataset.split(';') if len(x) > 0]}
     assert not (len(params.mono_dataset) == 0) ^ (params.n_mono == 0)
@@ -402,6 +498,9 @@ def check_all_data_params(params):
                 assert params.para_dataset[k][0] != ''
         assert params.otf_backprop_temperature == -1 or params.otf_backprop_temperature > 0
         assert params.otf_update_enc or params.otf_update_dec
+        assert params.otf_sample == -1 or params.otf_sample > 0
+        assert params.otf_sample_topk >= 0 and 0 < params.otf_sample_topp <= 1
+        assert params.otf_n_samples == 1 or params.otf_n_samples > 1 and params.otf_sample > 0
     else:
         assert params.otf_backprop_temperature == -1
 
@@ -441,12 +540,7 @@ def check_all_data_params(params):
     assert not params.n_mono == params.n_para == 0
 
     # check vocabulary parameters
-    params.vocab = {k: v for k, v in [x.split(':') for x in params.vocab.split(';') if len(x) > 0]}
-    if len(params.vocab) > 0:
-        assert type(params.vocab) is dict
-        assert set(params.vocab.keys()) == set(params.langs)
-        assert all(os.path.isfile(path) for path in params.vocab.values())
-    assert params.vocab_min_count == 0 or params.vocab_min_count >= 0 and len(params.vocab) > 0
+    check_vocab_params(params)
 
     # check coefficients
     assert not (params.lambda_dis == "0") ^ (params.n_dis == 0)
@@ -459,6 +553,11 @@ def check_all_data_params(params):
     # max length / max vocab / sentence noise
     assert params.max_len > 0
     assert params.max_vocab == -1 or params.max_vocab > 0
+    assert params.data_cache_size >= 0
+    assert params.max_tokens == -1 or params.max_tokens >= params.max_len + 2
+    assert params.eval_max_tokens == -1 or params.eval_max_tokens > 0
+    assert params.prefetch_batches >= 0
+    assert not params.pin_memory or params.prefetch_batches > 0 and params.device != 'cpu'
     if len(params.mono_directions) == 0:
         assert params.word_shuffle == 0
         assert params.word_dropout == 0
@@ -469,6 +568,50 @@ def check_all_data_params(params):
         assert 0 <= params.word_blank < 1
 
 
+def check_dico_params(params):
+    """
+    Check the parameters of a model used without any dataset.
+    `params.dico_path` is a vocabulary file or a binarized dataset
+    (shared by all languages), or a comma-separated list with one
+    path per language.
+    """
+    check_lang_params(params)
+    params.dico_path = params.dico_path.split(',')
+    if len(params.dico_path) == 1:
+        params.dico_path = params.dico_path * params.n_langs
+    assert len(params.dico_path) == params.n_langs
+    assert all(os.path.isfile(path) for path in params.dico_path)
+    check_vocab_params(params)
+    assert params.max_vocab == -1 or params.max_vocab > 0
+
+
+def load_dictionaries(params):
+    """
+    Load the dictionaries from vocabulary files or binarized datasets,
+    without loading any sentence. Vocabulary files must be the ones
+    used to binarize the training data.
+    """
+    data = {'dico': {}, 'mono': {}, 'para': {}, 'back': {}}
+    for lang, path in zip(params.langs, params.dico_path):
+        if path.endswith('.pth'):
+            logger.info("Loading %s dictionary from %s ..." % (lang, path))
+            dico = torch.load(path)['dico']
+        else:
+            dico = Dictionary.read_vocab(path)
+        if params.max_vocab != -1:
+            dico.prune(params.max_vocab)
+        set_dictionary(params, data, lang, dico)
+
+    # update parameters
+    check_dictionaries(params, data)
+
+    # vocabulary
+    load_vocab(params, data)
+    create_word_masks(params, data)
+    logger.info('')
+    return data
+
+
 def load_data(params, mono_only=False):
     """
     Load parallel / monolingual data.
@@ -480,20 +623,21 @@ def load_data(params, mono_only=False):
         - mono (dictionary of monolingual datasets (train, valid, test))
         - para (dictionary of parallel datasets (train, valid, test))
         - back (dictionary of parallel datasets (train only))
+    Datasets are wrapped in `LazySplits`, and only loaded when they are accessed.
     """
     data = {'dico': {}, 'mono': {}, 'para': {}, 'back': {}}
 
+    # parallel datasets
     if not mono_only:
-
-        # parallel datasets
         load_para_data(params, data)
 
-        # back-parallel datasets
-        load_back_data(params, data)
-
     # monolingual datasets
     load_mono_data(params, data)
 
+    # back-parallel datasets
+    if not mono_only:
+        load_back_data(params, data)
+
     # update parameters
     check_dictionaries(params, data)
 
@@ -501,20 +645,25 @@ def load_data(params, mono_only=False):
     load_vocab(params, data)
     create_word_masks(params, data)
 
-    # data summary
+    # data summary (datasets are loaded on first access)
+    def size(splits, data_type):
+        if splits.loaders[data_type] is None:
+            return 0
+        return len(splits[data_type]) if splits.is_loaded(data_type) else 'not loaded'
+
     logger.info('============ Data summary')
     for (lang1, lang2), v in data['para'].items():
         for data_type in ['train', 'valid', 'test']:
-            if v[data_type] is None:
+            if v.loaders[data_type] is None:
                 continue
-            logger.info('{: <18} - {: >5} - {: >4} -> {: >4}:{: >10}'.format('Parallel data', data_type, lang1, lang2, len(v[data_type])))
+            logger.info('{: <18} - {: >5} - {: >4} -> {: >4}:{: >10}'.format('Parallel data', data_type, lang1, lang2, size(v, data_type)))
 
     for (lang1, lang2), v in data['back'].items():
-        logger.info('{: <18} - {: >5} - {: >4} -> {: >4}:{: >10}'.format('Back-parallel data', 'train', lang1, lang2, len(v)))
+        logger.info('{: <18} - {: >5} - {: >4} -> {: >4}:{: >10}'.format('Back-parallel data', 'train', lang1, lang2, size(v, 'train')))
 
     for lang, v in data['mono'].items():
         for data_type in ['train', 'valid', 'test']:
-            logger.info('{: <18} - {: >5} - {: >12}:{: >10}'.format('Monolingual data', data_type, lang, len(v[data_type]) if v[data_type] is not None else 0))
+            logger.info('{: <18} - {: >5} - {: >12}:{: >10}'.format('Monolingual data', data_type, lang, size(v, data_type)))
 
     if hasattr(params, 'vocab') and len(params.vocab) > 0:
         for lang in params.langs:
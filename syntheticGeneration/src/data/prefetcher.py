@@ -0,0 +1,83 @@
+from logging import getLogger
+import threading
+import queue
+import torch
+
+
+logger = getLogger()
+
+
+def pin_batch(batch):
+    """
+    Copy the tensors of a batch to pinned memory.
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(pin_batch(x) for x in batch)
+    return batch
+
+
+class BatchPrefetcher(object):
+    """
+    Prepare the next batches of an iterator in a background thread.
+    `get_iterator` is called once, in the background thread. Training
+    iterators go over their dataset indefinitely, so the prefetcher
+    only stops when it is closed.
+    """
+
+    def __init__(self, get_iterator, n_batches, pin_memory=False):
+        assert n_batches > 0
+        self.get_iterator = get_iterator
+        self.pin_memory = pin_memory
+        self.queue = queue.Queue(maxsize=n_batches)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        """
+        Add an item to the queue. Return False if the prefetcher was closed.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self):
+        """
+        Fill the queue with batches. Exceptions are forwarded to the main thread.
+        """
+        try:
+            for batch in self.get_iterator():
+                if self.pin_memory:
+                    batch = pin_batch(batch)
+                if not self._put((batch, None)):
+                    return
+            self._put((None, StopIteration()))
+        except Exception as e:
+            self._put((None, e))
+
+    def close(self):
+        """
+        Stop the background thread, and release the prefetched batches.
+        """
+        self.stop_event.set()
+        self.thread.join()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch, error = self.queue.get()
+        if error is not None:
+            raise error
+        return batch
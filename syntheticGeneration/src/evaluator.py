@@ -1,4 +1,5 @@
 import os
+import hashlib
 import subprocess
 from collections import OrderedDict
 from logging import getLogger
@@ -7,6 +8,7 @@ import torch
 from torch import nn
 
 from .utils import restore_segmentation
+from .data.loader import release_data
 
 
 logger = getLogger()
@@ -53,6 +55,7 @@ class EvaluatorMT(object):
         else:
             i = None
         dataset.batch_size = 32
+        dataset.max_tokens = self.params.eval_max_tokens
         for batch in dataset.get_iterator(shuffle=False, group_by_size=True)():
             yield batch if i is None else batch[i]
 
@@ -68,15 +71,20 @@ class EvaluatorMT(object):
             k = (lang1, lang2) if lang1 < lang2 else (lang2, lang1)
             dataset = self.data['para'][k][data_type]
             dataset.batch_size = 32
+            dataset.max_tokens = self.params.eval_max_tokens
             for batch in dataset.get_iterator(shuffle=False, group_by_size=True)():
                 yield batch if lang1 < lang2 else batch[::-1]
 
     def create_reference_files(self):
         """
         Create reference files for BLEU evaluation.
+        Reference files are stored next to the experiment directories, and are
+        keyed on a hash of the evaluation data, so they are only created once.
         """
         params = self.params
         params.ref_paths = {}
+        ref_cache_path = os.path.join(os.path.dirname(os.path.normpath(params.dump_path)), 'references')
+        os.makedirs(ref_cache_path, exist_ok=True)
 
         for (lang1, lang2), v in self.data['para'].items():
 
@@ -86,8 +94,17 @@ class EvaluatorMT(object):
 
             for data_type in ['valid', 'test']:
 
-                lang1_path = os.path.join(params.dump_path, 'ref.{0}-{1}.{2}.txt'.format(lang2, lang1, data_type))
-                lang2_path = os.path.join(params.dump_path, 'ref.{0}-{1}.{2}.txt'.format(lang1, lang2, data_type))
+                data_hash = get_data_hash(v[data_type], params)
+                lang1_path = os.path.join(ref_cache_path, 'ref.{0}-{1}.{2}.{3}.txt'.format(lang2, lang1, data_type, data_hash))
+                lang2_path = os.path.join(ref_cache_path, 'ref.{0}-{1}.{2}.{3}.txt'.format(lang1, lang2, data_type, data_hash))
+
+                # store data paths
+                params.ref_paths[(lang2, lang1, data_type)] = lang1_path
+                params.ref_paths[(lang1, lang2, data_type)] = lang2_path
+
+                if os.path.isfile(lang1_path) and os.path.isfile(lang2_path):
+                    logger.info("Reusing reference files %s and %s" % (lang1_path, lang2_path))
+                    continue
 
                 lang1_txt = []
                 lang2_txt = []
@@ -101,19 +118,17 @@ class EvaluatorMT(object):
                 lang1_txt = [x.replace('<unk>', '<<unk>>') for x in lang1_txt]
                 lang2_txt = [x.replace('<unk>', '<<unk>>') for x in lang2_txt]
 
-                # export hypothesis
-                with open(lang1_path, 'w', encoding='utf-8') as f:
-                    f.write('\n'.join(lang1_txt) + '\n')
-                with open(lang2_path, 'w', encoding='utf-8') as f:
-                    f.write('\n'.join(lang2_txt) + '\n')
+                # export references / restore original segmentation
+                # (files are written under a temporary name, in case several jobs share the cache)
+                for path, txt in [(lang1_path, lang1_txt), (lang2_path, lang2_txt)]:
+                    tmp_path = '%s.%i.tmp' % (path, os.getpid())
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        f.write('\n'.join(txt) + '\n')
+                    restore_segmentation(tmp_path)
+                    os.replace(tmp_path, path)
 
-                # restore original segmentation
-                restore_segmentation(lang1_path)
-                restore_segmentation(lang2_path)
-
-                # store data paths
-                params.ref_paths[(lang2, lang1, data_type)] = lang1_path
-                params.ref_paths[(lang1, lang2, data_type)] = lang2_path
+        # evaluation splits are only needed again at the end of the epoch
+        release_data(self.data, ['valid', 'test'])
 
     def eval_para(self, lang1, lang2, data_type, scores):
         """
@@ -140,7 +155,7 @@ class EvaluatorMT(object):
 
             # batch
             (sent1, len1), (sent2, len2) = batch
-            sent1, sent2 = sent1.cuda(), sent2.cuda()
+            sent1, sent2 = sent1.to(self.params.device), sent2.to(self.params.device)
 
             # encode / decode / generate
             encoded = self.encoder(sent1, len1, lang1_id)
@@ -198,14 +213,14 @@ class EvaluatorMT(object):
 
             # batch
             (sent1, len1), (sent3, len3) = batch
-            sent1, sent3 = sent1.cuda(), sent3.cuda()
+            sent1, sent3 = sent1.to(self.params.device), sent3.to(self.params.device)
 
             # encode / generate lang1 -> lang2
             encoded = self.encoder(sent1, len1, lang1_id)
             sent2_, len2_, _ = self.decoder.generate(encoded, lang2_id)
 
             # encode / decode / generate lang2 -> lang3
-            encoded = self.encoder(sent2_.cuda(), len2_, lang2_id)
+            encoded = self.encoder(sent2_.to(self.params.device), len2_, lang2_id)
             decoded = self.decoder(encoded, sent3[:-1], lang3_id)
             sent3_, len3_, _ = self.decoder.generate(encoded, lang3_id)
 
@@ -257,6 +272,9 @@ class EvaluatorMT(object):
                 for data_type in ['valid', 'test']:
                     self.eval_back(lang1, lang2, lang3, data_type, scores)
 
+        # evaluation splits are only needed again at the end of the next epoch
+        release_data(self.data, ['valid', 'test'])
+
         return scores
 
 
@@ -276,6 +294,19 @@ def eval_moses_bleu(ref, hyp):
         return -1
 
 
+def get_data_hash(dataset, params):
+    """
+    Hash the sentences of a parallel dataset (and the dictionaries used to convert them to text).
+    """
+    h = hashlib.sha1()
+    for sent, pos, dico in [(dataset.sent1, dataset.pos1, dataset.dico1), (dataset.sent2, dataset.pos2, dataset.dico2)]:
+        h.update(np.ascontiguousarray(pos).tobytes())
+        h.update(np.ascontiguousarray(sent).tobytes())
+        h.update('\n'.join(dico.get_words()).encode('utf-8'))
+    h.update(str(params.max_vocab).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
 def convert_to_text(batch, lengths, dico, lang_id, params):
     """
     Convert a batch of sentences to a list of text sentences.
@@ -288,13 +319,12 @@ def convert_to_text(batch, lengths, dico, lang_id, params):
     assert lengths.max() == slen and lengths.shape[0] == bs
     assert (batch[0] == bos_index).sum() == bs
     assert (batch == params.eos_index).sum() == bs
-    sentences = []
-
-    for j in range(bs):
-        words = []
-        for k in range(1, lengths[j]):
-            if batch[k, j] == params.eos_index:
-                break
-            words.append(dico[batch[k, j]])
-        sentences.append(" ".join(words))
-    return sentences
+
+    # words are only kept up to the first EOS (or the sentence length)
+    is_eos = batch == params.eos_index
+    ends = np.where(is_eos.any(0), is_eos.argmax(0), slen)
+    ends = np.minimum(ends, lengths)
+    mask = np.arange(1, slen)[:, None] < ends[None, :]
+    words = dico.get_words()[batch[1:].T[mask.T]]
+    offsets = np.cumsum(ends - 1)[:-1]
+    return [" ".join(sentence) for sentence in np.split(words, offsets)]
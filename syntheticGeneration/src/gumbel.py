@@ -2,11 +2,11 @@ import torch
 from torch import nn
 
 
-def sample_gumbel(shape, eps=1e-20):
+def sample_gumbel(shape, device=None, eps=1e-20):
     """
     Sample from Gumbel(0, 1).
     """
-    u = torch.cuda.FloatTensor(*shape).uniform_()
+    u = torch.rand(*shape, device=device)
     return -torch.log(-torch.log(u + eps) + eps)
 
 
@@ -14,7 +14,7 @@ def gumbel_softmax_sample(log_probs, temperature):
     """
     Draw a sample from the Gumbel-Softmax distribution.
     """
-    y = log_probs + sample_gumbel(log_probs.size())
+    y = log_probs + sample_gumbel(log_probs.size(), log_probs.device)
     return nn.Softmax()(y / temperature)
 
 
@@ -32,7 +32,7 @@ def gumbel_softmax(log_probs, temperature, hard=False):
     """
     y = gumbel_softmax_sample(log_probs, temperature)
     if hard:
-        y_hard = torch.cuda.FloatTensor(y.size()).zero_()
+        y_hard = torch.zeros_like(y)
         y_hard.scatter_(1, y.max(1)[1].data, 1)
         y = (y_hard - y).detach() + y
     return y
@@ -0,0 +1,187 @@
+from collections import deque
+from itertools import islice
+from logging import getLogger
+import time
+import numpy as np
+import torch
+
+from .utils import get_flat_params, set_flat_params
+from .model import build_mt_model
+from .data.dataset import Dataset
+from .multiprocessing_event_loop import MultiprocessingEventLoop, Future
+
+
+logger = getLogger()
+
+
+def get_inference_batches(lengths, params):
+    """
+    Sort sentences by length, and split them into batches of at most
+    `params.max_tokens` padded tokens (or `params.batch_size` sentences).
+    Batches are returned longest first, so that memory issues show up immediately.
+    """
+    lengths = np.asarray(lengths)
+    indices = np.argsort(-lengths, kind='mergesort')
+    return Dataset(params).split_batches(indices, lengths)
+
+
+def generate(encoder, decoder, x, lengths, lang1_id, lang2_id, params):
+    """
+    Translate a batch of sentences, with greedy decoding or beam search.
+    With `params.nbest` > 1, the best hypotheses of each sentence are returned consecutively.
+    """
+    encoded = encoder(x, lengths, lang1_id)
+    max_len = int(1.5 * lengths.max() + 10)
+    if params.nbest > 1:
+        sent, sent_len, _ = decoder.generate_beam(encoded, lang2_id, beam_size=params.beam_size,
+                                                  max_len=max_len, nbest=params.nbest)
+    elif params.beam_size > 0 and not getattr(params, 'transformer', False):
+        # the transformer decoder already runs a beam search in `generate`
+        sent, sent_len, _ = decoder.generate_beam(encoded, lang2_id, beam_size=params.beam_size, max_len=max_len)
+    else:
+        sent, sent_len, _ = decoder.generate(encoded, lang2_id, max_len=max_len)
+    return sent, sent_len
+
+
+def translate(encoder, decoder, sentences, lang1_id, lang2_id, params):
+    """
+    Translate a list of sentences (arrays of word indices, without BOS / EOS).
+    Sentences are decoded in length-sorted token-budget batches, and the
+    translations (arrays of word indices, without BOS / EOS) are returned
+    in the input order. Empty sentences are translated to empty sentences.
+    With `params.nbest` > 1, each translation is a list of the `nbest` best
+    hypotheses of the sentence, best first.
+    """
+    nbest = params.nbest
+    device = next(encoder.parameters()).device
+    encoder.eval()
+    decoder.eval()
+
+    # flat sentences array / positions, in the format used by datasets
+    lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+    ends = np.cumsum(lengths + 1) - 1
+    pos = np.stack([ends - lengths, ends], 1)
+    sent = np.concatenate([np.append(s, -1) for s in sentences]).astype(np.int64)
+
+    dataset = Dataset(params)
+    non_empty = np.nonzero(lengths > 0)[0]
+    empty = np.zeros(0, dtype=np.int64)
+    translations = [empty if nbest == 1 else [empty] * nbest] * len(sentences)
+    if len(non_empty) == 0:
+        return translations
+    with torch.no_grad():
+        for batch_ids in get_inference_batches(lengths[non_empty], params):
+            sentence_ids = non_empty[batch_ids]
+            x, x_len = dataset.batch_sentences(sent, pos[sentence_ids], lang1_id)
+            x = x.to(device)
+            y, y_len = generate(encoder, decoder, x, x_len, lang1_id, lang2_id, params)
+            y = y.cpu().numpy()
+            for j, i in enumerate(sentence_ids):
+                if nbest == 1:
+                    translations[i] = y[1:y_len[j] - 1, j]
+                else:
+                    translations[i] = [y[1:y_len[k] - 1, k] for k in range(j * nbest, (j + 1) * nbest)]
+    return translations
+
+
+class InferencePool(MultiprocessingEventLoop):
+    """
+    Translate a corpus with CPU replicas of an encoder / decoder, one per
+    worker process. The input is split into shards that are assigned to the
+    workers in a round-robin fashion, and translations are returned in order.
+    """
+
+    def __init__(self, encoder, decoder, params, n_workers, n_threads=1):
+        """
+        Start `n_workers` processes running `n_threads` threads each,
+        and copy the encoder / decoder parameters to the workers.
+        """
+        assert n_workers > 0 and n_threads > 0
+        super().__init__(device_ids=tuple(range(n_workers)))
+        self.params = params
+        self.stats = [{'shards': 0, 'sentences': 0, 'words': 0, 'time': 0.} for _ in range(n_workers)]
+
+        # build the models in the workers, and wait for them to be ready
+        logger.info("Starting %i inference workers (%i threads each) ..." % (n_workers, n_threads))
+        futures = [self.call_async(rank, '_async_init', params=params, n_threads=n_threads)
+                   for rank in range(n_workers)]
+        Future.gen_list(futures)
+        self.sync_params(encoder, decoder)
+
+    def _async_init(self, rank, device_id, params, n_threads):
+        """
+        Build the model in a worker process.
+        """
+        from copy import deepcopy
+        torch.set_num_threads(n_threads)
+        self.params = deepcopy(params)
+        self.params.cpu_thread = True
+        self.params.device = 'cpu'
+        self.encoder, self.decoder, _, _ = build_mt_model(self.params, None, device='cpu')
+
+    def sync_params(self, encoder, decoder):
+        """
+        Copy the encoder / decoder parameters to the workers.
+        """
+        encoder_params = get_flat_params(encoder).cpu().share_memory_()
+        decoder_params = get_flat_params(decoder).cpu().share_memory_()
+        Future.gen_list([self.call_async(rank, '_async_sync_params', encoder_params=encoder_params,
+                                         decoder_params=decoder_params)
+                         for rank in range(self.num_replicas)])
+
+    def _async_sync_params(self, rank, device_id, encoder_params, decoder_params):
+        set_flat_params(self.encoder, encoder_params)
+        set_flat_params(self.decoder, decoder_params)
+
+    def _async_translate(self, rank, device_id, sentences, lang1_id, lang2_id):
+        """
+        Translate a shard of sentences in a worker process.
+        """
+        start = time.time()
+        translations = translate(self.encoder, self.decoder, sentences, lang1_id, lang2_id, self.params)
+        return translations, time.time() - start
+
+    def translate(self, sentences, lang1_id, lang2_id, shard_size):
+        """
+        Translate an iterable of sentences (arrays of word indices, without BOS / EOS).
+        The input is consumed lazily, and each worker has at most 2 shards in flight
+        (one being translated, one waiting) so that workers never wait for input.
+        Return a generator over the translations, in the input order.
+        """
+        assert shard_size > 0
+        sentences = iter(sentences)
+        pending = deque()
+        next_rank = 0
+        while True:
+            # fill the workers queues
+            while len(pending) < 2 * self.num_replicas:
+                shard = list(islice(sentences, shard_size))
+                if len(shard) == 0:
+                    break
+                future = self.call_async(next_rank, '_async_translate', sentences=shard,
+                                         lang1_id=lang1_id, lang2_id=lang2_id)
+                pending.append((next_rank, shard, future))
+                next_rank = (next_rank + 1) % self.num_replicas
+            if len(pending) == 0:
+                return
+
+            # wait for the oldest shard
+            rank, shard, future = pending.popleft()
+            translations, elapsed = future.gen()
+            stats = self.stats[rank]
+            stats['shards'] += 1
+            stats['sentences'] += len(shard)
+            stats['words'] += sum(len(s) for s in shard)
+            stats['time'] += elapsed
+            for translation in translations:
+                yield translation
+
+    def log_stats(self):
+        """
+        Log the throughput of each worker (source words / sentences per second of translation).
+        """
+        for rank, stats in enumerate(self.stats):
+            elapsed = max(stats['time'], 1e-6)
+            logger.info("Worker %i - %i shards - %i sentences (%.2f sent/s) - %i words (%.2f words/s)"
+                        % (rank, stats['shards'], stats['sentences'], stats['sentences'] / elapsed,
+                           stats['words'], stats['words'] / elapsed))
@@ -1,5 +1,6 @@
 import os
 from collections import namedtuple
+import torch
 
 
 LSTM_PARAMS = ['weight_ih_l%i', 'weight_hh_l%i', 'bias_ih_l%i', 'bias_hh_l%i']
@@ -8,6 +9,44 @@ BILSTM_PARAMS = LSTM_PARAMS + ['%s_reverse' % x for x in LSTM_PARAMS]
 LatentState = namedtuple('LatentState', 'dec_input, dis_input, input_len')
 
 
+def _pad_cat(tensors, dim, length_dim, value):
+    """
+    Pad tensors to the same size along `length_dim`, and concatenate them along `dim`.
+    """
+    length = max(x.size(length_dim) for x in tensors)
+    padded = []
+    for x in tensors:
+        if x.size(length_dim) < length:
+            size = list(x.size())
+            size[length_dim] = length - x.size(length_dim)
+            x = torch.cat([x, x.new_full(size, value)], length_dim)
+        padded.append(x)
+    return torch.cat(padded, dim)
+
+
+def concat_latent_states(states):
+    """
+    Concatenate encoded states along the batch dimension, so that
+    they can be decoded in a single decoder forward pass.
+    The discriminator input is not concatenated.
+    """
+    dec_inputs = [state.dec_input for state in states]
+    if type(dec_inputs[0]) is dict:
+        # transformer: (slen, bs, dim) outputs and (bs, slen) padding masks
+        dec_input = {
+            'encoder_out': _pad_cat([x['encoder_out'] for x in dec_inputs], 1, 0, 0),
+            'encoder_padding_mask': _pad_cat([x['encoder_padding_mask'] for x in dec_inputs], 0, 1, 1),
+        }
+    elif dec_inputs[0].dim() == 3:
+        # attention: (slen, bs, dim) outputs
+        dec_input = _pad_cat(dec_inputs, 1, 0, 0)
+    else:
+        # seq2seq: (bs, dim) latent states
+        dec_input = torch.cat(dec_inputs, 0)
+    input_len = torch.cat([state.input_len for state in states], 0)
+    return LatentState(dec_input=dec_input, dis_input=None, input_len=input_len)
+
+
 def check_mt_model_params(params):
     """
     Check models parameters.
@@ -82,13 +121,13 @@ def check_mt_model_params(params):
     assert not (params.reload_model != '') ^ (params.reload_enc or params.reload_dec or params.reload_dis)
 
 
-def build_mt_model(params, data, cuda=True):
+def build_mt_model(params, data, device=None):
     """
-    Build machine translation model.
+    Build machine translation model, on `device` (`params.device` by default).
     """
     if params.attention:
         from .attention import build_attention_model
-        return build_attention_model(params, data, cuda=cuda)
+        return build_attention_model(params, data, device=device)
     else:
         from .seq2seq import build_seq2seq_model
-        return build_seq2seq_model(params, data, cuda=cuda)
+        return build_seq2seq_model(params, data, device=device)
@@ -12,6 +12,7 @@ from .lm import LM
 from ..modules.label_smoothed_cross_entropy import LabelSmoothedCrossEntropyLoss
 from .pretrain_embeddings import initialize_embeddings
 from ..utils import get_mask, reload_model
+from ..sampling import sample_words, expand_encoded
 # from ..gumbel import gumbel_softmax
 
 
@@ -94,7 +95,7 @@ class Encoder(nn.Module):
               representing the encoded state of each sentence
         """
         assert type(lang_id) is int
-        is_cuda = x.is_cuda
+        device = x.device
         sort_len = lengths.type_as(x.data).sort(0, descending=True)[1]
         sort_len_rev = sort_len.sort()[1]
         emb_layer = self.embeddings[lang_id]
@@ -131,7 +132,7 @@ class Encoder(nn.Module):
         # discriminator input
         dis_input = lstm_output.data
         if self.dis_input_proj:
-            mask = get_mask(lengths, all_words=True, expand=self.emb_dim, batch_first=False, cuda=is_cuda)
+            mask = get_mask(lengths, all_words=True, expand=self.emb_dim, batch_first=False, device=device)
             dis_input = padded_output.masked_select(mask).view(lengths.sum(), self.emb_dim)
 
         return LatentState(input_len=lengths, dec_input=padded_output, dis_input=dis_input)
@@ -164,6 +165,7 @@ class Decoder(nn.Module):
         self.n_dec_layers = params.n_dec_layers
         self.input_feeding = params.input_feeding
         self.freeze_dec_emb = params.freeze_dec_emb
+        self.prune_finished = params.prune_finished
         assert not self.share_lang_emb or len(set(params.n_words)) == 1
         assert not self.share_decpro_emb or self.lstm_proj or self.emb_dim == self.hidden_dim
         assert 0 <= self.share_dec <= self.n_dec_layers
@@ -332,7 +334,7 @@ class Decoder(nn.Module):
         """
         latent = encoded.dec_input
         x_len = encoded.input_len
-        is_cuda = latent.is_cuda
+        device = latent.device
 
         # check inputs
         assert type(lang_id) is int
@@ -359,7 +361,7 @@ class Decoder(nn.Module):
         embeddings = F.dropout(embeddings, p=self.dropout, training=self.training)
 
         if self.input_feeding:
-            mask = get_mask(x_len, True, cuda=is_cuda) == 0  # attention mask
+            mask = get_mask(x_len, True, device=device) == 0  # attention mask
             h_c = None
             hidden_states = [latent.data.new(1, bs, self.hidden_dim).zero_()]
             attention_states = []
@@ -392,7 +394,7 @@ class Decoder(nn.Module):
             assert lstm_output.size() == (y_len, bs, self.hidden_dim)
 
             # attention layer
-            mask = get_mask(x_len, True, expand=int(y_len), batch_first=True, cuda=is_cuda).transpose(1, 2) == 0
+            mask = get_mask(x_len, True, expand=int(y_len), batch_first=True, device=device).transpose(1, 2) == 0
             att_input = torch.cat([latent.data.new(1, bs, self.hidden_dim).zero_(), lstm_output[:-1]], 0)
             attention = self.get_full_attention(latent, att_input, embeddings, mask, lang_id)
             assert attention.size() == (y_len, bs, self.emb_dim)
@@ -410,19 +412,24 @@ class Decoder(nn.Module):
         scores = proj_layer(output)
         return scores.view(y_len, bs, n_words)
 
-    def generate(self, encoded, lang_id, max_len=200, sample=False, temperature=None):
+    def generate(self, encoded, lang_id, max_len=200, sample=False, temperature=None,
+                 top_k=0, top_p=1., n_samples=1):
         """
         Generate a sentence from a given initial state.
         Input:
             - FloatTensor of size (batch_size, hidden_dim) representing
               sentences encoded in the latent space
         Output:
-            - LongTensor of size (seq_len, batch_size), word indices
-            - LongTensor of size (batch_size,), sentence x_len
+            - LongTensor of size (seq_len, batch_size * n_samples), word indices
+            - LongTensor of size (batch_size * n_samples,), sentence x_len
+        If `prune_finished` is set, finished sentences are removed from the batch.
+        When sampling, `n_samples` outputs are generated for each sentence.
         """
+        if n_samples > 1:
+            encoded = expand_encoded(encoded, n_samples)
         latent = encoded.dec_input
         x_len = encoded.input_len
-        is_cuda = latent.is_cuda
+        device = latent.device
         one_hot = None  # [] if temperature is not None else None
 
         # check inputs
@@ -443,13 +450,26 @@ class Decoder(nn.Module):
         assert x_len.max() == slen and x_len.size(0) == bs
         cur_len = 1
         decoded = torch.LongTensor(max_len, bs).fill_(self.pad_index)
-        decoded = decoded.cuda() if is_cuda else decoded
+        unfinished_sents = torch.LongTensor(bs).fill_(1)
+        lengths = torch.LongTensor(bs).fill_(1)
+        decoded = decoded.to(device)
+        unfinished_sents = unfinished_sents.to(device)
+        lengths = lengths.to(device)
         decoded[0] = self.bos_index[lang_id]
 
-        # compute attention
-        mask = get_mask(x_len, True, cuda=is_cuda) == 0
+        # compute attention (only the last hidden state of the first LSTM is required)
+        mask = get_mask(x_len, True, device=device) == 0
         h_c_1, h_c_2 = None, None
-        hidden_states = [latent.data.new(1, bs, self.hidden_dim).zero_()]
+        last_hidden = latent.data.new(bs, self.hidden_dim).zero_()
+
+        # sentences still in the batch, and final outputs
+        n_sents = bs
+        prune_finished = getattr(self, 'prune_finished', False)  # not set in older models
+        if prune_finished:
+            sent_ids = torch.arange(bs).long()
+            sent_ids = sent_ids.to(device)
+            final_decoded = decoded.clone()
+            final_lengths = lengths.clone()
 
         while cur_len < max_len:
             # previous word embeddings
@@ -457,15 +477,15 @@ class Decoder(nn.Module):
             embeddings = F.dropout(embeddings, p=self.dropout, training=self.training)
 
             # attention layer
-            attention = self.get_attention(latent, hidden_states[-1][0], embeddings, mask, lang_id)
+            attention = self.get_attention(latent, last_hidden, embeddings, mask, lang_id)
 
             # lstm step
             lstm_input = embeddings.unsqueeze(0)
             if self.input_feeding:
                 lstm_input = torch.cat([lstm_input, attention], 2)
             lstm_output, h_c_1 = lstm_layer1(lstm_input, h_c_1)
-            assert lstm_output.size() == (1, bs, self.hidden_dim)
-            hidden_states.append(lstm_output)
+            assert lstm_output.size() == (1, n_sents, self.hidden_dim)
+            last_hidden = lstm_output[0]
 
             # lstm (layers > 1)
             if self.n_dec_layers > 1:
@@ -473,13 +493,13 @@ class Decoder(nn.Module):
                 if not self.input_feeding:
                     lstm_output = torch.cat([lstm_output, attention], 2)
                 lstm_output, h_c_2 = lstm_layer2(lstm_output, h_c_2)
-                assert lstm_output.size() == (1, bs, self.hidden_dim)
+                assert lstm_output.size() == (1, n_sents, self.hidden_dim)
 
             # word scores
             output = F.dropout(lstm_output, p=self.dropout, training=self.training).view(-1, self.hidden_dim)
             if lstm_proj_layer is not None:
                 output = F.relu(lstm_proj_layer(output))
-            scores = proj_layer(output).view(bs, n_words)
+            scores = proj_layer(output).view(n_sents, n_words)
             scores = scores.data
 
             # do no sample words not in the language vocabulary
@@ -493,29 +513,46 @@ class Decoder(nn.Module):
                 #     next_words = gumbel.max(1)[1]
                 #     one_hot.append(gumbel)
                 # else:
-                next_words = torch.multinomial((scores / temperature).exp(), 1).squeeze(1)
+                next_words = sample_words(scores, 1, temperature, top_k, top_p).squeeze(1)
             else:
                 next_words = torch.topk(scores, 1)[1].squeeze(1)
-            assert next_words.size() == (bs,)
-            decoded[cur_len] = next_words
+            assert next_words.size() == (n_sents,)
+            decoded[cur_len] = next_words * unfinished_sents + self.pad_index * (1 - unfinished_sents)
+            lengths.add_(unfinished_sents)
+            unfinished_sents.mul_(next_words.ne(self.eos_index).long())
             cur_len += 1
 
             # stop when there is a </s> in each sentence
-            if decoded.eq(self.eos_index).sum(0).ne(0).sum() == bs:
+            if unfinished_sents.max() == 0:
                 break
 
-        # compute the length of each generated sentence, and
-        # put some padding after the end of each sentence
-        lengths = torch.LongTensor(bs).fill_(cur_len)
-        for i in range(bs):
-            for j in range(cur_len):
-                if decoded[j, i] == self.eos_index:
-                    if j + 1 < max_len:
-                        decoded[j + 1:, i] = self.pad_index
-                    lengths[i] = j + 1
-                    break
-            if lengths[i] == max_len:
-                decoded[-1, i] = self.eos_index
+            # remove finished sentences from the batch, and store their translations
+            if prune_finished and unfinished_sents.min() == 0:
+                finished = unfinished_sents.eq(0).nonzero().view(-1)
+                keep = unfinished_sents.nonzero().view(-1)
+                final_decoded.index_copy_(1, sent_ids[finished], decoded.index_select(1, finished))
+                final_lengths.index_copy_(0, sent_ids[finished], lengths[finished])
+                n_sents = keep.size(0)
+                sent_ids = sent_ids[keep]
+                decoded = decoded.index_select(1, keep)
+                lengths = lengths[keep]
+                unfinished_sents = unfinished_sents[keep]
+                latent = latent.index_select(1, keep)
+                mask = mask.index_select(1, keep)
+                last_hidden = last_hidden.index_select(0, keep)
+                h_c_1 = tuple(x.index_select(1, keep) for x in h_c_1)
+                if h_c_2 is not None:
+                    h_c_2 = tuple(x.index_select(1, keep) for x in h_c_2)
+
+        # add </s> to unfinished sentences
+        if cur_len == max_len:
+            decoded[max_len - 1].masked_fill_(unfinished_sents.ne(0), self.eos_index)
+
+        # scatter the remaining sentences back to their original positions
+        if prune_finished:
+            final_decoded.index_copy_(1, sent_ids, decoded)
+            final_lengths.index_copy_(0, sent_ids, lengths)
+            decoded, lengths = final_decoded, final_lengths
 
         if one_hot is not None:
             one_hot = torch.cat([x.unsqueeze(0) for x in one_hot], 0)
@@ -534,7 +571,7 @@ class Decoder(nn.Module):
         """
         latent = encoded.dec_input
         x_len = encoded.input_len
-        is_cuda = latent.is_cuda
+        device = latent.device
         one_hot = [] if temperature is not None else None
 
         # check inputs
@@ -554,24 +591,34 @@ class Decoder(nn.Module):
         slen, bs = latent.size(0), latent.size(1)
         assert x_len.max() == slen and x_len.size(0) == bs
         cur_len = 1
-        decoded = torch.LongTensor(max_len, bs * beam_size).fill_(self.pad_index)
-        decoded = decoded.cuda() if is_cuda else decoded
+        n_beams = bs * beam_size
+        decoded = torch.LongTensor(max_len, n_beams).fill_(self.pad_index)
+        decoded = decoded.to(device)
         decoded[0] = self.bos_index[lang_id]
 
         # expand tensors for beam search
-        expanded_latent = latent.unsqueeze(2).expand(slen, bs, beam_size, self.emb_dim).contiguous().view(slen, bs * beam_size, self.emb_dim)
+        expanded_latent = latent.unsqueeze(2).expand(slen, bs, beam_size, self.emb_dim).contiguous().view(slen, n_beams, self.emb_dim)
         expanded_x_len = x_len.unsqueeze(1).expand(x_len.size(0), beam_size).contiguous().view(-1)
 
-        # currently finished sentences / current scores in all beams
-        current_hyps = [[] for _ in range(bs)]
-        # current_hyp_scores = torch.FloatTensor(bs * beam_size).zero_().cuda()
-        # at first step, only look at the first beam
-        current_hyp_scores = latent.data.new(sum([[0] + ([-np.inf] * (beam_size - 1)) for _ in range(bs)], []))
+        # current scores in all beams (at first step, only look at the first beam)
+        beam_scores = latent.data.new(bs, beam_size).fill_(-np.inf)
+        beam_scores[:, 0] = 0
+        beam_scores = beam_scores.view(-1)
+
+        # finished hypotheses: number of hypotheses / best hypothesis of each sentence
+        n_hyps = decoded.new(bs).zero_()
+        best_norm_scores = latent.data.new(bs).fill_(-np.inf)
+        best_lengths = decoded.new(bs).zero_()
+        best_hyps = decoded.new(max_len, bs).fill_(self.pad_index)
+
+        # candidates ranks / offset of the first beam of each sentence
+        ranks = torch.arange(2 * beam_size, device=decoded.device)
+        offsets = torch.arange(bs, device=decoded.device) * beam_size
 
         # compute attention
-        expanded_mask = get_mask(expanded_x_len, True, cuda=is_cuda) == 0
+        expanded_mask = get_mask(expanded_x_len, True, device=device) == 0
         h_c_1, h_c_2 = None, None
-        hidden_states = [latent.data.new(1, bs * beam_size, self.hidden_dim).zero_()]
+        hidden_state = latent.data.new(n_beams, self.hidden_dim).zero_()
 
         while cur_len < max_len:
             # previous word embeddings
@@ -579,15 +626,14 @@ class Decoder(nn.Module):
             embeddings = F.dropout(embeddings, p=self.dropout, training=self.training)
 
             # attention layer
-            attention = self.get_attention(expanded_latent, hidden_states[-1][0], embeddings, expanded_mask, lang_id)
+            attention = self.get_attention(expanded_latent, hidden_state, embeddings, expanded_mask, lang_id)
 
             # lstm step
             lstm_input = embeddings.unsqueeze(0)
             if self.input_feeding:
                 lstm_input = torch.cat([lstm_input, attention], 2)
             lstm_output, h_c_1 = lstm_layer1(lstm_input, h_c_1)
-            assert lstm_output.size() == (1, bs * beam_size, self.hidden_dim)
-            hidden_states.append(lstm_output)
+            assert lstm_output.size() == (1, n_beams, self.hidden_dim)
 
             # lstm (layers > 1)
             if self.n_dec_layers > 1:
@@ -595,111 +641,76 @@ class Decoder(nn.Module):
                 if not self.input_feeding:
                     lstm_output = torch.cat([lstm_output, attention], 2)
                 lstm_output, h_c_2 = lstm_layer2(lstm_output, h_c_2)
-                assert lstm_output.size() == (1, bs * beam_size, self.hidden_dim)
+                assert lstm_output.size() == (1, n_beams, self.hidden_dim)
 
             # word scores
             lstm_output = F.dropout(lstm_output, p=self.dropout, training=self.training)
-            scores = self.log_sm(proj_layer(lstm_output.view(-1, self.hidden_dim)).view(bs * beam_size, n_words))
+            scores = self.log_sm(proj_layer(lstm_output.view(-1, self.hidden_dim)).view(n_beams, n_words))
 
-            # beam search
-            scores2 = scores.data + current_hyp_scores.unsqueeze(1).expand(bs * beam_size, n_words)
+            # best 2 * beam_size candidates of each sentence
+            scores2 = scores.data + beam_scores.unsqueeze(1).expand(n_beams, n_words)
             scores2 = scores2.contiguous().view(bs, beam_size * n_words)
             best_values, best_indexes = scores2.topk(2 * beam_size, dim=1, largest=True, sorted=True)
-
-            all_next = []  # [(current hyp value, next word, position in the total batch)]
-            for sent_id in range(bs):
-                if len(current_hyps[sent_id]) == beam_size:  # this sentence is done
-                    all_next.extend([(0, self.pad_index, 0)] * beam_size)  # pad the batch
-                    continue
-                offset = sent_id * beam_size
-                current_next = []
-                for beam_k in range(2 * beam_size):
-                    word_pos = best_indexes[sent_id, beam_k]
-                    beam_id = word_pos // n_words
-                    word_id = word_pos % n_words
-                    assert 0 <= beam_id < beam_size and 0 <= word_id < n_words
-                    if word_id == self.eos_index or cur_len + 1 == max_len:
-                        current_hyps[sent_id].append((
-                            decoded[:cur_len, offset + beam_id].clone(), best_values[sent_id, beam_k]
-                        ))
-                    else:
-                        current_next.append((best_values[sent_id, beam_k], word_id, offset + beam_id))
-                    if len(current_hyps[sent_id]) == beam_size:  # this sentence is done
-                        current_next = [(0, self.pad_index, 0)] * beam_size  # pad the batch
-                        break
-                    if len(current_next) == beam_size:  # enough next hypothesis in the beam
-                        break
-                assert len(current_next) == beam_size
-                all_next.extend(current_next)
-                assert len(all_next) == beam_size * (sent_id + 1)
-            # update current_hyp_scores
-            # print(cur_len,  "aaaaaaaaaaaaaaaaaaaaaaaaaaa")
-            assert len(all_next) == bs * beam_size, (len(all_next), bs * beam_size)
-            current_hyp_scores = latent.data.new([x[0] for x in all_next])
-            # print(all_next)
-
-            # update decoded tensor, and LSTM 1 + LSTM 2 internal states
-            # make this faster!!!
-            slow = True
-            if slow:
-                _decoded = decoded.clone()
-                _h_c_1 = (h_c_1[0].data.clone(), h_c_1[1].data.clone())
-                _h_c_2 = (h_c_2[0].data.clone(), h_c_2[1].data.clone())
-                for sent_id in range(bs):
-                    for beam_k in range(beam_size):
-                        k = sent_id * beam_size + beam_k
-                        # print(k)
-                        previous_beam_id = all_next[k][2]
-                        _decoded[:, k].copy_(decoded[:, previous_beam_id].clone())
-                        _decoded[cur_len, k] = all_next[k][1]
-                        _h_c_1[0][0, k].copy_(_h_c_1[0][0, previous_beam_id])
-                        _h_c_1[1][0, k].copy_(_h_c_1[1][0, previous_beam_id])
-                        for jj in range(self.n_dec_layers - 1):
-                            _h_c_2[0][jj, k].copy_(_h_c_2[0][jj, previous_beam_id])
-                            _h_c_2[1][jj, k].copy_(_h_c_2[1][jj, previous_beam_id])
-                decoded = _decoded
-                h_c_1 = (_h_c_1[0], _h_c_1[1])
-                h_c_2 = (_h_c_2[0], _h_c_2[1])
-            else:
-                next_ids = x_len.new([x[2] for x in all_next])
-                decoded = decoded.index_select(1, next_ids)
-                h_c_1 = (
-                    h_c_1[0][0].index_select(0, next_ids).unsqueeze(0),
-                    h_c_1[1][0].index_select(0, next_ids).unsqueeze(0)
-                )
-                h_c_2 = (
-                    h_c_2[0][0].index_select(0, next_ids).unsqueeze(0),
-                    h_c_2[1][0].index_select(0, next_ids).unsqueeze(0)
-                )
+            beam_ids = best_indexes // n_words
+            word_ids = best_indexes % n_words
+            positions = offsets.unsqueeze(1) + beam_ids                                # (bs, 2 * beam_size)
+
+            # candidates ending a hypothesis. candidates are considered by decreasing score,
+            # until the sentence has beam_size hypotheses or beam_size next candidates
+            ending = word_ids.eq(self.eos_index) | (cur_len + 1 == max_len)
+            n_ending = ending.long().cumsum(1)
+            n_next = (~ending).long().cumsum(1)
+            stop = (n_hyps.unsqueeze(1) + n_ending >= beam_size) | (n_next >= beam_size)
+            considered = (stop.long().cumsum(1) - stop.long()) == 0
+            active = n_hyps < beam_size
+            ending &= considered & active.unsqueeze(1)
+            next_cands = ~ending & considered & active.unsqueeze(1)
+
+            # update the best finished hypothesis. all new hypotheses have the same length, and candidates
+            # are sorted by score, so the first one is the best. earlier hypotheses win ties
+            first_ending = ending.long().argmax(1)
+            has_ending = ending.any(1)
+            new_norm_scores = best_values.gather(1, first_ending.unsqueeze(1)).squeeze(1) / cur_len
+            update = has_ending & ((n_hyps == 0) | (new_norm_scores > best_norm_scores))
+            if update.any():
+                update_ids = update.nonzero().squeeze(1)
+                best_norm_scores[update_ids] = new_norm_scores[update_ids]
+                best_lengths[update_ids] = cur_len
+                best_hyps[:, update_ids] = decoded[:, positions[update_ids, first_ending[update_ids]]]
+            n_hyps += ending.long().sum(1)
+            done = n_hyps >= beam_size
+
+            # next hypotheses of each sentence (finished sentences keep their beams, with padding)
+            assert (next_cands.long().sum(1)[~done] == beam_size).all()
+            next_ranks = ((~next_cands).long() * 2 * beam_size + ranks).topk(beam_size, dim=1, largest=False)[1]
+            next_ranks = next_ranks.sort(1)[0]
+            next_positions = positions.gather(1, next_ranks)
+            next_words = word_ids.gather(1, next_ranks)
+            beam_scores = best_values.gather(1, next_ranks)
+            next_positions[done] = offsets[done].unsqueeze(1) + torch.arange(beam_size, device=decoded.device)
+            next_words[done] = self.pad_index
+            beam_scores[done] = 0
+            next_positions = next_positions.view(-1)
+            beam_scores = beam_scores.view(-1)
+
+            # reorder decoded tensor, and LSTM 1 + LSTM 2 internal states
+            decoded = decoded.index_select(1, next_positions)
+            decoded[cur_len] = next_words.view(-1)
+            h_c_1 = tuple(h.index_select(1, next_positions) for h in h_c_1)
+            if h_c_2 is not None:
+                h_c_2 = tuple(h.index_select(1, next_positions) for h in h_c_2)
+            hidden_state = h_c_1[0][0]
 
             cur_len += 1
 
             # stop when there are `beam_size` hypothesis for each sentence
-            if all(len(hyps) == beam_size for hyps in current_hyps):
+            if done.all():
                 break
 
-        def score_sent(score, sent_len):
-            # return score
-            return score / sent_len
-            # return score / sent_len ** 0.5
-            # return score / sent_len + 0.01 * sent_len
-
-        # best hypothesis
-        lengths = torch.LongTensor(bs)
-        sentences = []
-        for i in range(bs):
-            hyps = current_hyps[i]
-            assert len(hyps) == beam_size
-            # best_hypo = max(hyps, key=lambda x: x[1])[0]
-            # print("\n".join([" ".join([(self.src_dico if source else self.tgt_dico)[wid] for wid in hyp[0]]) for hyp in hyps]))
-            best_hypo = max(hyps, key=lambda x: score_sent(x[1], len(x[0])))[0]
-            lengths[i] = len(best_hypo) + 1
-            sentences.append(best_hypo)
-        decoded = torch.LongTensor(lengths.max(), bs).fill_(self.pad_index)
-        decoded = decoded.cuda() if is_cuda else decoded
-        for i, hypo in enumerate(sentences):
-            decoded[:lengths[i] - 1, i] = hypo
-            decoded[lengths[i] - 1, i] = self.eos_index
+        # best hypothesis (scores are normalized by the hypothesis length)
+        lengths = (best_lengths + 1).cpu()
+        decoded = best_hyps[:lengths.max()]
+        decoded[best_lengths, torch.arange(bs, device=decoded.device)] = self.eos_index
 
         # if one_hot is not None:
         #     one_hot = torch.cat([x.unsqueeze(0) for x in one_hot], 0)
@@ -749,10 +760,13 @@ def build_transformer_enc_dec(params):
     return encoder, decoder
 
 
-def build_attention_model(params, data, cuda=True):
+def build_attention_model(params, data, device=None):
     """
     Build a encoder / decoder, and the decoder reconstruction loss function.
+    Models are moved to `device` (`params.device` by default).
     """
+    device = params.device if device is None else device
+
     # encoder / decoder / discriminator
     if params.transformer:
         encoder, decoder = build_transformer_enc_dec(params)
@@ -789,40 +803,40 @@ def build_attention_model(params, data, cuda=True):
     else:
         lm = None
 
-    # cuda - models on CPU will be synchronized and don't need to be reloaded
-    if cuda:
-        encoder.cuda()
-        decoder.cuda()
-        if len(params.vocab) > 0:
-            decoder.vocab_mask_neg = [x.cuda() for x in decoder.vocab_mask_neg]
-        if discriminator is not None:
-            discriminator.cuda()
-        if lm is not None:
-            lm.cuda()
-
-        # initialize the model with pretrained embeddings
-        assert not (getattr(params, 'cpu_thread', False)) ^ (data is None)
-        if data is not None:
-            initialize_embeddings(encoder, decoder, params, data)
-
-        # reload encoder / decoder / discriminator
-        if params.reload_model != '':
-            assert os.path.isfile(params.reload_model)
-            logger.info("Reloading model from %s ..." % params.reload_model)
-            reloaded = torch.load(params.reload_model)
-            if params.reload_enc:
-                logger.info("Reloading encoder...")
-                enc = reloaded.get('enc', reloaded.get('encoder'))
-                reload_model(encoder, enc, encoder.ENC_ATTR)
-            if params.reload_dec:
-                logger.info("Reloading decoder...")
-                dec = reloaded.get('dec', reloaded.get('decoder'))
-                reload_model(decoder, dec, decoder.DEC_ATTR)
-            if params.reload_dis:
-                assert discriminator is not None
-                logger.info("Reloading discriminator...")
-                dis = reloaded.get('dis', reloaded.get('discriminator'))
-                reload_model(discriminator, dis, discriminator.DIS_ATTR)
+    # device
+    encoder.to(device)
+    decoder.to(device)
+    if len(params.vocab) > 0:
+        decoder.vocab_mask_neg = [x.to(device) for x in decoder.vocab_mask_neg]
+    if discriminator is not None:
+        discriminator.to(device)
+    if lm is not None:
+        lm.to(device)
+
+    # initialize the model with pretrained embeddings (models in CPU
+    # threads are synchronized with the main models, and don't need it)
+    assert not (getattr(params, 'cpu_thread', False)) ^ (data is None)
+    if data is not None:
+        initialize_embeddings(encoder, decoder, params, data)
+
+    # reload encoder / decoder / discriminator
+    if data is not None and params.reload_model != '':
+        assert os.path.isfile(params.reload_model)
+        logger.info("Reloading model from %s ..." % params.reload_model)
+        reloaded = torch.load(params.reload_model, map_location=device)
+        if params.reload_enc:
+            logger.info("Reloading encoder...")
+            enc = reloaded.get('enc', reloaded.get('encoder'))
+            reload_model(encoder, enc, encoder.ENC_ATTR)
+        if params.reload_dec:
+            logger.info("Reloading decoder...")
+            dec = reloaded.get('dec', reloaded.get('decoder'))
+            reload_model(decoder, dec, decoder.DEC_ATTR)
+        if params.reload_dis:
+            assert discriminator is not None
+            logger.info("Reloading discriminator...")
+            dis = reloaded.get('dis', reloaded.get('discriminator'))
+            reload_model(discriminator, dis, discriminator.DIS_ATTR)
 
     # log models
     encdec_params = set(
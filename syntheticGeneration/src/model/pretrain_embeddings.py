@@ -119,13 +119,13 @@ def initialize_embeddings(encoder, decoder, params, data):
             word = dico[word_id]
             if word in word2id[i]:
                 found[i] += 1
-                vec = torch.from_numpy(pretrained[i][word2id[i][word]]).cuda()
+                vec = torch.from_numpy(pretrained[i][word2id[i][word]])
                 for x in to_update:
                     x[word_id] = vec
             elif word.lower() in word2id[i]:
                 found[i] += 1
                 lower[i] += 1
-                vec = torch.from_numpy(pretrained[i][word2id[i][word.lower()]]).cuda()
+                vec = torch.from_numpy(pretrained[i][word2id[i][word.lower()]])
                 for x in to_update:
                     x[word_id] = vec
 
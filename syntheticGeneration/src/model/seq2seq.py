@@ -9,16 +9,17 @@ from .discriminator import Discriminator
 from .lm import LM
 from .pretrain_embeddings import initialize_embeddings
 from ..utils import get_mask, reload_model
+from ..sampling import sample_words, expand_encoded
 
 
 logger = getLogger()
 
 
-def get_init_state(n_dec_layers, batch_size, hidden_dim, init_state=None):
+def get_init_state(n_dec_layers, batch_size, hidden_dim, device, init_state=None):
     """
-    Build an initial LSTM state, with optional non-zero first layer.
+    Build an initial LSTM state on `device`, with optional non-zero first layer.
     """
-    init = torch.cuda.FloatTensor(n_dec_layers, batch_size, hidden_dim).zero_()
+    init = torch.zeros(n_dec_layers, batch_size, hidden_dim, device=device)
     h_0 = init.clone()
     c_0 = init.clone()
     if init_state is not None:
@@ -106,7 +107,7 @@ class Encoder(nn.Module):
               representing the encoded state of each sentence
         """
         assert type(lang_id) is int
-        is_cuda = x.is_cuda
+        device = x.device
         emb_layer = self.embeddings[lang_id]
         lstm_layer = self.lstm[lang_id]
         proj_layer = self.proj[lang_id]
@@ -132,7 +133,7 @@ class Encoder(nn.Module):
             latent_state = lstm_output.max(0)[0]
         else:
             # select the last state of each sentence
-            mask = get_mask(lengths, False, expand=self.hidden_dim, batch_first=True, cuda=is_cuda)
+            mask = get_mask(lengths, False, expand=self.hidden_dim, batch_first=True, device=device)
             h_t = lstm_output.transpose(0, 1).masked_select(mask).view(bs, self.hidden_dim)
             if self.proj_mode == 'proj':
                 latent_state = proj_layer(h_t)
@@ -288,7 +289,7 @@ class Decoder(nn.Module):
         assert embeddings.size() == (slen, bs, self.emb_dim)
 
         if self.init_encoded:
-            init = get_init_state(self.n_dec_layers, bs, self.hidden_dim, latent)
+            init = get_init_state(self.n_dec_layers, bs, self.hidden_dim, latent.device, latent)
             lstm_input = embeddings
         else:
             init = None
@@ -306,19 +307,23 @@ class Decoder(nn.Module):
         scores = proj_layer(output)
         return scores.view(slen, bs, n_words)
 
-    def generate(self, encoded, lang_id, max_len=200, sample=False, temperature=None):
+    def generate(self, encoded, lang_id, max_len=200, sample=False, temperature=None,
+                 top_k=0, top_p=1., n_samples=1):
         """
         Generate a sentence from a given initial state.
         Input:
             - FloatTensor of size (batch_size, hidden_dim) representing
               sentences encoded in the latent space
         Output:
-            - LongTensor of size (seq_len, batch_size), word indices
-            - LongTensor of size (batch_size,), sentence lengths
+            - LongTensor of size (seq_len, batch_size * n_samples), word indices
+            - LongTensor of size (batch_size * n_samples,), sentence lengths
+        When sampling, `n_samples` outputs are generated for each sentence.
         """
+        if n_samples > 1:
+            encoded = expand_encoded(encoded, n_samples)
         assert encoded.input_len.size(0) == encoded.dec_input.size(0)
         latent = encoded.dec_input
-        is_cuda = latent.is_cuda
+        device = latent.device
         assert type(lang_id) is int
         assert (sample is True) ^ (temperature is None)
         one_hot = None  # [] if temperature is not None else None
@@ -332,11 +337,11 @@ class Decoder(nn.Module):
         bs = latent.size(0)
         cur_len = 1
         if self.init_encoded:
-            h_c = get_init_state(self.n_dec_layers, bs, self.hidden_dim, latent)
+            h_c = get_init_state(self.n_dec_layers, bs, self.hidden_dim, latent.device, latent)
         else:
             h_c = None
         decoded = torch.LongTensor(max_len, bs).fill_(self.pad_index)
-        decoded = decoded.cuda() if is_cuda else decoded
+        decoded = decoded.to(device)
         decoded[0] = self.bos_index[lang_id]
 
         # decoding
@@ -364,7 +369,7 @@ class Decoder(nn.Module):
                 #     next_words = gumbel.max(1)[1]
                 #     one_hot.append(gumbel)
                 # else:
-                next_words = torch.multinomial((scores / temperature).exp(), 1).squeeze(1)
+                next_words = sample_words(scores, 1, temperature, top_k, top_p).squeeze(1)
             else:
                 next_words = scores.max(1)[1]
             assert next_words.size() == (bs,)
@@ -394,10 +399,13 @@ class Decoder(nn.Module):
         return decoded[:cur_len], lengths, one_hot
 
 
-def build_seq2seq_model(params, data, cuda=True):
+def build_seq2seq_model(params, data, device=None):
     """
     Build a encoder / decoder, and the decoder reconstruction loss function.
+    Models are moved to `device` (`params.device` by default).
     """
+    device = params.device if device is None else device
+
     # encoder / decoder / discriminator
     logger.info("============ Building seq2seq model - Encoder ...")
     encoder = Encoder(params)
@@ -428,36 +436,36 @@ def build_seq2seq_model(params, data, cuda=True):
     else:
         lm = None
 
-    # cuda - models on CPU will be synchronized and don't need to be reloaded
-    if cuda:
-        encoder.cuda()
-        decoder.cuda()
-        if len(params.vocab) > 0:
-            decoder.vocab_mask_neg = [x.cuda() for x in decoder.vocab_mask_neg]
-        if discriminator is not None:
-            discriminator.cuda()
-        if lm is not None:
-            lm.cuda()
-
-        # initialize the model with pretrained embeddings
-        assert not (getattr(params, 'cpu_thread', False)) ^ (data is None)
-        if data is not None:
-            initialize_embeddings(encoder, decoder, params, data)
-
-        # reload encoder / decoder / discriminator
-        if params.reload_model != '':
-            assert os.path.isfile(params.reload_model)
-            logger.info("Reloading model from %s ..." % params.reload_model)
-            reloaded = torch.load(params.reload_model)
-            if params.reload_enc:
-                logger.info("Reloading encoder...")
-                reload_model(encoder, reloaded['enc'], encoder.ENC_ATTR)
-            if params.reload_dec:
-                logger.info("Reloading decoder...")
-                reload_model(decoder, reloaded['dec'], decoder.DEC_ATTR)
-            if params.reload_dis:
-                logger.info("Reloading discriminator...")
-                reload_model(discriminator, reloaded['dis'], discriminator.DIS_ATTR)
+    # device
+    encoder.to(device)
+    decoder.to(device)
+    if len(params.vocab) > 0:
+        decoder.vocab_mask_neg = [x.to(device) for x in decoder.vocab_mask_neg]
+    if discriminator is not None:
+        discriminator.to(device)
+    if lm is not None:
+        lm.to(device)
+
+    # initialize the model with pretrained embeddings (models in CPU
+    # threads are synchronized with the main models, and don't need it)
+    assert not (getattr(params, 'cpu_thread', False)) ^ (data is None)
+    if data is not None:
+        initialize_embeddings(encoder, decoder, params, data)
+
+    # reload encoder / decoder / discriminator
+    if data is not None and params.reload_model != '':
+        assert os.path.isfile(params.reload_model)
+        logger.info("Reloading model from %s ..." % params.reload_model)
+        reloaded = torch.load(params.reload_model, map_location=device)
+        if params.reload_enc:
+            logger.info("Reloading encoder...")
+            reload_model(encoder, reloaded['enc'], encoder.ENC_ATTR)
+        if params.reload_dec:
+            logger.info("Reloading decoder...")
+            reload_model(decoder, reloaded['dec'], decoder.DEC_ATTR)
+        if params.reload_dis:
+            logger.info("Reloading discriminator...")
+            reload_model(discriminator, reloaded['dis'], discriminator.DIS_ATTR)
 
     # log models
     logger.info("============ Model summary")
@@ -18,6 +18,7 @@ from ..modules.layer_norm import LayerNorm
 from ..modules.multihead_attention import MultiheadAttention
 from ..modules.sinusoidal_positional_embedding import SinusoidalPositionalEmbedding
 from ..sequence_generator import SequenceGenerator
+from ..sampling import sample_words, expand_encoded
 
 from . import LatentState
 
@@ -131,6 +132,8 @@ class TransformerDecoder(nn.Module):
         self.encoder_class = encoder.__class__
         self.beam_size = args.beam_size
         self.length_penalty = args.length_penalty
+        self.coverage_penalty = args.coverage_penalty
+        self.prune_finished = args.prune_finished
 
         # indexes
         self.eos_index = args.eos_index
@@ -198,7 +201,7 @@ class TransformerDecoder(nn.Module):
                 proj[i].bias = proj[0].bias
         self.proj = nn.ModuleList(proj)
 
-    def forward(self, encoded, y, lang_id, one_hot=False, incremental_state=None):
+    def forward(self, encoded, y, lang_id, one_hot=False, incremental_state=None, return_attn=False):
         assert not one_hot, 'one_hot=True has not been implemented for transformer'
         assert type(lang_id) is int
 
@@ -230,6 +233,9 @@ class TransformerDecoder(nn.Module):
         # project back to size of vocabulary
         x = proj_layer(x)
 
+        # optionally return the encoder-decoder attention of the last layer (B x T x S)
+        if return_attn:
+            return x, attn
         return x
 
     def max_positions(self):
@@ -251,29 +257,53 @@ class TransformerDecoder(nn.Module):
                 )
         self.apply(apply_reorder_incremental_state)
 
+    def allocate_kv_cache_(self, incremental_state, lang_id, bsz, max_len):
+        """Preallocate the self-attention keys / values of `max_len` time steps.
+
+        Decoding steps then write their keys / values in place, instead of
+        concatenating them to the previous ones (see MultiheadAttention).
+        """
+        for layer in self.layers:
+            layer[lang_id].self_attn.allocate_kv_cache(incremental_state, bsz, max_len)
+
+    def precompute_encoder_kv_(self, encoder_out_dict, lang_id, incremental_state):
+        """Compute the keys / values of the encoder-decoder attention layers.
+
+        This should be called once per source batch, before the first decoding
+        step. Keys / values are stored in the incremental state, and are reordered
+        with it, so the source is not projected again at each time step.
+        """
+        for layer in self.layers:
+            layer[lang_id].encoder_attn.precompute_static_kv(encoder_out_dict['encoder_out'], incremental_state)
+
     def reorder_encoder_out_(self, encoder_out_dict, new_order):
         if encoder_out_dict['encoder_padding_mask'] is not None:
             encoder_out_dict['encoder_padding_mask'] = \
                 encoder_out_dict['encoder_padding_mask'].index_select(0, new_order)
 
-    def generate(self, encoded, lang_id, max_len=200, sample=False, temperature=None):
+    def generate(self, encoded, lang_id, max_len=200, sample=False, temperature=None,
+                 top_k=0, top_p=1., n_samples=1):
         """
         Generate a sentence from a given initial state.
         Input:
             - FloatTensor of size (batch_size, hidden_dim) representing
               sentences encoded in the latent space
         Output:
-            - LongTensor of size (seq_len, batch_size), word indices
-            - LongTensor of size (batch_size,), sentence x_len
+            - LongTensor of size (seq_len, batch_size * n_samples), word indices
+            - LongTensor of size (batch_size * n_samples,), sentence x_len
+        If `prune_finished` is set, finished sentences are removed from the batch.
+        When sampling, `n_samples` outputs are generated for each sentence.
         """
+        if n_samples > 1:
+            encoded = expand_encoded(encoded, n_samples)
         if self.beam_size > 0:
-            return self.generate_beam(encoded, lang_id, self.beam_size, max_len, sample, temperature)
+            return self.generate_beam(encoded, lang_id, self.beam_size, max_len, sample, temperature, top_k, top_p)
 
         encoder_out = encoded.dec_input
         latent = encoder_out['encoder_out']
 
         x_len = encoded.input_len
-        is_cuda = latent.is_cuda
+        device = latent.device
         one_hot = None
 
         # check inputs
@@ -288,13 +318,25 @@ class TransformerDecoder(nn.Module):
         decoded = torch.LongTensor(max_len, bs).fill_(self.pad_index)
         unfinished_sents = torch.LongTensor(bs).fill_(1)
         lengths = torch.LongTensor(bs).fill_(1)
-        if is_cuda:
-            decoded = decoded.cuda()
-            unfinished_sents = unfinished_sents.cuda()
-            lengths = lengths.cuda()
+        decoded = decoded.to(device)
+        unfinished_sents = unfinished_sents.to(device)
+        lengths = lengths.to(device)
         decoded[0] = self.bos_index[lang_id]
 
+        # sentences still in the batch, and final outputs (the encoder output
+        # is copied, as it is reordered when finished sentences are removed)
+        n_sents = bs
+        prune_finished = getattr(self, 'prune_finished', False)  # not set in older models
+        if prune_finished:
+            encoded = encoded._replace(dec_input=dict(encoded.dec_input))
+            sent_ids = torch.arange(bs).long()
+            sent_ids = sent_ids.to(device)
+            final_decoded = decoded.clone()
+            final_lengths = lengths.clone()
+
         incremental_state = {}
+        self.allocate_kv_cache_(incremental_state, lang_id, bs, max_len)
+        self.precompute_encoder_kv_(encoded.dec_input, lang_id, incremental_state)
         while cur_len < max_len:
 
             # previous word embeddings
@@ -303,10 +345,10 @@ class TransformerDecoder(nn.Module):
 
             # select next words: sample or one-hot
             if sample:
-                next_words = torch.multinomial((scores / temperature).exp(), 1).squeeze(1)
+                next_words = sample_words(scores, 1, temperature, top_k, top_p).squeeze(1)
             else:
                 next_words = torch.topk(scores, 1)[1].squeeze(1)
-            assert next_words.size() == (bs,)
+            assert next_words.size() == (n_sents,)
             decoded[cur_len] = next_words * unfinished_sents + self.pad_index * (1 - unfinished_sents)
             lengths.add_(unfinished_sents)
             unfinished_sents.mul_(next_words.ne(self.eos_index).long())
@@ -316,52 +358,72 @@ class TransformerDecoder(nn.Module):
             if unfinished_sents.max() == 0:
                 break
 
+            # remove finished sentences from the batch, and store their translations
+            if prune_finished and unfinished_sents.min() == 0:
+                finished = unfinished_sents.eq(0).nonzero().view(-1)
+                keep = unfinished_sents.nonzero().view(-1)
+                final_decoded.index_copy_(1, sent_ids[finished], decoded.index_select(1, finished))
+                final_lengths.index_copy_(0, sent_ids[finished], lengths[finished])
+                n_sents = keep.size(0)
+                sent_ids = sent_ids[keep]
+                decoded = decoded.index_select(1, keep)
+                lengths = lengths[keep]
+                unfinished_sents = unfinished_sents[keep]
+                self.reorder_incremental_state_(incremental_state, keep)
+                self.reorder_encoder_out_(encoded.dec_input, keep)
+
         if cur_len == max_len:
-            decoded[max_len - 1].masked_fill_(unfinished_sents.byte(), self.eos_index)
+            decoded[max_len - 1].masked_fill_(unfinished_sents.ne(0), self.eos_index)
+
+        # scatter the remaining sentences back to their original positions
+        if prune_finished:
+            final_decoded.index_copy_(1, sent_ids, decoded)
+            final_lengths.index_copy_(0, sent_ids, lengths)
+            decoded, lengths = final_decoded, final_lengths
         assert (decoded == self.eos_index).sum() == bs
 
         return decoded[:cur_len], lengths, one_hot
 
-    def generate_beam(self, encoded, lang_id, beam_size=20, max_len=175, sample=False, temperature=None):
+    def generate_beam(self, encoded, lang_id, beam_size=20, max_len=175, sample=False, temperature=None,
+                      top_k=0, top_p=1., nbest=1):
         """
         Generate a sentence from a given initial state.
         Input:
             - FloatTensor of size (batch_size, hidden_dim) representing
               sentences encoded in the latent space
         Output:
-            - LongTensor of size (seq_len, batch_size), word indices
-            - LongTensor of size (batch_size,), sentence x_len
+            - LongTensor of size (seq_len, batch_size * nbest), word indices
+            - LongTensor of size (batch_size * nbest,), sentence x_len
+        The `nbest` best hypotheses of each sentence are returned consecutively, best first.
         """
+        assert 1 <= nbest <= beam_size
         self.encoder_class.expand_encoder_out_(encoded.dec_input, beam_size)
 
         x_len = encoded.input_len
-        is_cuda = encoded.dec_input['encoder_out'].is_cuda
+        device = encoded.dec_input['encoder_out'].device
         one_hot = None
 
         # check inputs
         assert type(lang_id) is int
         # assert latent.size() == (x_len.max(), x_len.size(0) * beam_size, self.emb_dim)
         assert (sample is True) ^ (temperature is None)
-        assert temperature is None, 'not supported'
 
+        coverage_penalty = getattr(self, 'coverage_penalty', 0)  # not set in older models
         generator = SequenceGenerator(
             self, self.bos_index[lang_id], self.pad_index, self.eos_index,
             self.n_words[lang_id], beam_size=beam_size, maxlen=max_len, sampling=sample,
-            len_penalty=self.length_penalty,
+            len_penalty=self.length_penalty, coverage_penalty=coverage_penalty,
+            sampling_temperature=temperature if sample else 1., sampling_topk=top_k, sampling_topp=top_p,
         )
-        if is_cuda:
-            x_len = x_len.cuda()
-        results = generator.generate(x_len, encoded, lang_id)
-
-        lengths = torch.LongTensor([sent[0]['tokens'].numel() for sent in results])
-        lengths.add_(1)  # for BOS
-        max_len = lengths.max()
-        bsz = len(results)
-        decoded = results[0][0]['tokens'].new(max_len, bsz).fill_(0)
-        decoded[0, :] = self.bos_index[lang_id]
-        for i, sent in enumerate(results):
-            ntoks = sent[0]['tokens'].numel()  # pick the top beam result
-            decoded[1:ntoks + 1, i] = sent[0]['tokens']
+        x_len = x_len.to(device)
+        hypotheses = generator.generate(x_len, encoded, lang_id)
+
+        # pick the top `nbest` beam results, and add BOS
+        lengths = hypotheses.lengths[:, :nbest].contiguous().view(-1) + 1
+        tokens = hypotheses.tokens[:, :nbest].contiguous().view(len(lengths), -1)
+        decoded = hypotheses.tokens.new(lengths.max(), len(lengths)).fill_(self.pad_index)
+        decoded[0] = self.bos_index[lang_id]
+        decoded[1:] = tokens[:, :decoded.size(0) - 1].t()
 
         return decoded, lengths, one_hot
 
@@ -21,7 +21,7 @@ class LabelSmoothedCrossEntropyLoss(nn.Module):
         self.register_buffer('weight', weight)
 
     def forward(self, input, target):
-        lprobs = F.log_softmax(input, dim=-1)
+        lprobs = F.log_softmax(input.float(), dim=-1)
         target = target.view(-1, 1)
 
         nll_loss = -lprobs.gather(dim=-1, index=target)
@@ -28,6 +28,10 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         shape = input.size()
 
+        # normalization statistics are computed in fp32, even in bfloat16 training
+        dtype = input.dtype
+        input = input.float()
+
         # In order to force the cudnn path, everything needs to be
         # contiguous. Hence the check here and reallocation below.
         if not input.is_contiguous():
@@ -51,4 +55,4 @@ class LayerNorm(nn.Module):
         w = self.w[:n]
         b = self.b[:n]
         output = F.batch_norm(input, dummy, dummy, w, b, True, 0., self.eps)
-        return torch.addcmul(self.bias, 1, output.view(*shape), self.gain)
+        return torch.addcmul(self.bias, 1, output.view(*shape), self.gain).to(dtype)
@@ -68,24 +68,31 @@ class MultiheadAttention(nn.Module):
                 'attn_state',
             ) or {}
 
-            if 'prev_key' in saved_state:
+            if 'prev_key' in saved_state or 'key_cache' in saved_state:
                 # previous time steps are cached - no need to recompute
                 # key and value if they are static
                 if static_kv:
                     assert kv_same
-                    key = key.data.new(0)
-                    value = value.data.new(0)
+                    key = value = None
         else:
             saved_state = None
 
         tgt_len, bsz, embed_dim = query.size()
         assert embed_dim == self.embed_dim
         assert list(query.size()) == [tgt_len, bsz, embed_dim]
-        assert key.size() == value.size()
+        assert key is None or key.size() == value.size()
 
         if qkv_same:
             # self-attention
             q, k, v = self.in_proj_qkv(query)
+        elif key is None:
+            # encoder-decoder attention, with cached key and value
+            q = self.in_proj_q(query)
+            if 'key_cache' in saved_state:
+                cache_len = saved_state['cache_len']
+                k, v = saved_state['key_cache'][:cache_len], saved_state['value_cache'][:cache_len]
+            else:
+                k, v = saved_state['prev_key'], saved_state['prev_value']
         elif kv_same:
             # encoder-decoder attention
             q = self.in_proj_q(query)
@@ -96,13 +103,24 @@ class MultiheadAttention(nn.Module):
             v = self.in_proj_v(value)
         q *= self.scaling
 
-        if saved_state is not None:
-            if 'prev_key' in saved_state:
-                k = torch.cat((saved_state['prev_key'], k), dim=0)
-            if 'prev_value' in saved_state:
-                v = torch.cat((saved_state['prev_value'], v), dim=0)
-            saved_state['prev_key'] = k
-            saved_state['prev_value'] = v
+        if saved_state is not None and key is not None:
+            if 'key_cache' in saved_state:
+                # write new time steps in the preallocated cache
+                start = saved_state['cache_len']
+                end = start + k.size(0)
+                assert end <= saved_state['key_cache'].size(0), 'key / value cache is full'
+                saved_state['key_cache'][start:end] = k
+                saved_state['value_cache'][start:end] = v
+                saved_state['cache_len'] = end
+                k = saved_state['key_cache'][:end]
+                v = saved_state['value_cache'][:end]
+            else:
+                if 'prev_key' in saved_state:
+                    k = torch.cat((saved_state['prev_key'], k), dim=0)
+                if 'prev_value' in saved_state:
+                    v = torch.cat((saved_state['prev_value'], v), dim=0)
+                saved_state['prev_key'] = k
+                saved_state['prev_value'] = v
             utils.set_incremental_state(
                 self,
                 incremental_state,
@@ -137,7 +155,8 @@ class MultiheadAttention(nn.Module):
                     -1e18,
                 )
                 attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
-        attn_weights = F.softmax(attn_weights, dim=-1)
+        # the softmax is computed in fp32 (bfloat16 training)
+        attn_weights = F.softmax(attn_weights.float(), dim=-1).type_as(attn_weights)
         attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
 
         attn = torch.bmm(attn_weights, v)
@@ -154,6 +173,46 @@ class MultiheadAttention(nn.Module):
 
         return attn, attn_weights
 
+    def allocate_kv_cache(self, incremental_state, bsz, max_len):
+        """Preallocate keys / values for `max_len` time steps in the incremental
+        state. Keys / values of new time steps are written in place at the
+        cursor position (`cache_len`), instead of being concatenated to the
+        previous ones. Spare buffers are used to reorder the cache without
+        allocating new tensors.
+        """
+        new_buffer = lambda: self.in_proj_weight.data.new(max_len, bsz, self.embed_dim)  # noqa
+        utils.set_incremental_state(
+            self,
+            incremental_state,
+            'attn_state',
+            {
+                'key_cache': new_buffer(),
+                'value_cache': new_buffer(),
+                'key_spare': new_buffer(),
+                'value_spare': new_buffer(),
+                'cache_len': 0,
+            },
+        )
+
+    def precompute_static_kv(self, key, incremental_state):
+        """Compute static keys / values (e.g. the encoder output in the
+        encoder-decoder attention) once, and cache them in the incremental state.
+        They are then reused at each time step when `static_kv` is set.
+        """
+        k, v = self.in_proj_kv(key)
+        utils.set_incremental_state(
+            self,
+            incremental_state,
+            'attn_state',
+            {
+                'key_cache': k.contiguous(),
+                'value_cache': v.contiguous(),
+                'key_spare': k.new(k.size()),
+                'value_spare': v.new(v.size()),
+                'cache_len': k.size(0),
+            },
+        )
+
     def in_proj_qkv(self, query):
         return self._in_proj(query).chunk(3, dim=-1)
 
@@ -195,6 +254,28 @@ class MultiheadAttention(nn.Module):
     def reorder_incremental_state(self, incremental_state, new_order):
         saved_state = utils.get_incremental_state(self, incremental_state, 'attn_state')
         if saved_state is not None:
-            for k in saved_state.keys():
-                saved_state[k] = saved_state[k].index_select(1, new_order)
+            if 'key_cache' in saved_state:
+                self._reorder_kv_cache(saved_state, new_order)
+            else:
+                for k in saved_state.keys():
+                    saved_state[k] = saved_state[k].index_select(1, new_order)
             utils.set_incremental_state(self, incremental_state, 'attn_state', saved_state)
+
+    def _reorder_kv_cache(self, saved_state, new_order):
+        """Reorder the filled part of a preallocated cache. If the batch size is
+        unchanged, the cache is reordered into the spare buffer and the two are
+        swapped, otherwise (e.g. finished sentences removed) buffers are reallocated.
+        """
+        cache_len = saved_state['cache_len']
+        for name in ['key', 'value']:
+            cache = saved_state['%s_cache' % name]
+            spare = saved_state['%s_spare' % name]
+            if new_order.numel() == cache.size(1):
+                torch.index_select(cache[:cache_len], 1, new_order, out=spare[:cache_len])
+                saved_state['%s_cache' % name] = spare
+                saved_state['%s_spare' % name] = cache
+            else:
+                new_cache = cache.new(cache.size(0), new_order.numel(), cache.size(2))
+                new_cache[:cache_len] = cache[:cache_len].index_select(1, new_order)
+                saved_state['%s_cache' % name] = new_cache
+                saved_state['%s_spare' % name] = new_cache.new(new_cache.size())
@@ -0,0 +1,71 @@
+import torch
+import torch.nn.functional as F
+
+from .model import LatentState
+
+
+def filter_logits_(logits, top_k=0, top_p=1.):
+    """
+    Set (in place) the scores of words that cannot be sampled to -inf.
+    Input:
+        logits: (batch_size, n_words) unnormalized log-probs
+        top_k: only keep the `top_k` best words (0 to disable)
+        top_p: only keep the smallest set of best words with a cumulative
+               probability >= `top_p` (nucleus sampling, 1 to disable)
+    """
+    assert top_k >= 0 and 0 < top_p <= 1
+    if 0 < top_k < logits.size(1):
+        kth_best = logits.topk(top_k, 1)[0][:, -1:]
+        logits.masked_fill_(logits < kth_best, -float('inf'))
+    if top_p < 1:
+        sorted_logits, sorted_indices = logits.sort(1, descending=True)
+        cum_probs = F.softmax(sorted_logits, -1).cumsum(1)
+        # remove words once the cumulative probability is above top_p (the best word is always kept)
+        removed = cum_probs > top_p
+        removed[:, 1:] = removed[:, :-1].clone()
+        removed[:, 0] = 0
+        logits.masked_fill_(removed.scatter(1, sorted_indices, removed), -float('inf'))
+    return logits
+
+
+def sample_words(logits, n_samples=1, temperature=1., top_k=0, top_p=1.):
+    """
+    Sample words from the scores of a batch (modified in place).
+    Input:
+        logits: (batch_size, n_words) unnormalized log-probs
+    Output:
+        LongTensor of size (batch_size, n_samples), sampled words
+    """
+    assert temperature > 0
+    if temperature != 1:
+        logits.div_(temperature)
+    filter_logits_(logits, top_k, top_p)
+    return torch.multinomial(F.softmax(logits, -1), n_samples, replacement=True)
+
+
+def expand_encoded(encoded, n_samples):
+    """
+    Repeat each sentence of an encoded batch `n_samples` times (consecutively),
+    to generate several outputs for each source sentence in a single pass.
+    The discriminator input is not used by decoders, and is not expanded.
+    """
+    def expand(x, dim):
+        size = list(x.size())
+        x = x.unsqueeze(dim + 1).expand(*(size[:dim + 1] + [n_samples] + size[dim + 1:]))
+        size[dim] *= n_samples
+        return x.contiguous().view(*size)
+
+    dec_input = encoded.dec_input
+    if type(dec_input) is dict:
+        # transformer: encoder output (slen, bs, dim) / padding mask (bs, slen)
+        dec_input = {
+            'encoder_out': expand(dec_input['encoder_out'], 1),
+            'encoder_padding_mask': expand(dec_input['encoder_padding_mask'], 0),
+        }
+    elif dec_input.dim() == 3:
+        # attention: (slen, bs, dim)
+        dec_input = expand(dec_input, 1)
+    else:
+        # seq2seq: (bs, dim)
+        dec_input = expand(dec_input, 0)
+    return LatentState(input_len=expand(encoded.input_len, 0), dec_input=dec_input, dis_input=None)
@@ -1,13 +1,26 @@
+from collections import namedtuple
 import math
 
 import torch
 import torch.nn.functional as F
 
+from .data.dictionary import SPECIAL_WORDS
+from .sampling import sample_words
+
+
+# finalized hypotheses, sorted by decreasing score for each sentence:
+#   - tokens: LongTensor (bsz, nbest, max_len), without BOS, with EOS, pad after EOS
+#   - lengths: LongTensor (bsz, nbest), number of tokens (EOS included)
+#   - scores: FloatTensor (bsz, nbest), normalized / penalized scores
+#   - positional_scores: FloatTensor (bsz, nbest, max_len), log-probability of each token
+Hypotheses = namedtuple('Hypotheses', 'tokens, lengths, scores, positional_scores')
+
 
 class SequenceGenerator(object):
     def __init__(self, decoder, bos, pad, eos, vocab_size, beam_size=1,
                  minlen=1, maxlen=175, stop_early=True, normalize_scores=True,
-                 len_penalty=1, retain_dropout=False, sampling=False):
+                 len_penalty=1, coverage_penalty=0, retain_dropout=False, sampling=False,
+                 sampling_temperature=1., sampling_topk=0, sampling_topp=1.):
         """Generates translations of a given source sentence.
 
         Args:
@@ -17,6 +30,11 @@ class SequenceGenerator(object):
                 hypotheses, even though longer hypotheses might have better
                 normalized scores.
             normalize_scores: Normalize scores by the length of the output.
+            len_penalty: Scores are divided by length ** len_penalty.
+            coverage_penalty: Weight of the coverage penalty (sum over source
+                words of log(min(attention received, 1))), 0 to disable.
+            sampling: Sample hypotheses instead of running a beam search, with
+                the given temperature / top-k / top-p (see `sample_words`).
         """
         self.decoder = decoder
         self.bos = bos
@@ -29,15 +47,20 @@ class SequenceGenerator(object):
         self.stop_early = stop_early
         self.normalize_scores = normalize_scores
         self.len_penalty = len_penalty
+        self.coverage_penalty = coverage_penalty
         self.retain_dropout = retain_dropout
         self.sampling = sampling
+        self.sampling_temperature = sampling_temperature
+        self.sampling_topk = sampling_topk
+        self.sampling_topp = sampling_topp
 
     def cuda(self):
         self.decoder.cuda()
         return self
 
     def generate(self, src_lengths, encoded, lang_id, beam_size=None, maxlen=None, prefix_tokens=None):
-        """Generate a batch of translations."""
+        """Generate a batch of translations. Return the `beam_size` best
+        hypotheses of each sentence, packed in tensors (see `Hypotheses`)."""
         bsz = src_lengths.size(0)
         maxlen = min(maxlen, self.maxlen) if maxlen is not None else self.maxlen
 
@@ -45,7 +68,11 @@ class SequenceGenerator(object):
         beam_size = beam_size if beam_size is not None else self.beam_size
         beam_size = min(beam_size, self.vocab_size - 1)
 
+        # the encoder-decoder attention keys / values are computed once, and
+        # the self-attention keys / values of all steps are preallocated
         incremental_state = {}
+        self.decoder.allocate_kv_cache_(incremental_state, lang_id, bsz * beam_size, maxlen + 1)
+        self.decoder.precompute_encoder_kv_(encoded.dec_input, lang_id, incremental_state)
 
         # initialize buffers
         scores = src_lengths.new(bsz * beam_size, maxlen + 1).float().fill_(0)
@@ -54,12 +81,21 @@ class SequenceGenerator(object):
         tokens_buf = tokens.clone()
         tokens[:, 0] = self.bos
 
-        # list of completed sentences
-        finalized = [[] for i in range(bsz)]
-        finished = [False for i in range(bsz)]
-        worst_finalized = [{'idx': None, 'score': -math.inf} for i in range(bsz)]
+        # completed hypotheses, stored by original sentence index
+        finalized_tokens = tokens.new(bsz, beam_size, maxlen + 1).fill_(self.pad)
+        finalized_pos_scores = scores.new(bsz, beam_size, maxlen + 1).fill_(0)
+        finalized_scores = scores.new(bsz, beam_size).fill_(-math.inf)
+        finalized_lengths = tokens.new(bsz, beam_size).fill_(0)
+        num_finalized = tokens.new(bsz).fill_(0)
+        finished = tokens.new(bsz).fill_(0)
+        sent_ids = torch.arange(0, bsz).type_as(tokens)  # original index of the sentences in the batch
         num_remaining_sent = bsz
 
+        # attention received by each source word, for the coverage penalty
+        if self.coverage_penalty > 0:
+            src_len = encoded.dec_input['encoder_padding_mask'].size(1)
+            coverage = scores.new(bsz * beam_size, src_len).fill_(0)
+
         # number of candidate hypos per step
         cand_size = 2 * beam_size  # 2 x beam size in case half are EOS
 
@@ -74,25 +110,6 @@ class SequenceGenerator(object):
                 buffers[name] = type_of.new()
             return buffers[name]
 
-        def is_finished(sent, step, unfinalized_scores=None):
-            """
-            Check whether we've finished generation for a given sentence, by
-            comparing the worst score among finalized hypotheses to the best
-            possible score among unfinalized hypotheses.
-            """
-            assert len(finalized[sent]) <= beam_size
-            if len(finalized[sent]) == beam_size:
-                if self.stop_early or step == maxlen or unfinalized_scores is None:
-                    return True
-                # stop if the best unfinalized score is worse than the worst
-                # finalized one
-                best_unfinalized_score = unfinalized_scores[sent].max()
-                if self.normalize_scores:
-                    best_unfinalized_score /= maxlen
-                if worst_finalized[sent]['score'] >= best_unfinalized_score:
-                    return True
-            return False
-
         def finalize_hypos(step, bbsz_idx, eos_scores, unfinalized_scores=None):
             """
             Finalize the given hypotheses at this step, while keeping the total
@@ -108,8 +125,10 @@ class SequenceGenerator(object):
                     indicating which hypotheses to finalize
                 eos_scores: A vector of the same size as bbsz_idx containing
                     scores for each hypothesis
-                unfinalized_scores: A vector containing scores for all
-                    unfinalized hypotheses
+                unfinalized_scores: A matrix (bsz, cand_size) containing scores
+                    for all unfinalized hypotheses
+
+            Return the indices (in the current batch) of newly finished sentences.
             """
             assert bbsz_idx.numel() == eos_scores.numel()
 
@@ -124,54 +143,58 @@ class SequenceGenerator(object):
             # convert from cumulative to per-position scores
             pos_scores[:, 1:] = pos_scores[:, 1:] - pos_scores[:, :-1]
 
-            # normalize sentence-level scores
+            # normalize sentence-level scores, and add the coverage penalty
             if self.normalize_scores:
-                eos_scores /= (step + 1)**self.len_penalty
-
-            cum_unfin = []
-            prev = 0
-            for f in finished:
-                if f:
-                    prev += 1
-                else:
-                    cum_unfin.append(prev)
-
-            sents_seen = set()
-            for i, (idx, score) in enumerate(zip(bbsz_idx.tolist(), eos_scores.tolist())):
-                unfin_idx = idx // beam_size
-                sent = unfin_idx + cum_unfin[unfin_idx]
-
-                sents_seen.add((sent, unfin_idx))
-
-                def get_hypo():
-                    return {
-                        'tokens': tokens_clone[i],
-                        'score': score,
-                        'positional_scores': pos_scores[i],
-                    }
-
-                if len(finalized[sent]) < beam_size:
-                    finalized[sent].append(get_hypo())
-                elif not self.stop_early and score > worst_finalized[sent]['score']:
-                    # replace worst hypo for this sentence with new/better one
-                    worst_idx = worst_finalized[sent]['idx']
-                    if worst_idx is not None:
-                        finalized[sent][worst_idx] = get_hypo()
-
-                    # find new worst finalized hypo for this sentence
-                    idx, s = min(enumerate(finalized[sent]), key=lambda r: r[1]['score'])
-                    worst_finalized[sent] = {
-                        'score': s['score'],
-                        'idx': idx,
-                    }
-
-            newly_finished = []
-            for sent, unfin_idx in sents_seen:
-                # check termination conditions for this sentence
-                if not finished[sent] and is_finished(sent, step, unfinalized_scores):
-                    finished[sent] = True
-                    newly_finished.append(unfin_idx)
-            return newly_finished
+                eos_scores = eos_scores / (step + 1)**self.len_penalty
+            if self.coverage_penalty > 0:
+                padding_mask = encoded.dec_input['encoder_padding_mask'].index_select(0, bbsz_idx)
+                attn = coverage.index_select(0, bbsz_idx).masked_fill(padding_mask, 1)
+                eos_scores = eos_scores + self.coverage_penalty * attn.clamp(max=1).log().sum(1)
+
+            # position of each hypothesis among the finalized hypotheses of its
+            # sentence (hypotheses that appear earlier in the input come first)
+            unfin_idx = bbsz_idx // beam_size
+            sents = sent_ids[unfin_idx]
+            same_sent = sents.unsqueeze(0).eq(sents.unsqueeze(1)).type_as(tokens)
+            slots = num_finalized[sents] + same_sent.tril(-1).sum(1)
+
+            # store hypotheses while there are less than beam_size for their sentence
+            kept = slots.lt(beam_size).nonzero().view(-1)
+            if kept.numel() > 0:
+                kept_sents, kept_slots = sents[kept], slots[kept]
+                finalized_tokens[kept_sents, kept_slots, :step + 1] = tokens_clone[kept]
+                finalized_pos_scores[kept_sents, kept_slots, :step + 1] = pos_scores[kept]
+                finalized_scores[kept_sents, kept_slots] = eos_scores[kept]
+                finalized_lengths[kept_sents, kept_slots] = step + 1
+                num_finalized.index_add_(0, kept_sents, torch.ones_like(kept_sents))
+
+            # replace the worst hypothesis of full sentences with new / better ones
+            if not self.stop_early:
+                for i in slots.ge(beam_size).nonzero().view(-1).tolist():
+                    sent = sents[i]
+                    worst_score, worst_idx = finalized_scores[sent].min(0)
+                    if eos_scores[i] > worst_score:
+                        finalized_tokens[sent, worst_idx] = self.pad
+                        finalized_tokens[sent, worst_idx, :step + 1] = tokens_clone[i]
+                        finalized_pos_scores[sent, worst_idx] = 0
+                        finalized_pos_scores[sent, worst_idx, :step + 1] = pos_scores[i]
+                        finalized_scores[sent, worst_idx] = eos_scores[i]
+                        finalized_lengths[sent, worst_idx] = step + 1
+
+            # check termination conditions for the sentences seen
+            unfin_idx = torch.unique(unfin_idx)
+            sents = sent_ids[unfin_idx]
+            newly_finished = finished[sents].eq(0) & num_finalized[sents].eq(beam_size)
+            if not (self.stop_early or step == maxlen or unfinalized_scores is None):
+                # stop if the best unfinalized score is worse than the worst
+                # finalized one
+                best_unfinalized_score = unfinalized_scores[unfin_idx].max(1)[0]
+                if self.normalize_scores:
+                    best_unfinalized_score /= maxlen
+                worst_finalized_score = finalized_scores[sents].min(1)[0]
+                newly_finished &= worst_finalized_score >= best_unfinalized_score
+            finished[sents[newly_finished]] = 1
+            return unfin_idx[newly_finished].tolist()
 
         reorder_state = None
         batch_idxs = None
@@ -185,7 +208,9 @@ class SequenceGenerator(object):
                 self.decoder.reorder_incremental_state_(incremental_state, reorder_state)
                 self.decoder.reorder_encoder_out_(encoded.dec_input, reorder_state)
 
-            probs = self._decode(tokens[:, :step + 1].t(), encoded, lang_id, incremental_state)
+            probs, attn = self._decode(tokens[:, :step + 1].t(), encoded, lang_id, incremental_state)
+            if self.coverage_penalty > 0:
+                coverage.add_(attn)
             if step == 0:
                 # at the first step all hypotheses are equally likely, so use
                 # only the first beam
@@ -197,6 +222,12 @@ class SequenceGenerator(object):
                 probs.add_(scores[:, step - 1].unsqueeze(-1))
 
             probs[:, self.pad] = -math.inf  # never select pad
+            if self.sampling:
+                # never sample BOS words (<s>, id 0, and the language BOS) or
+                # special words (ids 4 to 3 + SPECIAL_WORDS), which are only inputs
+                probs[:, self.bos] = -math.inf
+                probs[:, 0] = -math.inf
+                probs[:, 4:4 + SPECIAL_WORDS] = -math.inf
 
             cand_scores = buffer('cand_scores', type_of=scores)
             cand_indices = buffer('cand_indices')
@@ -213,17 +244,13 @@ class SequenceGenerator(object):
                     cand_indices = prefix_tokens[:, step].view(-1, 1).expand(bsz, cand_size).data
                     cand_beams.resize_as_(cand_indices).fill_(0)
                 elif self.sampling:
-                    assert self.pad == 1, 'sampling assumes the first two symbols can be ignored'
-                    exp_probs = probs.exp_().view(-1, self.vocab_size)
-                    if step == 0:
-                        # we exclude the first two vocab items, one of which is pad
-                        torch.multinomial(exp_probs[:, 2:], beam_size, replacement=True, out=cand_indices)
-                        cand_indices.add_(2)
-                    else:
-                        torch.multinomial(exp_probs[:, 2:], 1, replacement=True, out=cand_indices)
-                        cand_indices.add_(2)
-                    torch.gather(exp_probs, dim=1, index=cand_indices, out=cand_scores)
-                    cand_scores.log_()
+                    # sample from a copy of the scores (filtered in place), and
+                    # keep the model log-probabilities as hypotheses scores
+                    cand_indices = sample_words(
+                        probs.clone(), beam_size if step == 0 else 1,
+                        self.sampling_temperature, self.sampling_topk, self.sampling_topp,
+                    )
+                    cand_scores = probs.gather(1, cand_indices)
                     cand_indices = cand_indices.view(bsz, -1).repeat(1, 2)
                     cand_scores = cand_scores.view(bsz, -1).repeat(1, 2)
                     if step == 0:
@@ -309,6 +336,9 @@ class SequenceGenerator(object):
                 cand_scores = cand_scores[batch_idxs]
                 cand_indices = cand_indices[batch_idxs]
 
+                sent_ids = sent_ids[batch_idxs]
+                if self.coverage_penalty > 0:
+                    coverage = coverage.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
                 scores = scores.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
                 scores_buf.resize_as_(scores)
                 tokens = tokens.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
@@ -374,15 +404,22 @@ class SequenceGenerator(object):
 
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
+            if self.coverage_penalty > 0:
+                coverage = coverage.index_select(0, active_bbsz_idx)
 
         # sort by score descending
-        for sent in range(len(finalized)):
-            finalized[sent] = sorted(finalized[sent], key=lambda r: r['score'], reverse=True)
-
-        return finalized
+        finalized_scores, order = finalized_scores.sort(1, descending=True)
+        max_len = finalized_lengths.max()
+        return Hypotheses(
+            tokens=finalized_tokens.gather(1, order.unsqueeze(2).expand_as(finalized_tokens))[:, :, :max_len],
+            lengths=finalized_lengths.gather(1, order),
+            scores=finalized_scores,
+            positional_scores=finalized_pos_scores.gather(1, order.unsqueeze(2).expand_as(finalized_pos_scores))[:, :, :max_len],
+        )
 
     def _decode(self, tokens, encoded, lang_id, incremental_state):
-        decoder_out = self.decoder(encoded, tokens, lang_id, incremental_state=incremental_state)
+        decoder_out, attn = self.decoder(encoded, tokens, lang_id, incremental_state=incremental_state, return_attn=True)
         decoder_out = decoder_out[-1, :, :]  # T x B x C -> B x C
+        attn = attn[:, -1, :]  # B x T x S -> B x S
         probs = F.log_softmax(decoder_out, dim=-1).data
-        return probs.contiguous()
+        return probs.contiguous(), attn.data
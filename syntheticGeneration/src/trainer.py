@@ -1,14 +1,17 @@
 import os
 import time
+from contextlib import nullcontext
 from logging import getLogger
 import numpy as np
 import torch
 from torch.nn import functional as F
 from torch.nn.utils import clip_grad_norm_
 
-from .utils import reverse_sentences, clip_parameters
+from .utils import reverse_sentences, clip_parameters, get_rng_states, set_rng_states
 from .utils import get_optimizer, parse_lambda_config, update_lambdas
-from .model import build_mt_model
+from .utils import get_flat_params, set_flat_params
+from .model import build_mt_model, concat_latent_states
+from .data.prefetcher import BatchPrefetcher
 from .multiprocessing_event_loop import MultiprocessingEventLoop
 from .test import test_sharing
 
@@ -55,6 +58,19 @@ class TrainerMT(MultiprocessingEventLoop):
         self.dis_optimizer = get_optimizer(discriminator.parameters(), params.dis_optimizer) if discriminator is not None else None
         self.lm_optimizer = get_optimizer(lm.parameters(), params.enc_optimizer) if lm is not None else None
 
+        # bfloat16 mixed precision
+        if params.bf16:
+            assert hasattr(torch, 'autocast'), "bfloat16 training requires torch >= 1.10"
+            assert params.device == 'cpu' or torch.cuda.is_bf16_supported()
+
+        # gradient accumulation (the language model shares parameters with the
+        # encoder / decoder, but has its own optimizer, and is updated separately)
+        assert params.update_freq >= 0
+        if params.update_freq > 0:
+            assert params.lm_after == 0, "--update_freq requires --lm_after 0"
+            assert params.otf_update_enc and params.otf_update_dec, \
+                "--update_freq requires --otf_update_enc True and --otf_update_dec True"
+
         # models / optimizers
         self.model_opt = {
             'enc': (self.encoder, self.enc_optimizer),
@@ -90,6 +106,9 @@ class TrainerMT(MultiprocessingEventLoop):
         self.best_metrics = {metric: -1e12 for metric in self.VALIDATION_METRICS}
         self.epoch = 0
         self.n_total_iter = 0
+        self.n_accumulated_steps = 0
+        self.n_accumulated_tokens = 0
+        self.accumulated_joint_clip = False
         self.freeze_enc_emb = self.params.freeze_enc_emb
         self.freeze_dec_emb = self.params.freeze_dec_emb
 
@@ -118,8 +137,9 @@ class TrainerMT(MultiprocessingEventLoop):
         if len(params.pivo_directions) > 0:
             self.gen_time = 0
 
-        # data iterators
+        # data iterators / iterators position
         self.iterators = {}
+        self.iterator_states = {}
 
         # initialize BPE subwords
         self.init_bpe()
@@ -145,21 +165,51 @@ class TrainerMT(MultiprocessingEventLoop):
     def get_iterator(self, iter_name, lang1, lang2, back):
         """
         Create a new iterator for a dataset.
+        The iterator goes over the dataset indefinitely, and yields each batch
+        with the epoch / batch cursor required to resume from it.
         """
         assert back is False or lang2 is not None
         key = ','.join([x for x in [iter_name, lang1, lang2] if x is not None]) + ('_back' if back else '')
-        logger.info("Creating new training %s iterator ..." % key)
         if lang2 is None:
             dataset = self.data['mono'][lang1]['train']
         elif back:
-            dataset = self.data['back'][(lang1, lang2)]
+            dataset = self.data['back'][(lang1, lang2)]['train']
         else:
             k = (lang1, lang2) if lang1 < lang2 else (lang2, lang1)
             dataset = self.data['para'][k]['train']
-        iterator = dataset.get_iterator(shuffle=True, group_by_size=self.params.group_by_size)()
+
+        # each epoch is shuffled with a seed derived from the iterator seed,
+        # so that it can be re-created from a checkpoint
+        if key not in self.iterator_states:
+            self.iterator_states[key] = {'seed': np.random.randint(1 << 31), 'epoch': 0, 'cursor': 0}
+        state = dict(self.iterator_states[key])
+
+        def iterator():
+            epoch, cursor = state['epoch'], state['cursor']
+            while True:
+                logger.info("Creating new training %s iterator (epoch %i, batch %i) ..." % (key, epoch, cursor))
+                for batch in dataset.get_iterator(shuffle=True, group_by_size=self.params.group_by_size,
+                                                  seed=[state['seed'], epoch], start_batch=cursor)():
+                    cursor += 1
+                    yield batch, epoch, cursor
+                epoch, cursor = epoch + 1, 0
+
+        if self.params.prefetch_batches > 0:
+            iterator = BatchPrefetcher(iterator, n_batches=self.params.prefetch_batches,
+                                       pin_memory=self.params.pin_memory)
+        else:
+            iterator = iterator()
         self.iterators[key] = iterator
         return iterator
 
+    def close_iterators(self):
+        """
+        Close the training iterators (and stop their prefetching threads).
+        """
+        for iterator in self.iterators.values():
+            iterator.close()
+        self.iterators = {}
+
     def get_batch(self, iter_name, lang1, lang2, back=False):
         """
         Return a batch of sentences from a dataset.
@@ -171,13 +221,19 @@ class TrainerMT(MultiprocessingEventLoop):
         iterator = self.iterators.get(key, None)
         if iterator is None:
             iterator = self.get_iterator(iter_name, lang1, lang2, back)
-        try:
-            batch = next(iterator)
-        except StopIteration:
-            iterator = self.get_iterator(iter_name, lang1, lang2, back)
-            batch = next(iterator)
+        batch, epoch, cursor = next(iterator)
+        self.iterator_states[key]['epoch'] = epoch
+        self.iterator_states[key]['cursor'] = cursor
         return batch if (lang2 is None or lang1 < lang2 or back) else batch[::-1]
 
+    def get_word_idx(self, x, lang_id):
+        """
+        Return the index of the word each BPE token belongs to, inside its sentence.
+        """
+        bpe_end = self.bpe_end[lang_id][x]
+        word_idx = bpe_end[::-1].cumsum(0)[::-1]
+        return word_idx.max(0)[None, :] - word_idx
+
     def word_shuffle(self, x, l, lang_id):
         """
         Randomly shuffle input words.
@@ -190,19 +246,20 @@ class TrainerMT(MultiprocessingEventLoop):
         noise[0] = -1  # do not move start sentence symbol
 
         # be sure to shuffle entire words
-        bpe_end = self.bpe_end[lang_id][x]
-        word_idx = bpe_end[::-1].cumsum(0)[::-1]
-        word_idx = word_idx.max(0)[None, :] - word_idx
+        word_idx = self.get_word_idx(x, lang_id)[:-1]
+        word_idx = np.minimum(word_idx, noise.shape[0] - 1)  # only padding goes out of range
 
         assert self.params.word_shuffle > 1
+        slen, bs = noise.shape
+        positions = np.arange(slen)[:, None]
+        scores = word_idx + noise[word_idx, np.arange(bs)[None, :]]
+        scores += 1e-6 * positions  # ensure no reordering inside a word
+        # EOS / padding positions keep their order, after the words
+        tail = positions >= (l.numpy() - 1)[None, :]
+        scores[tail] = 1e9 + np.broadcast_to(positions, scores.shape)[tail]
+        permutation = torch.from_numpy(scores.argsort(0))
         x2 = x.clone()
-        for i in range(l.size(0)):
-            # generate a random permutation
-            scores = word_idx[:l[i] - 1, i] + noise[word_idx[:l[i] - 1, i], i]
-            scores += 1e-6 * np.arange(l[i] - 1)  # ensure no reordering inside a word
-            permutation = scores.argsort()
-            # shuffle words
-            x2[:l[i] - 1, i].copy_(x2[:l[i] - 1, i][torch.from_numpy(permutation)])
+        x2[:-1] = x[:-1].gather(0, permutation)
         return x2, l
 
     def word_dropout(self, x, l, lang_id):
@@ -220,29 +277,29 @@ class TrainerMT(MultiprocessingEventLoop):
         keep[0] = 1  # do not drop the start sentence symbol
 
         # be sure to drop entire words
-        bpe_end = self.bpe_end[lang_id][x]
-        word_idx = bpe_end[::-1].cumsum(0)[::-1]
-        word_idx = word_idx.max(0)[None, :] - word_idx
-
-        sentences = []
-        lengths = []
-        for i in range(l.size(0)):
-            assert x[l[i] - 1, i] == self.params.eos_index
-            words = x[:l[i] - 1, i].tolist()
-            # randomly drop words from the input
-            new_s = [w for j, w in enumerate(words) if keep[word_idx[j, i], i]]
-            # we need to have at least one word in the sentence (more than the start / end sentence symbols)
-            if len(new_s) == 1:
-                new_s.append(words[np.random.randint(1, len(words))])
-            new_s.append(self.params.eos_index)
-            assert len(new_s) >= 3 and new_s[0] == bos_index and new_s[-1] == self.params.eos_index
-            sentences.append(new_s)
-            lengths.append(len(new_s))
+        word_idx = self.get_word_idx(x, lang_id)[:-1]
+        word_idx = np.minimum(word_idx, keep.shape[0] - 1)  # only padding goes out of range
+
+        bs = l.size(0)
+        assert (x[l - 1, torch.arange(bs)] == self.params.eos_index).all()
+        lengths = l.numpy()
+        keep = keep[word_idx, np.arange(bs)[None, :]]
+        keep &= np.arange(keep.shape[0])[:, None] < (lengths - 1)[None, :]
+        l2 = keep.sum(0) + 1
+
         # re-construct input
-        l2 = torch.LongTensor(lengths)
-        x2 = torch.LongTensor(l2.max(), l2.size(0)).fill_(self.params.pad_index)
-        for i in range(l2.size(0)):
-            x2[:l2[i], i].copy_(torch.LongTensor(sentences[i]))
+        rows = keep.cumsum(0) - 1
+        cols = np.broadcast_to(np.arange(bs)[None, :], keep.shape)
+        x2 = np.full((l2.max() + 1, bs), self.params.pad_index, dtype=np.int64)
+        x2[rows[keep], cols[keep]] = x[:-1].numpy()[keep]
+        # we need to have at least one word in the sentence (more than the start / end sentence symbols)
+        for i in np.nonzero(l2 == 2)[0]:
+            x2[1, i] = x[np.random.randint(1, lengths[i] - 1), i]
+            l2[i] += 1
+        x2[l2 - 1, np.arange(bs)] = self.params.eos_index
+        x2 = torch.from_numpy(x2[:l2.max()])
+        l2 = torch.from_numpy(l2)
+        assert l2.min() >= 3 and (x2[0] == bos_index).all()
         return x2, l2
 
     def word_blank(self, x, l, lang_id):
@@ -260,23 +317,15 @@ class TrainerMT(MultiprocessingEventLoop):
         keep[0] = 1  # do not blank the start sentence symbol
 
         # be sure to blank entire words
-        bpe_end = self.bpe_end[lang_id][x]
-        word_idx = bpe_end[::-1].cumsum(0)[::-1]
-        word_idx = word_idx.max(0)[None, :] - word_idx
-
-        sentences = []
-        for i in range(l.size(0)):
-            assert x[l[i] - 1, i] == self.params.eos_index
-            words = x[:l[i] - 1, i].tolist()
-            # randomly blank words from the input
-            new_s = [w if keep[word_idx[j, i], i] else self.params.blank_index for j, w in enumerate(words)]
-            new_s.append(self.params.eos_index)
-            assert len(new_s) == l[i] and new_s[0] == bos_index and new_s[-1] == self.params.eos_index
-            sentences.append(new_s)
-        # re-construct input
-        x2 = torch.LongTensor(l.max(), l.size(0)).fill_(self.params.pad_index)
-        for i in range(l.size(0)):
-            x2[:l[i], i].copy_(torch.LongTensor(sentences[i]))
+        word_idx = self.get_word_idx(x, lang_id)[:-1]
+        word_idx = np.minimum(word_idx, keep.shape[0] - 1)  # only padding goes out of range
+
+        bs = l.size(0)
+        assert (x[l - 1, torch.arange(bs)] == self.params.eos_index).all()
+        blank = ~keep[word_idx, np.arange(bs)[None, :]]
+        blank &= np.arange(blank.shape[0])[:, None] < (l.numpy() - 1)[None, :]
+        x2 = x.clone()
+        x2[:-1][torch.from_numpy(blank)] = self.params.blank_index
         return x2, l
 
     def add_noise(self, words, lengths, lang_id):
@@ -288,6 +337,18 @@ class TrainerMT(MultiprocessingEventLoop):
         words, lengths = self.word_blank(words, lengths, lang_id)
         return words, lengths
 
+    def autocast(self):
+        """
+        Context in which forward passes and losses are computed.
+        With --bf16, activations are computed in bfloat16, while parameters,
+        gradients and optimizer states stay in fp32 (master weights). Losses
+        are computed in fp32, and as bfloat16 has the same exponent range as
+        fp32, gradients do not underflow and losses are not scaled.
+        """
+        if not self.params.bf16:
+            return nullcontext()
+        return torch.autocast(device_type=torch.device(self.params.device).type, dtype=torch.bfloat16)
+
     def zero_grad(self, models):
         """
         Zero gradients.
@@ -299,23 +360,68 @@ class TrainerMT(MultiprocessingEventLoop):
             if optimizer is not None:
                 optimizer.zero_grad()
 
-    def update_params(self, models):
+    def update_params(self, models, joint_clip=False):
         """
-        Update parameters.
+        Update parameters. If `joint_clip` is set, the gradients of all
+        models are clipped together, instead of model by model.
         """
         if type(models) is not list:
             models = [models]
         # don't update encoder when it's frozen
         models = [self.model_opt[name] for name in models]
-        # clip gradients
-        for model, _ in models:
-            clip_grad_norm_(model.parameters(), self.params.clip_grad_norm)
+        # clip gradients (parameters shared between models are counted once)
+        if joint_clip:
+            parameters = {id(p): p for model, _ in models for p in model.parameters()}
+            clip_grad_norm_(list(parameters.values()), self.params.clip_grad_norm)
+        else:
+            for model, _ in models:
+                clip_grad_norm_(model.parameters(), self.params.clip_grad_norm)
 
         # optimizer
         for _, optimizer in models:
             if optimizer is not None:
                 optimizer.step()
 
+    def optimize(self, loss, models, n_tokens, joint_clip=False):
+        """
+        Back-propagate the loss (averaged over `n_tokens` target tokens) and
+        update the parameters. With --update_freq, the encoder / decoder
+        gradients are accumulated instead, weighted by the number of target
+        tokens, and the parameters are updated every `update_freq` calls
+        (with a joint clipping only if all the accumulated steps requested it).
+        """
+        if self.params.update_freq == 0:
+            self.zero_grad(models)
+            loss.backward()
+            self.update_params(models, joint_clip=joint_clip)
+        else:
+            assert set(models) == {'enc', 'dec'}
+            if self.n_accumulated_steps == 0:
+                self.zero_grad(models)
+                self.accumulated_joint_clip = joint_clip
+            self.accumulated_joint_clip = self.accumulated_joint_clip and joint_clip
+            (loss * n_tokens).backward()
+            self.n_accumulated_steps += 1
+            self.n_accumulated_tokens += n_tokens
+            if self.n_accumulated_steps == self.params.update_freq:
+                self.update_accumulated_params()
+
+    def update_accumulated_params(self):
+        """
+        Normalize the accumulated gradients by the number
+        of target tokens, and update the encoder / decoder.
+        """
+        models = ['enc', 'dec']
+        if self.n_accumulated_tokens > 0:
+            # encoder / decoder parameters can be shared: normalize them once
+            parameters = {id(p): p for name in models for p in self.model_opt[name][0].parameters()}
+            for p in parameters.values():
+                if p.grad is not None:
+                    p.grad.data.div_(self.n_accumulated_tokens)
+            self.update_params(models, joint_clip=self.accumulated_joint_clip)
+        self.n_accumulated_steps = 0
+        self.n_accumulated_tokens = 0
+
     def get_lrs(self, models):
         """
         Get current optimizer learning rates.
@@ -346,7 +452,7 @@ class TrainerMT(MultiprocessingEventLoop):
         for lang_id, lang in enumerate(self.params.langs):
             sent1, len1 = self.get_batch('dis', lang, None)
             with torch.no_grad():
-                encoded.append(self.encoder(sent1.cuda(), len1, lang_id))
+                encoded.append(self.encoder(sent1.to(self.params.device, non_blocking=True), len1, lang_id))
 
         # discriminator
         dis_inputs = [x.dis_input.view(-1, x.dis_input.size(-1)) for x in encoded]
@@ -356,7 +462,7 @@ class TrainerMT(MultiprocessingEventLoop):
 
         # loss
         self.dis_target = torch.cat([torch.zeros(sz).fill_(i) for i, sz in enumerate(ntokens)])
-        self.dis_target = self.dis_target.contiguous().long().cuda()
+        self.dis_target = self.dis_target.contiguous().long().to(self.params.device)
         y = self.dis_target
 
         loss = F.cross_entropy(predictions, y)
@@ -383,33 +489,35 @@ class TrainerMT(MultiprocessingEventLoop):
 
         # batch
         sent1, len1 = self.get_batch('lm', lang, None)
-        sent1 = sent1.cuda()
+        sent1 = sent1.to(self.params.device, non_blocking=True)
         if self.lm.use_lm_enc_rev:
             sent1_rev = reverse_sentences(sent1, len1)
 
-        # forward
-        if self.lm.use_lm_enc:
-            scores_enc = self.lm(sent1[:-1], len1 - 1, lang_id, True, False)
-        if self.lm.use_lm_dec:
-            scores_dec = self.lm(sent1[:-1], len1 - 1, lang_id, False, False)
-        if self.lm.use_lm_enc_rev:
-            scores_enc_rev = self.lm(sent1_rev[:-1], len1 - 1, lang_id, True, True)
-
-        # loss
-        loss = 0
-        if self.lm.use_lm_enc:
-            loss_enc = loss_fn(scores_enc.view(-1, n_words), sent1[1:].view(-1))
-            self.stats['lme_costs_%s' % lang].append(loss_enc.item())
-            loss += loss_enc
-        if self.lm.use_lm_dec:
-            loss_dec = loss_fn(scores_dec.view(-1, n_words), sent1[1:].view(-1))
-            self.stats['lmd_costs_%s' % lang].append(loss_dec.item())
-            loss += loss_dec
-        if self.lm.use_lm_enc_rev:
-            loss_enc_rev = loss_fn(scores_enc_rev.view(-1, n_words), sent1_rev[1:].view(-1))
-            self.stats['lmer_costs_%s' % lang].append(loss_enc_rev.item())
-            loss += loss_enc_rev
-        loss = self.params.lambda_lm * loss
+        with self.autocast():
+
+            # forward
+            if self.lm.use_lm_enc:
+                scores_enc = self.lm(sent1[:-1], len1 - 1, lang_id, True, False)
+            if self.lm.use_lm_dec:
+                scores_dec = self.lm(sent1[:-1], len1 - 1, lang_id, False, False)
+            if self.lm.use_lm_enc_rev:
+                scores_enc_rev = self.lm(sent1_rev[:-1], len1 - 1, lang_id, True, True)
+
+            # loss
+            loss = 0
+            if self.lm.use_lm_enc:
+                loss_enc = loss_fn(scores_enc.view(-1, n_words).float(), sent1[1:].view(-1))
+                self.stats['lme_costs_%s' % lang].append(loss_enc.item())
+                loss += loss_enc
+            if self.lm.use_lm_dec:
+                loss_dec = loss_fn(scores_dec.view(-1, n_words).float(), sent1[1:].view(-1))
+                self.stats['lmd_costs_%s' % lang].append(loss_dec.item())
+                loss += loss_dec
+            if self.lm.use_lm_enc_rev:
+                loss_enc_rev = loss_fn(scores_enc_rev.view(-1, n_words).float(), sent1_rev[1:].view(-1))
+                self.stats['lmer_costs_%s' % lang].append(loss_enc_rev.item())
+                loss += loss_enc_rev
+            loss = self.params.lambda_lm * loss
 
         # check NaN
         if (loss != loss).data.any():
@@ -425,6 +533,39 @@ class TrainerMT(MultiprocessingEventLoop):
         self.stats['processed_s'] += len1.size(0)
         self.stats['processed_w'] += len1.sum()
 
+    def get_enc_dec_batch(self, lang1, lang2, back=False):
+        """
+        Get an encoder / decoder training batch, add noise
+        to the encoder input if the direction is autoencoding.
+        """
+        params = self.params
+        lang1_id = params.lang2id[lang1]
+        if back:
+            (sent1, len1), (sent2, len2) = self.get_batch('encdec', lang1, lang2, back=True)
+        elif lang1 == lang2:
+            sent1, len1 = self.get_batch('encdec', lang1, None)
+            sent2, len2 = sent1, len1
+        else:
+            (sent1, len1), (sent2, len2) = self.get_batch('encdec', lang1, lang2)
+
+        # prepare the encoder / decoder inputs
+        if lang1 == lang2:
+            sent1, len1 = self.add_noise(sent1, len1, lang1_id)
+        sent1, sent2 = sent1.to(params.device, non_blocking=True), sent2.to(params.device, non_blocking=True)
+        return sent1, len1, sent2, len2
+
+    def dis_feedback_loss(self, encoded, lang_id):
+        """
+        Loss of the encoder on the discriminator feedback
+        (the discriminator has to predict a wrong language).
+        """
+        params = self.params
+        predictions = self.discriminator(encoded.dis_input.view(-1, encoded.dis_input.size(-1)))
+        fake_y = torch.LongTensor(predictions.size(0)).random_(1, params.n_langs)
+        fake_y = (fake_y + lang_id) % params.n_langs
+        fake_y = fake_y.to(params.device)
+        return F.cross_entropy(predictions.float(), fake_y)
+
     def enc_dec_step(self, lang1, lang2, lambda_xe, back=False):
         """
         Source / target autoencoder training (parallel data):
@@ -444,44 +585,31 @@ class TrainerMT(MultiprocessingEventLoop):
             self.discriminator.eval()
 
         # batch
-        if back:
-            (sent1, len1), (sent2, len2) = self.get_batch('encdec', lang1, lang2, back=True)
-        elif lang1 == lang2:
-            sent1, len1 = self.get_batch('encdec', lang1, None)
-            sent2, len2 = sent1, len1
-        else:
-            (sent1, len1), (sent2, len2) = self.get_batch('encdec', lang1, lang2)
+        sent1, len1, sent2, len2 = self.get_enc_dec_batch(lang1, lang2, back)
 
-        # prepare the encoder / decoder inputs
-        if lang1 == lang2:
-            sent1, len1 = self.add_noise(sent1, len1, lang1_id)
-        sent1, sent2 = sent1.cuda(), sent2.cuda()
+        with self.autocast():
 
-        # encoded states
-        encoded = self.encoder(sent1, len1, lang1_id)
-        self.stats['enc_norms_%s' % lang1].append(encoded.dis_input.data.norm(2, 1).mean().item())
+            # encoded states
+            encoded = self.encoder(sent1, len1, lang1_id)
+            self.stats['enc_norms_%s' % lang1].append(encoded.dis_input.data.float().norm(2, 1).mean().item())
 
-        # cross-entropy scores / loss
-        scores = self.decoder(encoded, sent2[:-1], lang2_id)
-        xe_loss = loss_fn(scores.view(-1, n_words), sent2[1:].view(-1))
-        if back:
-            self.stats['xe_costs_bt_%s_%s' % (lang1, lang2)].append(xe_loss.item())
-        else:
-            self.stats['xe_costs_%s_%s' % (lang1, lang2)].append(xe_loss.item())
-
-        # discriminator feedback loss
-        if params.lambda_dis:
-            predictions = self.discriminator(encoded.dis_input.view(-1, encoded.dis_input.size(-1)))
-            fake_y = torch.LongTensor(predictions.size(0)).random_(1, params.n_langs)
-            fake_y = (fake_y + lang1_id) % params.n_langs
-            fake_y = fake_y.cuda()
-            dis_loss = F.cross_entropy(predictions, fake_y)
-
-        # total loss
-        assert lambda_xe > 0
-        loss = lambda_xe * xe_loss
-        if params.lambda_dis:
-            loss = loss + params.lambda_dis * dis_loss
+            # cross-entropy scores / loss
+            scores = self.decoder(encoded, sent2[:-1], lang2_id)
+            xe_loss = loss_fn(scores.view(-1, n_words).float(), sent2[1:].view(-1))
+            if back:
+                self.stats['xe_costs_bt_%s_%s' % (lang1, lang2)].append(xe_loss.item())
+            else:
+                self.stats['xe_costs_%s_%s' % (lang1, lang2)].append(xe_loss.item())
+
+            # discriminator feedback loss
+            if params.lambda_dis:
+                dis_loss = self.dis_feedback_loss(encoded, lang1_id)
+
+            # total loss
+            assert lambda_xe > 0
+            loss = lambda_xe * xe_loss
+            if params.lambda_dis:
+                loss = loss + params.lambda_dis * dis_loss
 
         # check NaN
         if (loss != loss).data.any():
@@ -489,14 +617,99 @@ class TrainerMT(MultiprocessingEventLoop):
             exit()
 
         # optimizer
-        self.zero_grad(['enc', 'dec'])
-        loss.backward()
-        self.update_params(['enc', 'dec'])
+        self.optimize(loss, ['enc', 'dec'], (len2 - 1).sum().item())
 
         # number of processed sentences / words
         self.stats['processed_s'] += len2.size(0)
         self.stats['processed_w'] += len2.sum()
 
+    def enc_dec_fused_step(self, directions):
+        """
+        Encoder / decoder training on several directions at once.
+        `directions` is a list of (lang1, lang2, lambda_xe, back) tuples.
+        Each batch is encoded separately, but the batches with the same target
+        language are decoded in a single forward pass. The losses of all
+        directions are back-propagated together, and the parameters are
+        updated once (the encoder / decoder gradients are clipped together).
+        """
+        params = self.params
+        assert len(directions) > 0
+        self.encoder.train()
+        self.decoder.train()
+        if self.discriminator is not None:
+            self.discriminator.eval()
+
+        # batches, grouped by target language
+        batches = {}
+        for lang1, lang2, lambda_xe, back in directions:
+            assert lang1 in params.langs and lang2 in params.langs
+            assert lambda_xe > 0
+            sent1, len1, sent2, len2 = self.get_enc_dec_batch(lang1, lang2, back)
+            batches.setdefault(lang2, []).append((lang1, lambda_xe, back, sent1, len1, sent2, len2))
+
+        losses = []
+        n_tokens = []
+        with self.autocast():
+
+            for lang2, group in batches.items():
+                lang2_id = params.lang2id[lang2]
+                loss_fn = self.decoder.loss_fn[lang2_id]
+                n_words = params.n_words[lang2_id]
+
+                # encoded states
+                encoded = []
+                dis_losses = []
+                for lang1, lambda_xe, back, sent1, len1, _, _ in group:
+                    lang1_id = params.lang2id[lang1]
+                    _encoded = self.encoder(sent1, len1, lang1_id)
+                    self.stats['enc_norms_%s' % lang1].append(_encoded.dis_input.data.float().norm(2, 1).mean().item())
+                    if params.lambda_dis:
+                        dis_losses.append(self.dis_feedback_loss(_encoded, lang1_id))
+                    encoded.append(_encoded)
+
+                # decode all the batches at once (targets are padded to the same length)
+                sent2 = [x[5] for x in group]
+                max_len2 = max(x.size(0) for x in sent2)
+                sent2 = torch.cat([
+                    torch.cat([x, x.new_full((max_len2 - x.size(0), x.size(1)), params.pad_index)], 0)
+                    for x in sent2
+                ], 1)
+                scores = self.decoder(concat_latent_states(encoded), sent2[:-1], lang2_id)
+
+                # cross-entropy loss of each direction
+                bs = 0
+                for i, (lang1, lambda_xe, back, _, _, _sent2, len2) in enumerate(group):
+                    _scores = scores[:_sent2.size(0) - 1, bs:bs + len2.size(0)]
+                    bs += len2.size(0)
+                    xe_loss = loss_fn(_scores.contiguous().view(-1, n_words).float(), _sent2[1:].view(-1))
+                    if back:
+                        self.stats['xe_costs_bt_%s_%s' % (lang1, lang2)].append(xe_loss.item())
+                    else:
+                        self.stats['xe_costs_%s_%s' % (lang1, lang2)].append(xe_loss.item())
+                    loss = lambda_xe * xe_loss
+                    if params.lambda_dis:
+                        loss = loss + params.lambda_dis * dis_losses[i]
+                    losses.append(loss)
+                    n_tokens.append((len2 - 1).sum().item())
+
+                    # number of processed sentences / words
+                    self.stats['processed_s'] += len2.size(0)
+                    self.stats['processed_w'] += len2.sum()
+
+            # total loss (with --update_freq, averaged over target tokens)
+            if params.update_freq == 0:
+                loss = sum(losses)
+            else:
+                loss = sum(l * n for l, n in zip(losses, n_tokens)) / sum(n_tokens)
+
+        # check NaN
+        if (loss != loss).data.any():
+            logger.error("NaN detected")
+            exit()
+
+        # optimizer
+        self.optimize(loss, ['enc', 'dec'], sum(n_tokens), joint_clip=True)
+
     def otf_start_multiprocessing(self):
         logger.info("Starting subprocesses for OTF generation ...")
 
@@ -511,17 +724,13 @@ class TrainerMT(MultiprocessingEventLoop):
         params = deepcopy(params)
         self.params = params
         self.params.cpu_thread = True
+        self.params.device = 'cpu'
         self.data = None  # do not load data in the CPU threads
         self.iterators = {}
-        self.encoder, self.decoder, _, _ = build_mt_model(self.params, self.data, cuda=False)
+        self.encoder, self.decoder, _, _ = build_mt_model(self.params, self.data, device='cpu')
 
     def otf_sync_params(self):
         # logger.info("Syncing encoder and decoder params for OTF generation ...")
-
-        def get_flat_params(module):
-            return torch._utils._flatten_dense_tensors(
-                [p.data for p in module.parameters()])
-
         encoder_params = get_flat_params(self.encoder).cpu().share_memory_()
         decoder_params = get_flat_params(self.decoder).cpu().share_memory_()
 
@@ -530,12 +739,6 @@ class TrainerMT(MultiprocessingEventLoop):
                             decoder_params=decoder_params)
 
     def _async_otf_sync_params(self, rank, device_id, encoder_params, decoder_params):
-
-        def set_flat_params(module, flat):
-            params = [p.data for p in module.parameters()]
-            for p, f in zip(params, torch._utils._unflatten_dense_tensors(flat, params)):
-                p.copy_(f)
-
         # copy parameters back into modules
         set_flat_params(self.encoder, encoder_params)
         set_flat_params(self.decoder, decoder_params)
@@ -623,7 +826,16 @@ class TrainerMT(MultiprocessingEventLoop):
                     sent2, len2, _ = self.decoder.generate(encoded, lang_id=lang2_id, max_len=max_len)
                 else:
                     sent2, len2, _ = self.decoder.generate(encoded, lang_id=lang2_id, max_len=max_len,
-                                                           sample=True, temperature=params.otf_sample)
+                                                           sample=True, temperature=params.otf_sample,
+                                                           top_k=params.otf_sample_topk, top_p=params.otf_sample_topp,
+                                                           n_samples=params.otf_n_samples)
+
+                # several samples per sentence: repeat source / target sentences accordingly
+                if params.otf_n_samples > 1:
+                    bs = len1.size(0)
+                    idx = torch.arange(bs).long().view(-1, 1).expand(bs, params.otf_n_samples).contiguous().view(-1)
+                    sent1, len1 = sent1.index_select(1, idx), len1.index_select(0, idx)
+                    sent3, len3 = sent3.index_select(1, idx), len3.index_select(0, idx)
 
                 # keep cached batches on CPU for easier transfer
                 assert not any(x.is_cuda for x in [sent1, sent2, sent3])
@@ -658,30 +870,32 @@ class TrainerMT(MultiprocessingEventLoop):
         self.decoder.train()
 
         # prepare batch
-        sent1, sent2, sent3 = sent1.cuda(), sent2.cuda(), sent3.cuda()
+        sent1, sent2, sent3 = sent1.to(params.device), sent2.to(params.device), sent3.to(params.device)
         bs = sent1.size(1)
 
-        if backprop_temperature == -1:
-            # lang2 -> lang3
-            encoded = self.encoder(sent2, len2, lang_id=lang2_id)
-        else:
-            # lang1 -> lang2
-            encoded = self.encoder(sent1, len1, lang_id=lang1_id)
-            scores = self.decoder(encoded, sent2[:-1], lang_id=lang2_id)
-            assert scores.size() == (len2.max() - 1, bs, n_words2)
-
-            # lang2 -> lang3
-            bos = torch.cuda.FloatTensor(1, bs, n_words2).zero_()
-            bos[0, :, params.bos_index[lang2_id]] = 1
-            sent2_input = torch.cat([bos, F.softmax(scores / backprop_temperature, -1)], 0)
-            encoded = self.encoder(sent2_input, len2, lang_id=lang2_id)
-
-        # cross-entropy scores / loss
-        scores = self.decoder(encoded, sent3[:-1], lang_id=lang3_id)
-        xe_loss = loss_fn(scores.view(-1, n_words3), sent3[1:].view(-1))
-        self.stats['xe_costs_%s_%s_%s' % direction].append(xe_loss.item())
-        assert lambda_xe > 0
-        loss = lambda_xe * xe_loss
+        with self.autocast():
+
+            if backprop_temperature == -1:
+                # lang2 -> lang3
+                encoded = self.encoder(sent2, len2, lang_id=lang2_id)
+            else:
+                # lang1 -> lang2
+                encoded = self.encoder(sent1, len1, lang_id=lang1_id)
+                scores = self.decoder(encoded, sent2[:-1], lang_id=lang2_id)
+                assert scores.size() == (len2.max() - 1, bs, n_words2)
+
+                # lang2 -> lang3
+                bos = torch.zeros(1, bs, n_words2, device=params.device)
+                bos[0, :, params.bos_index[lang2_id]] = 1
+                sent2_input = torch.cat([bos, F.softmax(scores.float() / backprop_temperature, -1)], 0)
+                encoded = self.encoder(sent2_input, len2, lang_id=lang2_id)
+
+            # cross-entropy scores / loss
+            scores = self.decoder(encoded, sent3[:-1], lang_id=lang3_id)
+            xe_loss = loss_fn(scores.view(-1, n_words3).float(), sent3[1:].view(-1))
+            self.stats['xe_costs_%s_%s_%s' % direction].append(xe_loss.item())
+            assert lambda_xe > 0
+            loss = lambda_xe * xe_loss
 
         # check NaN
         if (loss != loss).data.any():
@@ -695,9 +909,7 @@ class TrainerMT(MultiprocessingEventLoop):
             to_update.append('enc')
         if params.otf_update_dec:
             to_update.append('dec')
-        self.zero_grad(to_update)
-        loss.backward()
-        self.update_params(to_update)
+        self.optimize(loss, to_update, (len3 - 1).sum().item())
 
         # number of processed sentences / words
         self.stats['processed_s'] += len3.size(0)
@@ -795,6 +1007,8 @@ class TrainerMT(MultiprocessingEventLoop):
             'n_total_iter': self.n_total_iter,
             'best_metrics': self.best_metrics,
             'best_stopping_criterion': self.best_stopping_criterion,
+            'iterator_states': self.iterator_states,
+            'rng_states': get_rng_states(),
         }
         checkpoint_path = os.path.join(self.params.dump_path, 'checkpoint.pth')
         logger.info("Saving checkpoint to %s ..." % checkpoint_path)
@@ -809,7 +1023,9 @@ class TrainerMT(MultiprocessingEventLoop):
         if not os.path.isfile(checkpoint_path):
             return
         logger.warning('Reloading checkpoint from %s ...' % checkpoint_path)
-        checkpoint_data = torch.load(checkpoint_path)
+        # random generator states must stay on CPU, only remap GPU checkpoints to CPU
+        map_location = 'cpu' if self.params.device == 'cpu' else None
+        checkpoint_data = torch.load(checkpoint_path, map_location=map_location)
         self.encoder = checkpoint_data['encoder']
         self.decoder = checkpoint_data['decoder']
         self.discriminator = checkpoint_data['discriminator']
@@ -822,6 +1038,11 @@ class TrainerMT(MultiprocessingEventLoop):
         self.n_total_iter = checkpoint_data['n_total_iter']
         self.best_metrics = checkpoint_data['best_metrics']
         self.best_stopping_criterion = checkpoint_data['best_stopping_criterion']
+        # older checkpoints do not store the data iterators position
+        if 'iterator_states' in checkpoint_data:
+            self.iterator_states = checkpoint_data['iterator_states']
+            self.close_iterators()
+            set_rng_states(checkpoint_data['rng_states'])
         self.model_opt = {
             'enc': (self.encoder, self.enc_optimizer),
             'dec': (self.decoder, self.dec_optimizer),
@@ -48,6 +48,7 @@ def initialize_exp(params, logger_filename='train.log'):
     - dump parameters
     - create a logger
     - set the random seed
+    - set the device / number of CPU threads
     """
     # dump parameters
     get_dump_path(params)
@@ -71,6 +72,13 @@ def initialize_exp(params, logger_filename='train.log'):
         torch.manual_seed(params.seed)
         torch.cuda.manual_seed(params.seed)
 
+    # device / number of CPU threads
+    assert params.device == 'cpu' or params.device.startswith('cuda')
+    assert params.device == 'cpu' or torch.cuda.is_available(), "CUDA is not available, use --device cpu"
+    assert params.n_threads >= 0
+    if params.n_threads > 0:
+        torch.set_num_threads(params.n_threads)
+
     # environment variables
     if 'pivo_directions' in params and len(params.pivo_directions) > 0:
         os.environ["OMP_NUM_THREADS"] = "2"
@@ -86,6 +94,29 @@ def initialize_exp(params, logger_filename='train.log'):
     return logger
 
 
+def get_rng_states():
+    """
+    Return the state of the python / numpy / torch random generators.
+    """
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_states(states):
+    """
+    Restore random generators states saved with `get_rng_states`.
+    """
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if states['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
 def get_dump_path(params):
     """
     Create a directory to store the experiment.
@@ -252,6 +283,22 @@ def get_grad_norm(model):
     return np.sqrt(norm)
 
 
+def get_flat_params(module):
+    """
+    Return the parameters of a module, flattened in a single tensor.
+    """
+    return torch._utils._flatten_dense_tensors([p.data for p in module.parameters()])
+
+
+def set_flat_params(module, flat):
+    """
+    Copy flattened parameters (see `get_flat_params`) back into a module.
+    """
+    params = [p.data for p in module.parameters()]
+    for p, f in zip(params, torch._utils._unflatten_dense_tensors(flat, params)):
+        p.copy_(f)
+
+
 def parse_lambda_config(params, name):
     """
     Parse the configuration of lambda coefficient (for scheduling).
@@ -308,26 +355,25 @@ def update_lambdas(params, n_total_iter):
         params.lambda_lm = update_lambda_value(params.lambda_lm_config, n_total_iter)
 
 
-def get_mask(lengths, all_words, expand=None, ignore_first=False, batch_first=False, cuda=True):
+def get_mask(lengths, all_words, expand=None, ignore_first=False, batch_first=False, device=None):
     """
-    Create a mask of shape (slen, bs) or (bs, slen).
+    Create a mask of shape (slen, bs) or (bs, slen), on `device`
+    (by default, the device of `lengths`).
     """
-    bs, slen = lengths.size(0), lengths.max()
-    mask = torch.ByteTensor(slen, bs).zero_()
-    for i in range(bs):
-        if all_words:
-            mask[:lengths[i], i] = 1
-        else:
-            mask[lengths[i] - 1, i] = 1
+    bs, slen = lengths.size(0), int(lengths.max())
+    lengths = lengths.to(device) if device is not None else lengths
+    positions = torch.arange(slen, device=lengths.device)[:, None]
+    if all_words:
+        mask = positions < lengths[None]
+    else:
+        mask = positions == (lengths - 1)[None]
+    if ignore_first:
+        mask[0] = 0
     if expand is not None:
         assert type(expand) is int
         mask = mask.unsqueeze(2).expand(slen, bs, expand)
-    if ignore_first:
-        mask[0].fill_(0)
     if batch_first:
         mask = mask.transpose(0, 1)
-    if cuda:
-        mask = mask.cuda()
     return mask
 
 
@@ -337,11 +383,12 @@ def reverse_sentences(batch, lengths):
     """
     bs = lengths.size(0)
     assert batch.size(1) == bs
-    new_batch = batch.clone()
-    inv_idx = torch.arange(lengths.max() - 1, -1, -1)
-    for i in range(bs):
-        new_batch[:lengths[i], i].copy_(new_batch[:, i][inv_idx[-lengths[i]:]])
-    return new_batch
+    lengths = lengths.to(batch.device)
+    positions = torch.arange(batch.size(0), device=batch.device)[:, None]
+    reversed_positions = lengths[None] - 1 - positions
+    # padding words stay in place
+    index = torch.where(positions < lengths[None], reversed_positions, positions)
+    return batch.gather(0, index)
 
 
 def restore_segmentation(path):
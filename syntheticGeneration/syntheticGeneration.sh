@@ -4,10 +4,11 @@ DATA_DIR="./data"
 INPUT_HI_FILE="$DATA_DIR/Translate/input_hindi.txt"
 OUTPUT_HINGLISH_FILE="synthetic_hinglish_sentences.txt"
 MODEL_DIR='./data/mt.256.model'
+VOCAB_FILE="$DATA_DIR/vocab.all"
  
 
-# Run translation script
-python3 translate.py \
+# Run translation script (the model parameters must match the trained model)
+python3 syntheticGeneration_Translate.py \
 --exp_name translate_hindi_to_hinglish \
 --transformer True \
 --n_enc_layers 3 \
@@ -18,20 +19,8 @@ python3 translate.py \
 --share_output_emb True \
 --emb_dim 256 \
 --langs 'en,hi' \
---mono_directions 'en,hi' \
---word_shuffle 0 \
---word_dropout 0 \
---word_blank 0 \
---pretrained_out True \
---lambda_xe_mono 1 \
---lambda_xe_otfd 1 \
---otf_num_processes 30 \
---enc_optimizer adam,lr=0.0001 \
---group_by_size True \
 --batch_size 16 \
---epoch_size 200000 \
---freeze_enc_emb False \
---freeze_dec_emb False \
+--dico_path $VOCAB_FILE \
 --reload_model $MODEL_DIR/model.pth \
 --reload_enc True \
 --reload_dec True \
@@ -1,127 +1,146 @@
+import re
+import sys
 import time
-import json
-import argparse
-import torch
-from indicnlp.normalize.indic_normalize import DevanagariNormalizer
-from src.data.loader import check_all_data_params, load_data
+from itertools import islice
+from logging import getLogger
+import numpy as np
+
+from src.data.loader import check_dico_params, load_dictionaries
 from src.utils import bool_flag, initialize_exp
 from src.model import check_mt_model_params, build_mt_model
-from src.trainer import TrainerMT
-from src.evaluator import EvaluatorMT
-from indicnlp.tokenize import indic_tokenize  
-
-
-def preprocess_sentences(input_hi):
-    normalizer = DevanagariNormalizer()
-    
-    hi_data = []
-    
-    with open(input_hi, 'r', encoding='utf-8') as hi_reader:
-        for line in hi_reader:
-            line=line.strip()
-            hi_data.append(line)
-            
-    for i in range(len(hi_data)):
-        hi_data[i] = normalizer.normalize(hi_data[i])
-    
-    return hi_data
-
-
-def encode_input_sentences(input_hi, encoder_model):
-    # Tokenize input sentences
-  
-    preprocessed_sentences = preprocess_sentences(input_hi)
-    
-    # Encode input sentences
-    encoded_sentences = []
-    for sentence in preprocessed_sentences:
-        sentence_tensor = torch.LongTensor(sentence).unsqueeze(1)  # Add batch dimension
-        if torch.cuda.is_available():
-            sentence_tensor = sentence_tensor.cuda()
-        encoded_output = encoder_model(sentence_tensor)
-        encoded_sentences.append(encoded_output)
-    
-    return encoded_sentences
-
-
-def translate_sentence(encoder_output, decoder, lang_id=4, max_length=100):
-    """
-    Translate a single sentence.
-    Args:
-        encoder_output: Encoded representation of the input sentence.
-        decoder: Decoder model.
-        lang_id: Language ID of the target language.
-        max_length: Maximum length of the output sentence.
-    Returns:
-        translated_sentence: Translated sentence.
-    """
-    # Initialize the decoder input with the encoded representation
-    decoder_input = encoder_output.dec_input
-    input_length = encoder_output.input_len
-    batch_size = encoder_output.input_len.size(0)
+from src.inference import translate, InferencePool
+from src.params import get_parser
 
-    # Initialize an empty tensor to store the decoded sentence
-    decoded_words = torch.zeros(max_length, batch_size, dtype=torch.long)
-    decoded_words[0] = decoder.bos_index[lang_id]
 
-    # Initialize hidden states
-    hidden = None
+logger = getLogger()
 
-    # Iterate through each step of decoding
-    for t in range(1, max_length):
-        # Forward pass through the decoder
-        scores = decoder.forward(encoder_output, decoded_words[:t], lang_id)
 
-        # Get the index of the word with the highest score
-        top_scores, top_indices = scores[-1].topk(1)
+def get_preprocessor(params):
+    """
+    Return a function that normalizes / tokenizes an input line.
+    """
+    normalizer = None
+    if params.normalize:
+        from indicnlp.normalize.indic_normalize import DevanagariNormalizer
+        normalizer = DevanagariNormalizer()
+    if params.tokenize:
+        from indicnlp.tokenize import indic_tokenize
 
-        # Add the word index to the decoded sentence
-        decoded_words[t] = top_indices.view(-1)
+    def preprocess(line):
+        line = line.strip()
+        if normalizer is not None:
+            line = normalizer.normalize(line)
+        if params.tokenize:
+            return indic_tokenize.trivial_tokenize(line)
+        return line.split()
+
+    return preprocess
 
-        # Stop decoding if all sentences have generated an end-of-sentence token
-        if (decoded_words[t] == decoder.eos_index).all():
-            break
 
-    # Convert the tensor of word indices into a list of words
-    translated_sentence = []
-    for i in range(batch_size):
-        words = [decoder.vocab[token.item()] for token in decoded_words[:, i]]
-        # Remove padding and end-of-sentence tokens
-        words = [word for word in words if word != '<pad>' and word != '</s>']
-        translated_sentence.append(' '.join(words))
+def index_sentences(lines, dico, preprocess):
+    """
+    Convert input lines to arrays of word indices.
+    """
+    return [np.array([dico.index(w) for w in preprocess(line)], dtype=np.int64) for line in lines]
 
-    return translated_sentence
+
+def translate_lines(encoder, decoder, lines, data, preprocess, params, pool=None):
+    """
+    Translate a chunk of input lines. Empty lines are translated to empty lines.
+    If an inference pool is provided, the chunk is sharded across its workers.
+    With `params.nbest` > 1, the `nbest` best translations of each line are
+    returned consecutively, best first.
+    """
+    src_dico = data['dico'][params.src_lang]
+    tgt_words = data['dico'][params.tgt_lang].get_words()
+    sentences = index_sentences(lines, src_dico, preprocess)
+    lang1_id = params.lang2id[params.src_lang]
+    lang2_id = params.lang2id[params.tgt_lang]
+    if pool is None:
+        outputs = translate(encoder, decoder, sentences, lang1_id, lang2_id, params)
+    else:
+        outputs = pool.translate(sentences, lang1_id, lang2_id, params.shard_size)
+    if params.nbest > 1:
+        outputs = [output for hypotheses in outputs for output in hypotheses]
+    return [re.sub(r'(@@ )|(@@ ?$)', '', ' '.join(tgt_words[output])) for output in outputs]
 
 
 def main(params):
-    
-    ##### can be used for loading encoder and decoder
     # check parameters
     assert params.exp_name
-    check_all_data_params(params)
+    check_dico_params(params)
     check_mt_model_params(params)
-
-    # initialize experiment / load data / build model
-    logger = initialize_exp(params)
-    data = load_data(params)
-    encoder, decoder, discriminator, lm = build_mt_model(params, data)
-
-    # initialize trainer / reload checkpoint / initialize evaluator
-    trainer = TrainerMT(encoder, decoder, discriminator, lm, data, params)
-    trainer.reload_checkpoint()
-    trainer.test_sharing()  # check parameters sharing
-    evaluator = EvaluatorMT(trainer, data, params)
-    
-    encoded_sentences = encode_input_sentences(input.txt, trainer.encoder)
-    
-    translated_data = translate_sentence(encoded_sentences, trainer.decoder, 100)
-    
-    with open('synthetic_hinglish_sentences', 'w', encoding='utf-8') as f:
-        for item in translated_data:
-            f.write("%s\n" % item)
+    assert params.src_lang in params.langs and params.tgt_lang in params.langs
+    assert params.src_lang != params.tgt_lang
+    assert params.reload_model != '' and params.reload_enc and params.reload_dec, \
+        "A trained model is required: set --reload_model, --reload_enc True and --reload_dec True"
+    assert params.chunk_size > 0
+    assert params.nbest == 1 or params.transformer and 1 <= params.nbest <= params.beam_size, \
+        "--nbest > 1 requires a transformer model and --beam_size >= nbest"
+    assert params.n_workers >= 0 and params.n_threads_per_worker > 0 and params.shard_size > 0
+
+    # initialize experiment / load dictionaries / build model (no dataset is loaded)
+    initialize_exp(params, logger_filename='translate.log')
+    data = load_dictionaries(params)
+    preprocess = get_preprocessor(params)
+    encoder, decoder, _, _ = build_mt_model(params, data, device=params.device if params.n_workers == 0 else 'cpu')
+
+    # CPU worker processes (the model is built on CPU and copied to the workers)
+    pool = None
+    if params.n_workers > 0:
+        if params.chunk_size < 2 * params.n_workers * params.shard_size:
+            logger.warning("Chunks of %i lines cannot keep %i workers busy with shards of %i sentences."
+                           % (params.chunk_size, params.n_workers, params.shard_size))
+        pool = InferencePool(encoder, decoder, params, params.n_workers, params.n_threads_per_worker)
+
+    # stream input lines by chunks, and write translations in the input order
+    f_in = sys.stdin if params.input_hi == '-' else open(params.input_hi, 'r', encoding='utf-8')
+    f_out = sys.stdout if params.output_hinglish == '-' else open(params.output_hinglish, 'w', encoding='utf-8')
+    n_lines = 0
+    start = time.time()
+    while True:
+        lines = list(islice(f_in, params.chunk_size))
+        if len(lines) == 0:
+            break
+        for translation in translate_lines(encoder, decoder, lines, data, preprocess, params, pool):
+            f_out.write(translation + '\n')
+        f_out.flush()
+        n_lines += len(lines)
+        logger.info("Translated %i sentences (%.2f sentences/s)" % (n_lines, n_lines / (time.time() - start)))
+    if pool is not None:
+        pool.log_stats()
+        pool.stop()
+    if f_in is not sys.stdin:
+        f_in.close()
+    if f_out is not sys.stdout:
+        f_out.close()
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Translate Hindi to Hinglish")
-    args = parser.parse_args()
-    main(args)
+    parser = get_parser()
+    parser.description = "Translate Hindi to Hinglish"
+    parser.add_argument("--input_hi", type=str, default="-",
+                        help="Input file (- for stdin)")
+    parser.add_argument("--output_hinglish", type=str, default="-",
+                        help="Output file (- for stdout)")
+    parser.add_argument("--dico_path", type=str, default="",
+                        help="Vocabulary file used to binarize the training data, or binarized dataset "
+                             "(comma-separated list for one dictionary per language)")
+    parser.add_argument("--src_lang", type=str, default="hi",
+                        help="Source language")
+    parser.add_argument("--tgt_lang", type=str, default="en",
+                        help="Target language")
+    parser.add_argument("--normalize", type=bool_flag, default=True,
+                        help="Normalize input sentences with the Devanagari normalizer")
+    parser.add_argument("--tokenize", type=bool_flag, default=True,
+                        help="Tokenize input sentences (input words must match the model dictionary, BPE included)")
+    parser.add_argument("--chunk_size", type=int, default=10000,
+                        help="Number of input lines read / translated at once")
+    parser.add_argument("--n_workers", type=int, default=0,
+                        help="Number of CPU worker processes (0 to translate in the main process)")
+    parser.add_argument("--n_threads_per_worker", type=int, default=1,
+                        help="Number of torch threads in each CPU worker process")
+    parser.add_argument("--shard_size", type=int, default=200,
+                        help="Number of sentences sent to a CPU worker at once")
+    params = parser.parse_args()
+    main(params)
@@ -0,0 +1,158 @@
+"""
+Check that the vectorized batching / mask / reversal functions return the
+same tensors as the original per-sentence implementations.
+"""
+from types import SimpleNamespace
+import numpy as np
+import torch
+import pytest
+
+from src.data.dataset import Dataset
+from src.data.dictionary import get_index_dtype, get_positions_dtype
+from src.utils import get_mask, reverse_sentences
+
+
+N_SPECIAL = 14  # <s>, </s>, <pad>, <unk> and 10 special words
+N_WORDS = 60
+EOS_INDEX = 1
+PAD_INDEX = 2
+UNK_INDEX = 3
+BOS_INDEX = [5, 6]
+
+
+def reference_batch_sentences(dataset, sentences, lang_id):
+    """
+    Take as input a list of n sentences (torch.LongTensor vectors) and return
+    a tensor of size (s_len, n) where s_len is the length of the longest
+    sentence, and a vector lengths containing the length of each sentence
+    (original implementation).
+    """
+    assert type(lang_id) is int
+    lengths = torch.LongTensor([len(s) + 2 for s in sentences])
+    sent = torch.LongTensor(lengths.max(), lengths.size(0)).fill_(dataset.pad_index)
+
+    sent[0] = dataset.bos_index[lang_id]
+    for i, s in enumerate(sentences):
+        sent[1:lengths[i] - 1, i].copy_(s)
+        sent[lengths[i] - 1, i] = dataset.eos_index
+
+    return sent, lengths
+
+
+def reference_get_mask(lengths, all_words, expand=None, ignore_first=False, batch_first=False):
+    """
+    Create a mask of shape (slen, bs) or (bs, slen) (original implementation).
+    """
+    bs, slen = lengths.size(0), lengths.max()
+    mask = torch.ByteTensor(slen, bs).zero_()
+    for i in range(bs):
+        if all_words:
+            mask[:lengths[i], i] = 1
+        else:
+            mask[lengths[i] - 1, i] = 1
+    if expand is not None:
+        assert type(expand) is int
+        mask = mask.unsqueeze(2).expand(slen, bs, expand)
+    if ignore_first:
+        mask[0].fill_(0)
+    if batch_first:
+        mask = mask.transpose(0, 1)
+    return mask
+
+
+def reference_reverse_sentences(batch, lengths):
+    """
+    Reverse sentences inside a batch (original implementation).
+    """
+    bs = lengths.size(0)
+    assert batch.size(1) == bs
+    new_batch = batch.clone()
+    inv_idx = torch.arange(lengths.max() - 1, -1, -1)
+    for i in range(bs):
+        new_batch[:lengths[i], i].copy_(new_batch[:, i][inv_idx[-lengths[i]:]])
+    return new_batch
+
+
+def build_dataset(max_vocab=-1):
+    """
+    Dataset with only the attributes used by `batch_sentences`.
+    """
+    return Dataset(SimpleNamespace(
+        eos_index=EOS_INDEX, pad_index=PAD_INDEX, unk_index=UNK_INDEX, bos_index=BOS_INDEX,
+        batch_size=32, max_tokens=-1, max_vocab=max_vocab,
+    ))
+
+
+def random_sentences(rng):
+    """
+    Flat array of sentences separated by -1, stored with the compact dtypes
+    of the loader, and the (start, end) positions of a random subset of them.
+    """
+    n = rng.randint(1, 30)
+    lengths = rng.randint(1, 25, size=n)
+    lengths[0] = 1
+    ends = np.cumsum(lengths + 1) - 1
+    positions = np.stack([ends - lengths, ends], 1)
+    sent = np.full(ends[-1] + 1, -1, dtype=np.int64)
+    for a, b in positions:
+        sent[a:b] = rng.randint(N_SPECIAL, N_WORDS, size=b - a)
+    sent = sent.astype(get_index_dtype(N_WORDS))
+    positions = positions.astype(get_positions_dtype(len(sent)))
+    return sent, positions[rng.permutation(n)[:rng.randint(1, n + 1)]]
+
+
+def random_lengths(rng):
+    """
+    Sentence lengths of a batch, with at least one sentence of each extreme length.
+    """
+    bs = rng.randint(1, 12)
+    lengths = rng.randint(1, 25, size=bs)
+    lengths[0] = 1
+    return torch.from_numpy(lengths)
+
+
+@pytest.mark.parametrize('max_vocab', [-1, 40])
+def test_batch_sentences_matches_reference(max_vocab):
+    dataset = build_dataset(max_vocab)
+    rng = np.random.RandomState(0)
+    for seed in range(200):
+        lang_id = seed % 2
+        sent, pos = random_sentences(rng)
+        sent1, len1 = dataset.batch_sentences(sent, pos, lang_id)
+        # the original loader pruned the vocabulary of the sentences once loaded
+        pruned = torch.from_numpy(sent.astype(np.int64))
+        if max_vocab != -1:
+            pruned.masked_fill_(pruned >= max_vocab, UNK_INDEX)
+        sent2, len2 = reference_batch_sentences(dataset, [pruned[a:b] for a, b in pos], lang_id)
+        assert sent1.dtype == torch.int64 and len1.dtype == torch.int64
+        assert torch.equal(len1, len2)
+        assert torch.equal(sent1, sent2)
+
+
+@pytest.mark.parametrize('all_words, expand, ignore_first, batch_first', [
+    (True, None, False, False),
+    (False, None, False, False),
+    (True, None, True, False),
+    (False, None, True, True),
+    (True, None, False, True),
+    (True, 7, False, False),
+    (False, 7, False, True),
+])
+def test_get_mask_matches_reference(all_words, expand, ignore_first, batch_first):
+    rng = np.random.RandomState(1)
+    for _ in range(100):
+        lengths = random_lengths(rng)
+        mask1 = get_mask(lengths, all_words, expand=expand, ignore_first=ignore_first, batch_first=batch_first)
+        mask2 = reference_get_mask(lengths, all_words, expand=expand, ignore_first=ignore_first,
+                                   batch_first=batch_first)
+        assert mask1.size() == mask2.size()
+        assert torch.equal(mask1.long(), mask2.long())
+
+
+def test_reverse_sentences_matches_reference():
+    rng = np.random.RandomState(2)
+    for _ in range(200):
+        lengths = random_lengths(rng)
+        batch = torch.from_numpy(rng.randint(N_SPECIAL, N_WORDS, size=(int(lengths.max()), len(lengths))))
+        batch.masked_fill_(torch.arange(batch.size(0))[:, None] >= lengths[None], PAD_INDEX)
+        assert torch.equal(reverse_sentences(batch, lengths), reference_reverse_sentences(batch, lengths))
@@ -0,0 +1,85 @@
+"""
+Check that released splits and evicted binarized files are freed.
+"""
+import gc
+import weakref
+from types import SimpleNamespace
+import numpy as np
+import torch
+
+from src.data import loader
+from src.data.dictionary import Dictionary
+from src.data.loader import LazySplits, load_binarized, release_data
+
+
+class Split(object):
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+
+
+def write_binarized(tmp_path, name, n_sentences):
+    """
+    Binarize `n_sentences` random sentences (non memory-mapped format).
+    """
+    vocab_path = tmp_path / 'vocab'
+    vocab_path.write_text(''.join('w%i %i\n' % (i, 100 - i) for i in range(20)), encoding='utf-8')
+    dico = Dictionary.read_vocab(str(vocab_path))
+    lengths = np.random.RandomState(n_sentences).randint(1, 10, size=n_sentences)
+    positions = np.stack([np.cumsum(lengths + 1) - lengths - 1, np.cumsum(lengths + 1) - 1], 1)
+    sentences = np.full(positions[-1, 1] + 1, -1, dtype=np.int64)
+    for a, b in positions:
+        sentences[a:b] = np.random.randint(14, len(dico), size=b - a)
+    path = str(tmp_path / ('%s.pth' % name))
+    torch.save({
+        'dico': dico,
+        'sentences': torch.from_numpy(sentences),
+        'positions': torch.from_numpy(positions),
+        'unk_words': {},
+    }, path)
+    return path
+
+
+def test_cache_eviction_frees_data(tmp_path):
+    params = SimpleNamespace(max_vocab=-1, data_cache_size=1)
+    path1 = write_binarized(tmp_path, 'data1', 50)
+    path2 = write_binarized(tmp_path, 'data2', 60)
+    loader.loaded_data.clear()
+
+    ref = weakref.ref(load_binarized(path1, params)['sentences'])
+    assert path1 in loader.loaded_data
+    load_binarized(path2, params)
+    assert list(loader.loaded_data.keys()) == [path2]
+    gc.collect()
+    assert ref() is None
+    loader.loaded_data.clear()
+
+
+def test_released_splits_free_data(tmp_path):
+    params = SimpleNamespace(max_vocab=-1, data_cache_size=1)
+    path1 = write_binarized(tmp_path, 'valid', 50)
+    path2 = write_binarized(tmp_path, 'test', 60)
+    loader.loaded_data.clear()
+
+    splits = LazySplits({
+        'train': None,
+        'valid': lambda: Split(load_binarized(path1, params)['sentences']),
+        'test': lambda: Split(load_binarized(path2, params)['sentences']),
+    })
+    data = {'mono': {'en': splits}, 'para': {}, 'back': {}}
+    valid = weakref.ref(splits['valid'].sentences)
+    test = weakref.ref(splits['test'].sentences)
+    assert splits.is_loaded('valid') and splits.is_loaded('test')
+
+    # the split dataset keeps the evicted file data alive until it is released
+    gc.collect()
+    assert valid() is not None
+    release_data(data, ['valid', 'test'])
+    assert not splits.is_loaded('valid') and not splits.is_loaded('test')
+    gc.collect()
+    assert valid() is None
+    assert test() is not None  # still in the cache
+
+    # released splits are reloaded on the next access
+    assert splits['valid'] is not None and splits.is_loaded('valid')
+    loader.loaded_data.clear()
@@ -0,0 +1,141 @@
+"""
+Check that the decoding optimizations do not change the generated sentences:
+greedy decoding follows the teacher-forced decoder, pruning finished sentences
+from the batch and beam search with a single beam give the greedy outputs.
+Small random transformer / LSTM attention models, with a fixed torch seed.
+"""
+from types import SimpleNamespace
+import numpy as np
+import torch
+import torch.nn as nn
+import pytest
+
+from src.model.attention import build_lstm_enc_dec, build_transformer_enc_dec
+
+
+N_SPECIAL = 14  # <s>, </s>, <pad>, <unk> and 10 special words
+N_WORDS = 40
+EOS_INDEX = 1
+PAD_INDEX = 2
+BOS_INDEX = [5, 6]
+MAX_LEN = 20
+N_BATCHES = 30
+MODELS = ['transformer', 'lstm']
+
+
+def build_model(model):
+    """
+    Encoder / decoder with only the parameters used by the models.
+    The output projection is rescaled so that the predicted words vary
+    with the context, and EOS is predicted after a varying number of words.
+    """
+    params = SimpleNamespace(
+        n_langs=2, n_words=[N_WORDS, N_WORDS], bos_index=BOS_INDEX, eos_index=EOS_INDEX, pad_index=PAD_INDEX,
+        emb_dim=16, hidden_dim=16, n_enc_layers=2, n_dec_layers=2, dropout=0, max_len=175, vocab={},
+        share_lang_emb=False, share_encdec_emb=False, share_decpro_emb=False, share_output_emb=False,
+        share_lstm_proj=False, share_att_proj=False, share_enc=0, share_dec=0,
+        freeze_enc_emb=False, freeze_dec_emb=False, dis_input_proj=True, lstm_proj=False, input_feeding=True,
+        transformer_ffn_emb_dim=32, attention_dropout=0, relu_dropout=0,
+        encoder_attention_heads=4, decoder_attention_heads=4,
+        encoder_normalize_before=False, decoder_normalize_before=False,
+        beam_size=0, length_penalty=1.0, coverage_penalty=0, prune_finished=False,
+    )
+    torch.manual_seed(0)
+    if model == 'transformer':
+        encoder, decoder = build_transformer_enc_dec(params)
+    else:
+        encoder, decoder = build_lstm_enc_dec(params)
+    with torch.no_grad():
+        for proj in decoder.proj:
+            nn.init.normal_(proj.weight, 0, 1)
+            nn.init.normal_(proj.bias, 0, 1)
+            proj.bias[EOS_INDEX] = proj.bias.max()
+    return encoder.eval(), decoder.eval()
+
+
+def random_batch(rng):
+    """
+    Batch of source sentences with mixed lengths, padded with the padding index.
+    """
+    bs = rng.randint(1, 12)
+    lengths = rng.randint(3, 15, size=bs)
+    x = np.full((lengths.max(), bs), PAD_INDEX, dtype=np.int64)
+    for i, length in enumerate(lengths):
+        x[0, i] = BOS_INDEX[0]
+        x[1:length - 1, i] = rng.randint(N_SPECIAL, N_WORDS, size=length - 2)
+        x[length - 1, i] = EOS_INDEX
+    return torch.from_numpy(x), torch.from_numpy(lengths)
+
+
+def greedy(encoder, decoder, x, lengths, prune_finished=False):
+    decoder.prune_finished = prune_finished
+    with torch.no_grad():
+        return decoder.generate(encoder(x, lengths, 0), 1, max_len=MAX_LEN)[:2]
+
+
+def beam_search(encoder, decoder, x, lengths, **kwargs):
+    # the transformer beam search expands the encoder output in place, so encode again
+    with torch.no_grad():
+        return decoder.generate_beam(encoder(x, lengths, 0), 1, max_len=MAX_LEN, **kwargs)[:2]
+
+
+@pytest.mark.parametrize('model', MODELS)
+def test_greedy_matches_teacher_forcing(model):
+    encoder, decoder = build_model(model)
+    rng = np.random.RandomState(0)
+    for _ in range(N_BATCHES):
+        x, lengths = random_batch(rng)
+        y, y_len = greedy(encoder, decoder, x, lengths)
+        assert (y[0] == BOS_INDEX[1]).all()
+        assert (y[y_len - 1, torch.arange(len(y_len))] == EOS_INDEX).all()
+        with torch.no_grad():
+            scores = decoder(encoder(x, lengths, 0), y[:-1], 1)
+        # every generated word has the best teacher-forced score
+        # (except EOS, when it is added to sentences reaching the maximum length)
+        n_predicted = y_len - 1 - y_len.eq(MAX_LEN).long()
+        predicted = torch.arange(y.size(0) - 1)[:, None] < n_predicted[None]
+        chosen = scores.gather(2, y[1:].unsqueeze(2)).squeeze(2)
+        best = scores.max(2)[0]
+        assert (chosen[predicted] >= best[predicted] - 1e-4).all()
+
+
+@pytest.mark.parametrize('model', MODELS)
+def test_prune_finished_matches_full_batch(model):
+    encoder, decoder = build_model(model)
+    rng = np.random.RandomState(1)
+    for _ in range(N_BATCHES):
+        x, lengths = random_batch(rng)
+        y1, len1 = greedy(encoder, decoder, x, lengths, prune_finished=False)
+        y2, len2 = greedy(encoder, decoder, x, lengths, prune_finished=True)
+        assert torch.equal(len1, len2)
+        assert torch.equal(y1, y2)
+
+
+@pytest.mark.parametrize('model', MODELS)
+def test_beam_size_1_matches_greedy(model):
+    encoder, decoder = build_model(model)
+    rng = np.random.RandomState(2)
+    for _ in range(N_BATCHES):
+        x, lengths = random_batch(rng)
+        y1, len1 = greedy(encoder, decoder, x, lengths)
+        y2, len2 = beam_search(encoder, decoder, x, lengths, beam_size=1)
+        for i in range(len(len1)):
+            # the transformer beam search does not end hypotheses at the first step,
+            # and generates up to MAX_LEN words: only compare the other sentences
+            if model == 'transformer' and not 3 <= len1[i] < MAX_LEN:
+                continue
+            assert len1[i] == len2[i]
+            assert torch.equal(y1[:len1[i], i], y2[:len2[i], i])
+
+
+def test_nbest_starts_with_best_hypothesis():
+    encoder, decoder = build_model('transformer')
+    rng = np.random.RandomState(3)
+    for _ in range(N_BATCHES):
+        x, lengths = random_batch(rng)
+        y1, len1 = beam_search(encoder, decoder, x, lengths, beam_size=4)
+        y2, len2 = beam_search(encoder, decoder, x, lengths, beam_size=4, nbest=3)
+        assert len(len2) == 3 * len(len1)
+        assert torch.equal(len2[::3], len1)
+        for i in range(len(len1)):
+            assert torch.equal(y2[:len2[3 * i], 3 * i], y1[:len1[i], i])
@@ -0,0 +1,177 @@
+"""
+Check that the vectorized word shuffle / dropout / blank noise functions
+return the same batches as the original per-sentence implementations,
+for the same numpy random seed.
+"""
+from types import SimpleNamespace
+import numpy as np
+import torch
+import pytest
+
+from src.trainer import TrainerMT
+
+
+N_SPECIAL = 14  # <s>, </s>, <pad>, <unk> and 10 special words
+N_WORDS = 60
+EOS_INDEX = 1
+PAD_INDEX = 2
+BLANK_INDEX = 4
+BOS_INDEX = [5, 6]
+
+
+def reference_word_shuffle(trainer, x, l, lang_id):
+    """
+    Randomly shuffle input words (original implementation).
+    """
+    if trainer.params.word_shuffle == 0:
+        return x, l
+
+    # define noise word scores
+    noise = np.random.uniform(0, trainer.params.word_shuffle, size=(x.size(0) - 1, x.size(1)))
+    noise[0] = -1  # do not move start sentence symbol
+
+    # be sure to shuffle entire words
+    bpe_end = trainer.bpe_end[lang_id][x.numpy()]
+    word_idx = bpe_end[::-1].cumsum(0)[::-1]
+    word_idx = word_idx.max(0)[None, :] - word_idx
+
+    assert trainer.params.word_shuffle > 1
+    x2 = x.clone()
+    for i in range(l.size(0)):
+        # generate a random permutation
+        scores = word_idx[:l[i] - 1, i] + noise[word_idx[:l[i] - 1, i], i]
+        scores += 1e-6 * np.arange(l[i] - 1)  # ensure no reordering inside a word
+        permutation = scores.argsort()
+        # shuffle words
+        x2[:l[i] - 1, i].copy_(x2[:l[i] - 1, i][torch.from_numpy(permutation)])
+    return x2, l
+
+
+def reference_word_dropout(trainer, x, l, lang_id):
+    """
+    Randomly drop input words (original implementation).
+    """
+    if trainer.params.word_dropout == 0:
+        return x, l
+    assert 0 < trainer.params.word_dropout < 1
+
+    # define words to drop
+    bos_index = trainer.params.bos_index[lang_id]
+    assert (x[0] == bos_index).sum() == l.size(0)
+    keep = np.random.rand(x.size(0) - 1, x.size(1)) >= trainer.params.word_dropout
+    keep[0] = 1  # do not drop the start sentence symbol
+
+    # be sure to drop entire words
+    bpe_end = trainer.bpe_end[lang_id][x.numpy()]
+    word_idx = bpe_end[::-1].cumsum(0)[::-1]
+    word_idx = word_idx.max(0)[None, :] - word_idx
+
+    sentences = []
+    lengths = []
+    for i in range(l.size(0)):
+        assert x[l[i] - 1, i] == trainer.params.eos_index
+        words = x[:l[i] - 1, i].tolist()
+        # randomly drop words from the input
+        new_s = [w for j, w in enumerate(words) if keep[word_idx[j, i], i]]
+        # we need to have at least one word in the sentence (more than the start / end sentence symbols)
+        if len(new_s) == 1:
+            new_s.append(words[np.random.randint(1, len(words))])
+        new_s.append(trainer.params.eos_index)
+        assert len(new_s) >= 3 and new_s[0] == bos_index and new_s[-1] == trainer.params.eos_index
+        sentences.append(new_s)
+        lengths.append(len(new_s))
+    # re-construct input
+    l2 = torch.LongTensor(lengths)
+    x2 = torch.LongTensor(l2.max(), l2.size(0)).fill_(trainer.params.pad_index)
+    for i in range(l2.size(0)):
+        x2[:l2[i], i].copy_(torch.LongTensor(sentences[i]))
+    return x2, l2
+
+
+def reference_word_blank(trainer, x, l, lang_id):
+    """
+    Randomly blank input words (original implementation).
+    """
+    if trainer.params.word_blank == 0:
+        return x, l
+    assert 0 < trainer.params.word_blank < 1
+
+    # define words to blank
+    bos_index = trainer.params.bos_index[lang_id]
+    assert (x[0] == bos_index).sum() == l.size(0)
+    keep = np.random.rand(x.size(0) - 1, x.size(1)) >= trainer.params.word_blank
+    keep[0] = 1  # do not blank the start sentence symbol
+
+    # be sure to blank entire words
+    bpe_end = trainer.bpe_end[lang_id][x.numpy()]
+    word_idx = bpe_end[::-1].cumsum(0)[::-1]
+    word_idx = word_idx.max(0)[None, :] - word_idx
+
+    sentences = []
+    for i in range(l.size(0)):
+        assert x[l[i] - 1, i] == trainer.params.eos_index
+        words = x[:l[i] - 1, i].tolist()
+        # randomly blank words from the input
+        new_s = [w if keep[word_idx[j, i], i] else trainer.params.blank_index for j, w in enumerate(words)]
+        new_s.append(trainer.params.eos_index)
+        assert len(new_s) == l[i] and new_s[0] == bos_index and new_s[-1] == trainer.params.eos_index
+        sentences.append(new_s)
+    # re-construct input
+    x2 = torch.LongTensor(l.max(), l.size(0)).fill_(trainer.params.pad_index)
+    for i in range(l.size(0)):
+        x2[:l[i], i].copy_(torch.LongTensor(sentences[i]))
+    return x2, l
+
+
+def build_trainer(word_shuffle=0, word_dropout=0, word_blank=0):
+    """
+    Trainer with only the attributes used by the noise functions.
+    About a third of the words are BPE pieces (ending with "@@").
+    """
+    rng = np.random.RandomState(0)
+    bpe_end = np.concatenate([np.ones(N_SPECIAL, dtype=bool), rng.rand(N_WORDS - N_SPECIAL) >= 0.3])
+    trainer = TrainerMT.__new__(TrainerMT)
+    trainer.params = SimpleNamespace(
+        word_shuffle=word_shuffle, word_dropout=word_dropout, word_blank=word_blank,
+        bos_index=BOS_INDEX, eos_index=EOS_INDEX, pad_index=PAD_INDEX, blank_index=BLANK_INDEX,
+    )
+    trainer.bpe_end = [bpe_end, bpe_end]
+    return trainer
+
+
+def random_batch(rng, lang_id):
+    """
+    Batch of sentences with mixed lengths (including the shortest
+    possible sentences), padded with the padding index.
+    """
+    bs = rng.randint(1, 12)
+    lengths = rng.randint(3, 25, size=bs)
+    lengths[0] = 3
+    x = np.full((lengths.max(), bs), PAD_INDEX, dtype=np.int64)
+    for i, length in enumerate(lengths):
+        x[0, i] = BOS_INDEX[lang_id]
+        x[1:length - 1, i] = rng.randint(N_SPECIAL, N_WORDS, size=length - 2)
+        x[length - 1, i] = EOS_INDEX
+    return torch.from_numpy(x), torch.from_numpy(lengths)
+
+
+@pytest.mark.parametrize('noise, reference, kwargs', [
+    ('word_shuffle', reference_word_shuffle, {'word_shuffle': 3}),
+    ('word_shuffle', reference_word_shuffle, {'word_shuffle': 10}),
+    ('word_dropout', reference_word_dropout, {'word_dropout': 0.1}),
+    ('word_dropout', reference_word_dropout, {'word_dropout': 0.6}),
+    ('word_blank', reference_word_blank, {'word_blank': 0.1}),
+    ('word_blank', reference_word_blank, {'word_blank': 0.5}),
+])
+def test_noise_matches_reference(noise, reference, kwargs):
+    trainer = build_trainer(**kwargs)
+    rng = np.random.RandomState(1)
+    for seed in range(200):
+        lang_id = seed % 2
+        x, l = random_batch(rng, lang_id)
+        np.random.seed(seed)
+        x1, l1 = getattr(trainer, noise)(x, l, lang_id)
+        np.random.seed(seed)
+        x2, l2 = reference(trainer, x, l, lang_id)
+        assert torch.equal(l1, l2)
+        assert torch.equal(x1, x2)
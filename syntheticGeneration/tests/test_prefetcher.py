@@ -0,0 +1,33 @@
+"""
+Check the background batch prefetcher.
+"""
+import itertools
+import pytest
+
+from src.data.prefetcher import BatchPrefetcher
+
+
+def test_prefetcher_order():
+    prefetcher = BatchPrefetcher(lambda: iter(range(10)), n_batches=3)
+    assert list(prefetcher) == list(range(10))
+    prefetcher.close()
+
+
+def test_prefetcher_forwards_errors():
+    def iterator():
+        yield 0
+        raise ValueError("bad batch")
+    prefetcher = BatchPrefetcher(iterator, n_batches=3)
+    assert next(prefetcher) == 0
+    with pytest.raises(ValueError):
+        next(prefetcher)
+    prefetcher.close()
+
+
+def test_prefetcher_close():
+    # the thread is blocked on a full queue of an infinite iterator
+    prefetcher = BatchPrefetcher(itertools.count, n_batches=2)
+    assert next(prefetcher) == 0
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    assert prefetcher.queue.empty()